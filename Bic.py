@@ -14,43 +14,86 @@ Purpose:
 """
 # Import the various modules necessary
 import time
+import queue
 import numpy as np
 from sklearn import preprocessing
 from sklearn import mixture
 from sklearn import decomposition
 from math import log10, floor
 
+import GMM
 import Load
+import Parallel
 import Print
 
-start_time = time.clock()
+start_time = time.perf_counter()
 
 def main(address, filename_raw_data, subsample_bic, repeat_bic, max_groups, grid_bic,\
-         conc_bic, size_bic, n_dimen, fraction_nan_samples, fraction_nan_depths, cov_type):
+         conc_bic, size_bic, n_dimen, fraction_nan_samples, fraction_nan_depths, cov_type,\
+         callback=None, n_workers=1, seed_bic=None, patience_bic=None):
+    """ BIC scores of GMMs with 1 to max_groups-1 classes, fitted to repeat_bic
+    uniformly resampled training datasets. With patience_bic set, a repeat
+    stops once patience_bic consecutive n have failed to improve on its lowest
+    BIC; the untested n are stored as NaN and left out of the averages.
+
+    Every finished fit is appended to Data_store/Info/BIC_cells.csv with its
+    seed and fit time, so a sweep restarted with the same settings skips
+    the cells it has already done """
     
-    bic_many = np.ones((repeat_bic,max_groups-1)) # Need to use (max_groups-1) as the bic runs from 1 to max_groups 
-    n_lowest_array = np.zeros(repeat_bic)
-    n_comp_array = None
+    # fixing seed_bic makes the training sets and GMM initialisations repeatable
+    if seed_bic is not None:
+        np.random.seed(seed_bic)
+
+    # load and clean the raw data once, every repeat resamples from it
+    lon, lat, dynHeight, Tint, Sint, varTime, depth, profile_id = \
+        Load.loadAndClean(filename_raw_data, fraction_nan_samples, fraction_nan_depths)
+    # the uniform sampling cells do not change between repeats
+    cells = Load.gridCells(lon, lat, grid_bic)
+
+    # one training dataset (in its own PCA space) per repeat
+    X_train_list = []
     for i in range(0,repeat_bic):
-        print("Starting ", i)
-        bic = bic_oneRun(address, filename_raw_data, subsample_bic, repeat_bic, max_groups, grid_bic,\
-                   conc_bic, size_bic, n_dimen, fraction_nan_samples, fraction_nan_depths, cov_type)
-        bic_many[i,:] = bic[0]
-        n_lowest_array[i] = bic[1]
-        if i == 0 :
-            n_comp_array = bic[2]
-        del bic
-        print("finished ", i)
+        X_train_list.append(bic_trainingSet(Tint, cells, conc_bic, n_dimen))
+
+    # one GMM random_state per (repeat, n_components) fit
+    n_comp_array = np.arange(1, max_groups)
+    seeds = np.random.randint(0, 2**31-1, size=(repeat_bic, max_groups-1))
+
+    # cells finished by an earlier run with the same settings (and seeds)
+    config = '/'.join([str(v) for v in [filename_raw_data, subsample_bic, \
+                       repeat_bic, max_groups, grid_bic, conc_bic, n_dimen, \
+                       fraction_nan_samples, fraction_nan_depths, cov_type, seed_bic]])
+    done = bic_readCheckpoint(address, config, seeds, n_comp_array)
+
+    bic_many = np.ones((repeat_bic,max_groups-1)) # Need to use (max_groups-1) as the bic runs from 1 to max_groups 
+    if n_workers == 1:
+        for i in range(0,repeat_bic):
+            print("Starting ", i)
+            checkpoint = bic_checkpointFunction(address, config, i)
+            bic_many[i,:], fit_logs = bic_calculate(X_train_list[i], n_comp_array, \
+                                        cov_type, seeds[i,:], 'r'+str(i).zfill(3), callback, \
+                                        patience_bic, done[i], checkpoint)
+            # convergence telemetry, written as each repeat finishes
+            Print.printFitLog(address, None, 'BIC', fit_logs, \
+                              append=(i > 0 or len(done[i]) > 0))
+            print("finished ", i)
+    else:
+        bic_many = bic_calculateParallel(address, X_train_list, n_comp_array, \
+                                         cov_type, seeds, callback, n_workers, \
+                                         patience=patience_bic, config=config, done=done)
+    n_lowest_array = n_comp_array[np.nanargmin(bic_many, axis=1)]
+    print("Bic.main number of GMM fits = ", np.sum(np.isfinite(bic_many)), \
+          " of ", bic_many.size)
         
     # bic_many shape (repeat, n_comp_array)
-        
-    bic_stand = preprocessing.StandardScaler()
-    bic_stand.fit(bic_many)
-    bic_mean = bic_stand.mean_
-    bic_stdev = np.sqrt(bic_stand.var_)
+    # (NaN where a repeat stopped early)
+    bic_mean = np.nanmean(bic_many, axis=0)
+    bic_stdev = np.nanstd(bic_many, axis=0)
 
     # Calculate the most appropriate number of components from the bic_scores
     def round_sig(x, x_2, sig=2):
+        if x_2 == 0:    # every repeat chose the same n
+            return x
         return round(x, sig-int(floor(log10(abs(x_2))))-1)
         
     n_stand = preprocessing.StandardScaler()
@@ -62,23 +105,24 @@ def main(address, filename_raw_data, subsample_bic, repeat_bic, max_groups, grid
     n_stdev = round_sig(n_stdev, n_stdev)
     
     # Alternative way of calculating the minimum number of components
-    min_index = np.where(bic_mean==bic_mean.min())[0]
-    n_min = (n_comp_array[min_index])[0]
+    n_min = n_comp_array[np.nanargmin(bic_mean)]
              
     # Print to file
     Print.printBIC(address, repeat_bic, bic_many, bic_mean, bic_stdev, n_mean, n_stdev, n_min)
   
 ###############################################################################
-def bic_oneRun(address, filename_raw_data, subsample_bic, repeat_bic, max_groups, grid_bic,\
-         conc_bic, size_bic, n_dimen, fraction_nan_samples, fraction_nan_depths, cov_type):
-
-    # load the training data
-    lon_train, lat_train, dynHeight_train, Tint_train, varTrain_centre, Sint_train, varTime_train \
-            = None, None, None, None, None, None, None
-    lon_train, lat_train, dynHeight_train, Tint_train, varTrain_centre, Sint_train, varTime_train \
-        = Load.main(address, filename_raw_data, None, subsample_bic, False,\
-         False, grid_bic, conc_bic, None, None, None,\
-         fraction_nan_samples, fraction_nan_depths, cov_type, run_bic=True)
+def bic_trainingSet(Tint, cells, conc_bic, n_dimen):
+    """ Uniformly resample the cleaned profiles, then standardise and PCA
+    the sample (nothing is reloaded or written to file) """
+
+    # select the training data
+    Tint_train = None
+    Tint_train = Tint[Load.uniformTrainIndices(cells, conc_bic), :]
+
+    # centre and standardise
+    stand, varTrain_centre = None, None
+    stand = preprocessing.StandardScaler()
+    varTrain_centre = stand.fit_transform(Tint_train)
     
     # calculate PCA
     pca, X_pca_train = None, None
@@ -86,36 +130,186 @@ def bic_oneRun(address, filename_raw_data, subsample_bic, repeat_bic, max_groups
     pca.fit(varTrain_centre)                         # Fit the PCA to the training data
     X_pca_train = pca.transform(varTrain_centre) 
     del pca
-    
-    # run BIC for GMM with different number of components
-    # bic_values contains the array of scores for the different n_comp
-    # n_lowest is the lowest n for each repeat
-    # n_comp_array is from 0 to max_groups in integers
-    bic_values, n_lowest, n_comp_array = None, None, None
-    bic_values, n_lowest, n_comp_array = bic_calculate(X_pca_train, max_groups, cov_type)
-    
-    return bic_values, n_lowest, n_comp_array
+
+    return X_pca_train
 
 ###############################################################################
-def bic_calculate(X, max_groups, cov_type):
-#    print("BIC X shape = ",X.shape)
-    X = X.reshape(-1,1)
-#    print("BIC X.reshape shape = ", X.shape)
-    lowest_bic, bic_score = np.infty, []
-    n_components_range = np.arange(1, max_groups)
-    for n_components in n_components_range:
-#        print("BIC n_comp = ",n_components)
-
-        # create GMM object
-        gmm = mixture.GaussianMixture(n_components = n_components, covariance_type = cov_type)
-        # fit test dataset to GMM 
-        gmm.fit(X)
-        # append to results array
-        bic_score.append(gmm.bic(X))
-        if bic_score[-1] < lowest_bic:
-            lowest_bic = bic_score[-1]
-            lowest_n = n_components
-    bic_score = np.asarray(bic_score).reshape(1,-1)
-    return bic_score, lowest_n, n_components_range
-
-print('BIC runtime = ', time.clock() - start_time,' s')
+def bic_calculate(X, n_comp_array, cov_type, seeds, label='', callback=None, \
+                  patience=None, done=None, checkpoint=None):
+    # BIC score for each number of components in n_comp_array (in order),
+    # NaN for those skipped after an early stop. Scores already in done
+    # ({index in n_comp_array: bic}) are reused, new ones go to checkpoint
+    bic_score, fit_logs = np.full(len(n_comp_array), np.nan), []
+    if done is None:
+        done = {}
+    for j in range(len(n_comp_array)):
+        if j in done:
+            bic_score[j] = done[j]
+        else:
+            bic_score[j], fit_log = bic_fitOne(X, n_comp_array[j], cov_type, \
+                                               seeds[j], label, callback)
+            fit_logs.append(fit_log)
+            if checkpoint is not None:
+                checkpoint(n_comp_array[j], seeds[j], bic_score[j], fit_log)
+        if bic_stopHere(bic_score[:j+1], patience):
+            print("Bic.bic_calculate "+label+" stopping after n = ", n_comp_array[j])
+            break
+    return bic_score, fit_logs
+
+def bic_stopHere(bic_scores, patience):
+    """ True once the last patience scores (for consecutive n) are all above
+    the lowest score so far """
+    if patience is None:
+        return False
+    return len(bic_scores) - 1 - np.argmin(bic_scores) >= patience
+
+def bic_readCheckpoint(address, config, seeds, n_comp_array):
+    # [{index in n_comp_array: bic} per repeat] for stored cells whose seed
+    # matches this run (with seed_bic = None nothing matches)
+    cells = Print.readBICCells(address, config)
+    done = []
+    for i in range(seeds.shape[0]):
+        done.append({})
+        for j in range(len(n_comp_array)):
+            cell = cells.get((i, int(n_comp_array[j])))
+            if cell is not None and cell[0] == seeds[i,j]:
+                done[i][j] = cell[1]
+    print("Bic.bic_readCheckpoint skipping ", sum([len(d) for d in done]), " fits")
+    return done
+
+def bic_checkpointFunction(address, config, i):
+    def checkpoint(n_components, seed, bic, fit_log):
+        Print.printBICCell(address, config, i, n_components, seed, bic, \
+                           fit_log['fit_time'])
+    return checkpoint
+
+def bic_fitOne(X, n_components, cov_type, seed, label='', callback=None):
+    # X is the (samples, col_reduced) training set in PCA space, the same
+    # space and covariance type that GMM.create uses
+
+    # create GMM object
+    gmm = mixture.GaussianMixture(n_components = n_components, \
+                                  covariance_type = cov_type, random_state = seed)
+    # fit test dataset to GMM 
+    fit_log = GMM.fitWithTelemetry(gmm, X, \
+                    label+'n'+str(n_components).zfill(2), callback)
+    return gmm.bic(X), fit_log
+
+###############################################################################
+# process-parallel (repeat x n_components) grid
+
+# training sets and settings held by each worker process
+worker_state = {}
+
+def bic_calculateParallel(address, X_train_list, n_comp_array, cov_type, seeds, \
+                          callback=None, n_workers=None, n_threads=1, patience=None, \
+                          config='', done=None):
+    print("Bic.bic_calculateParallel")
+    """ Every (repeat, n_components) fit is an independent task on a process
+    pool. The training sets are stacked (zero padded to the largest number
+    of PCs) into one shared array; results are gathered into bic_many by
+    index, so the output does not depend on the order tasks finish in.
+
+    With patience set, tasks are submitted in increasing n for each repeat
+    and a repeat is stopped by the same rule as bic_calculate, applied to the
+    completed prefix of its row; fits that were already running past the
+    stopping point are discarded so the result matches the serial sweep.
+    Cells in done (see bic_readCheckpoint) are not refitted """
+    repeat_bic = len(X_train_list)
+    n_samples = max([X.shape[0] for X in X_train_list])
+    n_cols = np.array([X.shape[1] for X in X_train_list])
+    n_rows = np.array([X.shape[0] for X in X_train_list])
+
+    X_stack = np.zeros((repeat_bic, n_samples, n_cols.max()))
+    for i in range(repeat_bic):
+        X_stack[i,:n_rows[i],:n_cols[i]] = X_train_list[i]
+    X_shm, X_shared, X_spec = Parallel.toSharedArray(X_stack)
+    del X_stack
+
+    n_groups = len(n_comp_array)
+    bic_many = np.full((repeat_bic, n_groups), np.nan)
+    finished = np.zeros((repeat_bic, n_groups), dtype=bool)
+    stop_at = np.full(repeat_bic, n_groups)   # number of n kept per repeat
+    next_j = np.zeros(repeat_bic, dtype=int)  # next n to submit per repeat
+    results = queue.Queue()
+    if done is None:
+        done = [{} for i in range(repeat_bic)]
+    for i in range(repeat_bic):
+        for j in done[i]:
+            bic_many[i,j] = done[i][j]
+            finished[i,j] = True
+        bic_stopParallel(bic_many, finished, stop_at, i, patience)
+    resumed = sum([len(d) for d in done]) > 0
+
+    n_workers = Parallel.workerCount(n_workers, n_threads)
+    pool = Parallel.makePool(n_workers, n_threads, bic_workerInit, \
+                             (X_spec, n_rows, n_cols, cov_type, callback))
+    max_in_flight = 2*n_workers
+    try:
+        n_in_flight, n_done = 0, 0
+        while True:
+            # keep the pool busy, lowest n first across the repeats
+            while n_in_flight < max_in_flight:
+                for i in range(repeat_bic):
+                    while next_j[i] < stop_at[i] and finished[i,next_j[i]]:
+                        next_j[i] = next_j[i] + 1
+                open_repeats = np.where(next_j < stop_at)[0]
+                if open_repeats.size == 0:
+                    break
+                i = open_repeats[np.argmin(next_j[open_repeats])]
+                j = next_j[i]
+                pool.apply_async(bic_workerTask, ((i, j, n_comp_array[j], seeds[i,j]),), \
+                                 callback=results.put, error_callback=results.put)
+                next_j[i] = j + 1
+                n_in_flight = n_in_flight + 1
+            if n_in_flight == 0:
+                break
+
+            # collect one result
+            result = results.get()
+            n_in_flight = n_in_flight - 1
+            if isinstance(result, BaseException):
+                raise result
+            i, j, bic, fit_log = result
+            Print.printFitLog(address, None, 'BIC', [fit_log], \
+                              append=(n_done > 0 or resumed))
+            Print.printBICCell(address, config, i, n_comp_array[j], seeds[i,j], \
+                               bic, fit_log['fit_time'])
+            n_done = n_done + 1
+            if j >= stop_at[i]:
+                continue
+            bic_many[i,j] = bic
+            finished[i,j] = True
+            bic_stopParallel(bic_many, finished, stop_at, i, patience)
+    finally:
+        pool.close()
+        pool.join()
+        Parallel.releaseSharedArrays([X_shm])
+
+    print("Bic.bic_calculateParallel finished ", n_done, " fits")
+    return bic_many
+
+def bic_stopParallel(bic_many, finished, stop_at, i, patience):
+    # apply the stopping rule to each completed prefix of repeat i
+    n_prefix = np.argmin(np.append(finished[i,:], False))
+    for m in range(1, n_prefix + 1):
+        if bic_stopHere(bic_many[i,:m], patience):
+            stop_at[i] = min(stop_at[i], m)
+            break
+    bic_many[i,stop_at[i]:] = np.nan
+
+def bic_workerInit(X_spec, n_rows, n_cols, cov_type, callback):
+    worker_state['X'] = Parallel.attachSharedArray(X_spec)
+    worker_state['n_rows'] = n_rows
+    worker_state['n_cols'] = n_cols
+    worker_state['cov_type'] = cov_type
+    worker_state['callback'] = callback
+
+def bic_workerTask(task):
+    i, j, n_components, seed = task
+    X = worker_state['X'][i, :worker_state['n_rows'][i], :worker_state['n_cols'][i]]
+    bic, fit_log = bic_fitOne(X, n_components, worker_state['cov_type'], seed, \
+                              'r'+str(i).zfill(3), worker_state['callback'])
+    return i, j, bic, fit_log
+
+print('BIC runtime = ', time.perf_counter() - start_time,' s')
@@ -11,12 +11,16 @@ Input:
 Output:
     - data frame with everything, including SST sorted labels
        (saved as pickle file)
-    - old2new: new class indices (sorted by SST)
+    - old2new: new class indices (sorted by temperature, of the GMM
+      class means by default or of the classified profiles)
+    - with streamed=True the statistics come from the accumulators that
+      GMM.apply filled chunk by chunk (accumulateStatistics) and no data
+      frame is written
 
 """
 
 # import relevant modules
-import glob
+import os
 import pandas as pd
 import scipy as sp
 import numpy as np
@@ -24,84 +28,147 @@ import matplotlib.pyplot as plt
 import Print
 import pickle
 import csv
+import Parallel
+import Reconstruct
 
-def main(address, runIndex, n_comp):
+def main(address, runIndex, n_comp, quantiles='exact', ordering='parameters', \
+         streamed=False):
 
     print("ClassProperties.main()")
 
+    # statistics accumulated in GMM.apply, without loading the profiles
+    if streamed:
+        return mainStreamed(address, runIndex, n_comp, ordering)
+
     # set paths
     floc = address + 'Data_store/CentredAndUncentred/' 
     labloc_unsorted = address + 'Data_store/Labels/Labels_unsorted.csv'
     frame_store = address + 'Objects/AllProfiles.pkl'
 
-    # find all csv files
-    allFiles = glob.glob(floc + "*.csv") 
-    frame = pd.DataFrame()
-
-    # read in label data - now passed as an argument
-    df0 = pd.read_csv(labloc_unsorted, index_col=None, header=0)
-    df1 = df0['label']
-    labels = df1.values
+    # read in label data, indexed by profile id (this sets the profile order)
+    df0 = pd.read_csv(labloc_unsorted, index_col='profile_id', header=0)
+    profile_id = df0.index.values.astype(np.int64)
+    labels = df0['label'].values
 
     # read depth levels
     depths_retained = Print.readDepth(address, runIndex)
 
-    # load posterior probabilities for each class
+    # load posterior probabilities for each class, joined on profile id
     class_number_array = None
     class_number_array = np.arange(0,n_comp).reshape(-1,1)
     lon_pp,lat_pp,dynHeight_pp,varTime_pp,post_prob = \
     Print.readPosteriorProb(address, runIndex, class_number_array)
+    pp_id = pd.read_csv(address + 'Data_store/Probabilities/Post_prob_class000.csv', \
+                        usecols=['profile_id'])['profile_id'].values
+    post_prob = post_prob[joinProfiles(pp_id, profile_id, 'Post_prob_class000.csv')]
 
-    # read in T,S data. stack together with label data
-    list_ = []
-    for file_ in allFiles:
-        df = pd.read_csv(file_, index_col=None, header=0)
-        c = np.column_stack((df.values,labels))
-        list_.append(c)
-
-    # stack depths as new dimension / shape is (profile number, variable, depth)
-    # where variables are lon lat dynHeight Tint Tint_centred Sint Time Label
-    allOne = np.dstack(list_)
-    numberOfProfiles, numberOfVars, numberOfDepths = allOne.shape
-
-    # make a pandas dataframe that can be easily split
-    print('ClassProperties.main() : creating data frame (this may take a while)')
-    d = []
-    for i in range(0,numberOfProfiles):
-        for k in range(0,numberOfDepths):
-            d.append({'profile_index': i, 
-                      'depth_index': k,
-                      'longitude': allOne[i,0,k],
-                      'latitude': allOne[i,1,k],
-                      'pressure': depths_retained[k],
-                      'dynamic_height': allOne[i,2,k],
-                      'temperature': allOne[i,3,k],
-                      'temperature_standardized': allOne[i,4,k],
-                      'salinity': allOne[i,5,k],
-                      'time': allOne[i,6,k],
-                      'class': int(allOne[i,7,k]),
-                      'posterior_probability': np.max(post_prob[i,:])})
-    allDF = pd.DataFrame(d)        
-
-    # clear some memory by getting rid of variables
-    del allOne
-    del post_prob
+    # read in T,S data (one file per retained depth) straight into
+    # (profile, depth) arrays, each row joined to the labels on profile id
+    numberOfProfiles, numberOfDepths = profile_id.size, len(depths_retained)
+    wide = {}
+    for column in ['dynamic_height', 'temperature', 'temperature_standardized', \
+                   'salinity']:
+        wide[column] = np.empty((numberOfProfiles, numberOfDepths))
+    for i, d in enumerate(depths_retained):
+        fname = 'CentredAndUncentred_depth' + str(int(d)).zfill(3) + '.csv'
+        df = pd.read_csv(floc + fname, index_col='profile_id', header=0)
+        values = df.values[joinProfiles(df.index.values, profile_id, fname),:7]
+        if i == 0:
+            # lon lat Time are per profile
+            lon, lat, varTime = values[:,0], values[:,1], values[:,6]
+        wide['dynamic_height'][:,i] = values[:,2]
+        wide['temperature'][:,i] = values[:,3]
+        wide['temperature_standardized'][:,i] = values[:,4]
+        wide['salinity'][:,i] = values[:,5]
+        del df, values
+
+    # sort by temperature (these are the new class numbers), either of the
+    # GMM class means or of the profiles assigned to each class
+    labels = labels.astype(int)
+    if ordering == 'data':
+        T_means = classStatistics({'temperature': wide['temperature']}, labels, \
+                                  n_comp, None)['temperature']['mean']
+        old2new = np.argsort(T_means.reindex(np.arange(n_comp)).values)
+    else:
+        old2new = parameterOrder(address, runIndex)
+
+    printOld2new(address, old2new, n_comp)
+    new_of_old = np.empty(n_comp, dtype=int)
+    new_of_old[old2new] = np.arange(n_comp)
+    labels_sorted = new_of_old[labels]
+    posterior = np.max(post_prob, axis=1)
 
-    # read the pickle file data frame (for testing only)
-#   allDF = pd.read_pickle(frame_store, compression='infer')
+    # write some summaries to csv, one per column of allDF: the per-profile
+    # and per-depth columns are broadcast (read-only) views, not copies
+    print('ClassProperties.main(): writing summaries')
+    shape = (numberOfProfiles, numberOfDepths)
+    byProfile = lambda v: np.broadcast_to(np.asarray(v)[:,np.newaxis], shape)
+    byDepth = lambda v: np.broadcast_to(np.asarray(v)[np.newaxis,:], shape)
+    columns = {'profile_index': byProfile(np.arange(numberOfProfiles)),
+               'depth_index': byDepth(np.arange(numberOfDepths)),
+               'longitude': byProfile(lon),
+               'latitude': byProfile(lat),
+               'pressure': byDepth(depths_retained),
+               'dynamic_height': wide['dynamic_height'],
+               'temperature': wide['temperature'],
+               'temperature_standardized': wide['temperature_standardized'],
+               'salinity': wide['salinity'],
+               'time': byProfile(varTime),
+               'class': byProfile(labels),
+               'posterior_probability': byProfile(posterior),
+               'class_sorted': byProfile(labels_sorted)}
+    stats = classStatistics(columns, labels_sorted, n_comp, quantiles)
+    for column in stats:
+        fname = address + 'Results/' + column + '_stats.csv'
+        stats[column].to_csv(fname)
+    del columns
+
+    # class mean profiles weighted by the posterior probabilities
+    # (columns in sorted class order)
+    post_prob_sorted = post_prob[:,old2new]
+    del post_prob
+    for column in ['temperature', 'temperature_standardized', 'salinity']:
+        fname = address + 'Results/' + column + '_posterior_means.csv'
+        weighted = posteriorWeightedMeans(wide[column], post_prob_sorted)
+        tmp = pd.DataFrame(weighted.T, index=pd.Index(depths_retained, name='pressure'), \
+                           columns=np.arange(n_comp))
+        tmp.to_csv(fname)
+    del post_prob_sorted
 
-    # surface only
-    surfaceDF = allDF[allDF.pressure == 15]
-    surfaceDFg = surfaceDF.groupby(['class'])
+    # the long data frame (one row per profile and depth, depth varying
+    # fastest) is only built to be stored, directly in the compact schema;
+    # each (profile, depth) array is released once it has been copied in
+    print('ClassProperties.main(): creating data frame')
+    allDF = pd.DataFrame({
+        'profile_index': np.repeat(np.arange(numberOfProfiles, dtype=np.int32), \
+                                   numberOfDepths),
+        'depth_index': np.tile(np.arange(numberOfDepths, dtype=np.int16), \
+                               numberOfProfiles),
+        'longitude': np.repeat(lon.astype(np.float32), numberOfDepths),
+        'latitude': np.repeat(lat.astype(np.float32), numberOfDepths),
+        'pressure': pd.Categorical.from_codes(np.tile(np.arange(numberOfDepths), \
+                      numberOfProfiles), categories=depths_retained)}, \
+        index=pd.Index(np.repeat(profile_id, numberOfDepths), name='profile_id'))
+    for column in ['dynamic_height', 'temperature', 'temperature_standardized', \
+                   'salinity']:
+        allDF[column] = wide.pop(column).astype(np.float32).ravel()
+    allDF['time'] = np.repeat(varTime, numberOfDepths)
+    allDF['class'] = np.repeat(labels, numberOfDepths)
+    allDF['posterior_probability'] = np.repeat(posterior.astype(np.float32), \
+                                               numberOfDepths)
+    allDF['class_sorted'] = np.repeat(labels_sorted, numberOfDepths)
+    applySchema(allDF)
 
-    # sea surface properties
-    T_means = allDF.groupby(['class'])['temperature'].mean()
-    SST_means = surfaceDFg['temperature'].mean()
-    SST_medians = surfaceDFg['temperature'].median()
+    # save allDF pickle object for later use
+    print('ClassProperties.main(): pickling data frame')
+    allDF.to_pickle(frame_store, compression='infer')
 
-    # sort by temperature (these are the new class numbers)
-    old2new = np.argsort(T_means.values) 
+    # index arrays that Plot slices instead of filtering allDF
+    index = plotIndex(allDF, n_comp)
+    with open(address + 'Objects/AllProfiles_index.pkl', 'wb') as f:
+        pickle.dump(index, f)
 
+def printOld2new(address, old2new, n_comp):
     # construct dictionary to replace old class numbers with new ones
     di = dict(zip(old2new,range(0,n_comp)))
 
@@ -115,21 +182,506 @@ def main(address, runIndex, n_comp):
     pickle.dump(di,f)
     f.close()
 
-    # add sorted class numbers as a new column
-    allDF['class_sorted']=allDF['class'].map(di)
+def joinProfiles(table_id, profile_id, name):
+    # rows of a table (ids table_id) in the profile order of profile_id;
+    # every profile must be present
+    rows = Print.joinRows(table_id, profile_id)
+    if np.any(rows < 0):
+        raise ValueError("ClassProperties: "+str(np.sum(rows < 0))+\
+                         " labelled profiles are missing from "+name)
+    return rows
 
-    # save allDF pickle object for later use
-    print('ClassProperties.main(): pickling data frame')
-    allDF.to_pickle(frame_store, compression='infer')
+#######################################################################
 
-    # write some summaries to csv
-    print('ClassProperties.main(): writing summaries')
-    allDFgrouped = allDF.groupby('class_sorted')
-    for column in allDF:
-        fname = address + 'Results/' + column + '_stats.csv'
-        tmp = allDFgrouped[column].describe()
-        tmp.to_csv(fname)
+def parameterOrder(address, runIndex):
+    """ Class order (old2new) by the depth-mean temperature of each GMM
+    class mean, back-projected from PCA space through the PCA and scaling
+    objects. Needs no profile data and does not depend on which profiles
+    the classes were assigned """
+    pca, stand, col_reduced, depth = Reconstruct.loadObjects(address, runIndex)
+    gmm = None
+    with open(address+'Objects/GMM_Object.pkl', 'rb') as input:
+        gmm = pickle.load(input)
+    W_centred, b_centred, W, b = Reconstruct.inverseTransform(pca, stand)
+    T_class = gmm.means_.dot(W) + b      # (class, depth) uncentred means
+    return np.argsort(T_class.mean(axis=1))
+
+#######################################################################
+
+# column types of the AllProfiles data frame; pressure is stored as a
+# categorical (a lookup table of the depth levels plus one small code per
+# row). time stays float64: float32 would round day numbers to ~1 hour
+schema = {'profile_index': 'int32',
+          'depth_index': 'int16',
+          'class': 'uint8',
+          'class_sorted': 'uint8',
+          'longitude': 'float32',
+          'latitude': 'float32',
+          'dynamic_height': 'float32',
+          'temperature': 'float32',
+          'temperature_standardized': 'float32',
+          'salinity': 'float32',
+          'time': 'float64',
+          'posterior_probability': 'float32'}
+
+def applySchema(allDF):
+    """ Convert the AllProfiles data frame (in place) to the compact column
+    types in schema. Frames that already follow it are left as they are """
+    for column, dtype in schema.items():
+        if column not in allDF:
+            continue
+        if dtype == 'uint8' and allDF[column].max() > 255:
+            dtype = 'uint16'
+        if allDF[column].dtype != dtype:
+            allDF[column] = allDF[column].astype(dtype)
+    if 'pressure' in allDF and not isinstance(allDF['pressure'].dtype, pd.CategoricalDtype):
+        allDF['pressure'] = pd.Categorical(allDF['pressure'])
+    return allDF
+
+def readAllProfiles(address):
+    print("ClassProperties.readAllProfiles")
+    # read the AllProfiles data frame (indexed by profile_id), converting
+    # older pickles to the schema
+    frame_store = address + 'Objects/AllProfiles.pkl'
+    if not os.path.isfile(frame_store):
+        raise FileNotFoundError("ClassProperties.readAllProfiles: no "+frame_store+\
+              ", run ClassProperties.main with streamed=False first")
+    allDF = pd.read_pickle(frame_store, compression='infer')
+    if 'profile_id' in allDF:
+        allDF = allDF.set_index('profile_id')
+    return applySchema(allDF)
+
+#######################################################################
+
+# posterior thresholds with precomputed profile lists, and the upper edges
+# of the posterior buckets counted in each class
+index_thresholds = [0.5, 0.75, 0.9]
+bucket_edges = [0.5, 0.75, 0.9, 1.0]
+
+def plotIndex(allDF, n_comp):
+    """ Index arrays for selecting from allDF by slicing rather than by
+    boolean filters over the whole table. allDF has one row per profile and
+    depth (depth varying fastest), so the row of profile p at depth level d
+    is p*n_depths + d (see profileRows) and the index is per profile:
+      class_order, class_offsets: profiles sorted by class_sorted (stable),
+          class k is class_order[class_offsets[k]:class_offsets[k+1]]
+      threshold_profiles[t]: profiles with posterior_probability >= t
+      bucket_counts: (class, bucket) number of profiles with posterior in
+          each bucket (upper edges bucket_edges) """
+    n_depths = int(allDF['depth_index'].max()) + 1
+    n_profiles = len(allDF) // n_depths
+    classes = np.asarray(allDF['class_sorted'].values[::n_depths], dtype=np.int64)
+    posterior = allDF['posterior_probability'].values[::n_depths]
+
+    counts = np.bincount(classes, minlength=n_comp)
+    n_bucket = len(bucket_edges)
+    bucket = np.searchsorted(bucket_edges, posterior, side='left')
+    bucket_counts = np.bincount(classes*(n_bucket + 1) + bucket, \
+                                minlength=n_comp*(n_bucket + 1))
+    bucket_counts = bucket_counts.reshape(n_comp, n_bucket + 1)[:,:n_bucket]
+
+    index = {'n_profiles': n_profiles,
+             'n_depths': n_depths,
+             'depths': np.asarray(allDF['pressure'].values[:n_depths], dtype=float),
+             'posterior': posterior,
+             'class_order': np.argsort(classes, kind='stable'),
+             'class_offsets': np.concatenate(([0], np.cumsum(counts))),
+             'threshold_profiles': {t: np.flatnonzero(posterior >= t) \
+                                    for t in index_thresholds},
+             'bucket_counts': bucket_counts}
+    return index
+
+def readPlotIndex(address, allDF, n_comp):
+    print("ClassProperties.readPlotIndex")
+    # read the index written by main(), or build it when it is missing or
+    # does not match allDF (frames from before the index existed)
+    fname = address + 'Objects/AllProfiles_index.pkl'
+    index = None
+    if os.path.isfile(fname):
+        with open(fname, 'rb') as f:
+            index = pickle.load(f)
+    if index is None or index['n_profiles']*index['n_depths'] != len(allDF) \
+      or len(index['class_offsets']) != n_comp + 1:
+        index = plotIndex(allDF, n_comp)
+    return index
+
+def profileRows(index, profiles, depth_index=0):
+    """ allDF rows of the given profiles at one (or several) depth levels """
+    depth_index = np.atleast_1d(depth_index)
+    profiles = np.asarray(profiles, dtype=np.int64)
+    return (profiles[:,None]*index['n_depths'] + depth_index[None,:]).ravel()
+
+def thresholdProfiles(index, threshold):
+    # profiles with posterior_probability >= threshold
+    if threshold in index['threshold_profiles']:
+        return index['threshold_profiles'][threshold]
+    return np.flatnonzero(index['posterior'] >= threshold)
 
 #######################################################################
 
+def classStatistics(wide, labels, n_comp, quantiles='exact', nbins=2048, \
+                    block_size=65536):
+    """ Per-class count, mean, std, min, quartiles and max of each
+    (profile, depth) array in wide, where labels gives the class of each
+    profile. Equivalent to allDF.groupby('class_sorted')[column].describe()
+    (NaNs skipped) but works on the wide arrays, a block of block_size
+    profiles at a time so no temporary is larger than a block or a class:
+    counts and sums from bincount, the std from a second pass of squared
+    deviations, quartiles exact (np.percentile over the values of one class
+    at a time) or, with quantiles='approx', from an nbins histogram per
+    class. quantiles=None leaves the quartiles out """
+    numberOfProfiles = labels.size
+    n_class = np.bincount(labels, minlength=n_comp)
+    present = np.where(n_class > 0)[0]   # groupby leaves out empty classes
+    blocks = [(start, min(start + block_size, numberOfProfiles)) \
+              for start in range(0, numberOfProfiles, block_size)]
 
+    # profiles grouped by class, for the exact quantiles
+    order = np.argsort(labels, kind='stable')
+    stops = np.cumsum(n_class)
+    starts = stops - n_class
+
+    stats = {}
+    for column, V in wide.items():
+        count, total = np.zeros(n_comp), np.zeros(n_comp)
+        minimum, maximum = np.full(n_comp, np.inf), np.full(n_comp, -np.inf)
+        for start, stop in blocks:
+            block, finite = finiteBlock(V, start, stop)
+            count += np.bincount(labels[start:stop], weights=finite.sum(axis=1), \
+                                 minlength=n_comp)
+            total += np.bincount(labels[start:stop], \
+                                 weights=np.where(finite, block, 0).sum(axis=1), \
+                                 minlength=n_comp)
+            np.minimum.at(minimum, labels[start:stop], \
+                          np.where(finite, block, np.inf).min(axis=1))
+            np.maximum.at(maximum, labels[start:stop], \
+                          np.where(finite, block, -np.inf).max(axis=1))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = total/count
+        minimum[count == 0] = np.nan
+        maximum[count == 0] = np.nan
+
+        M2 = np.zeros(n_comp)
+        for start, stop in blocks:
+            block, finite = finiteBlock(V, start, stop)
+            deviation = np.where(finite, block - mean[labels[start:stop]][:,np.newaxis], 0)
+            M2 += np.bincount(labels[start:stop], weights=(deviation**2).sum(axis=1), \
+                              minlength=n_comp)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            std = np.sqrt(M2/(count - 1))
+        std[count <= 1] = np.nan
+
+        quartiles = np.full((n_comp, 3), np.nan)
+        if quantiles == 'approx':
+            quartiles = histogramQuantiles(V, labels, n_comp, [0.25, 0.5, 0.75], \
+                                           minimum, maximum, nbins, blocks)
+        elif quantiles is not None:
+            for k in present:
+                values = np.asarray(V[order[starts[k]:stops[k]]], dtype=float).ravel()
+                values = values[~np.isnan(values)]
+                if values.size > 0:
+                    quartiles[k,:] = np.percentile(values, [25, 50, 75])
+
+        tmp = pd.DataFrame({'count': count, 'mean': mean, \
+                            'std': std, 'min': minimum, '25%': quartiles[:,0], \
+                            '50%': quartiles[:,1], '75%': quartiles[:,2], \
+                            'max': maximum}, \
+                           index=pd.Index(np.arange(n_comp), name='class_sorted'))
+        stats[column] = tmp.iloc[present]
+    return stats
+
+def finiteBlock(V, start, stop):
+    # rows start:stop of V as floats, and where they are not NaN
+    block = np.asarray(V[start:stop], dtype=float)
+    return block, ~np.isnan(block)
+
+def histogramQuantiles(V, labels, n_comp, probabilities, minimum, maximum, \
+                       nbins=2048, blocks=None):
+    # quantiles of V for each class from np.bincount histograms between the
+    # class minimum and maximum over all classes (NaNs skipped); each is
+    # within one bin, (max - min)/nbins, of an order statistic next to the
+    # exact (interpolated) quantile
+    low, high = np.nanmin(minimum), np.nanmax(maximum)
+    result = np.full((n_comp, len(probabilities)), np.nan)
+    if np.isnan(low):
+        return result
+    width = (high - low)/nbins
+    if width == 0:
+        result[~np.isnan(minimum),:] = low
+        return result
+    if blocks is None:
+        blocks = [(0, labels.size)]
+    hist = np.zeros(n_comp*nbins)
+    for start, stop in blocks:
+        block, finite = finiteBlock(V, start, stop)
+        bins = np.clip(((np.where(finite, block, low) - low)/width).astype(int), \
+                       0, nbins - 1)
+        flat = labels[start:stop][:,np.newaxis]*nbins + bins
+        hist += np.bincount(flat[finite], minlength=n_comp*nbins)
+    hist = hist.reshape(n_comp, nbins)
+    cumulative = np.cumsum(hist, axis=1)
+    for k in np.where(cumulative[:,-1] > 0)[0]:
+        for j, p in enumerate(probabilities):
+            target = p*(cumulative[k,-1] - 1)   # rank, as in linear interpolation
+            b = np.searchsorted(cumulative[k,:], target, side='right')
+            before = cumulative[k,b] - hist[k,b]
+            result[k,j] = low + (b + (target - before + 0.5)/hist[k,b])*width
+    return result
+
+def posteriorWeightedMeans(V, post_prob, block_size=65536):
+    # (class, depth) mean profiles with every profile weighted by its
+    # posterior probability of being in each class: post_prob^T.V, with
+    # NaNs left out of both the sums and the weights
+    total = np.zeros((post_prob.shape[1], V.shape[1]))
+    weight = np.zeros((post_prob.shape[1], V.shape[1]))
+    for start in range(0, V.shape[0], block_size):
+        block, finite = finiteBlock(V, start, start + block_size)
+        total += post_prob[start:start+block_size].T.dot(np.where(finite, block, 0))
+        weight += post_prob[start:start+block_size].T.dot(finite)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return total/weight
+
+#######################################################################
+
+#######################################################################
+# streaming per-(class, depth) statistics with mergeable accumulators
+
+# variables accumulated (columns 3-5 of the CentredAndUncentred files)
+stream_columns = ['temperature', 'temperature_standardized', 'salinity']
+
+def newAccumulator(n_comp, n_depth, low, high, nbins=1024):
+    """ Empty running statistics for each (class, depth): count, mean, M2
+    (sum of squared deviations, Welford), min, max, the posterior-weighted
+    sum and weight (soft class means), and a histogram with nbins bins
+    between low and high for quantiles. low and high are the same at every
+    depth, so histograms also merge across depths. NaNs are skipped """
+    acc = {}
+    acc['count'] = np.zeros((n_comp, n_depth))
+    acc['mean'] = np.zeros((n_comp, n_depth))
+    acc['M2'] = np.zeros((n_comp, n_depth))
+    acc['min'] = np.full((n_comp, n_depth), np.inf)
+    acc['max'] = np.full((n_comp, n_depth), -np.inf)
+    acc['weighted_sum'] = np.zeros((n_comp, n_depth))
+    acc['weight'] = np.zeros((n_comp, n_depth))
+    acc['hist'] = np.zeros((n_comp, n_depth, nbins))
+    acc['low'] = float(low)
+    acc['high'] = float(high)
+    return acc
+
+def chunkAccumulator(V, labels, post_prob, n_comp, low, high, nbins=1024):
+    # accumulator of one (profile, depth) chunk, labels = class of each
+    # profile, post_prob = (profile, class) posterior probabilities
+    n_profiles, n_depth = V.shape
+    acc = newAccumulator(n_comp, n_depth, low, high, nbins)
+    finite = ~np.isnan(V)
+    V0 = np.where(finite, V, 0)
+    onehot = np.zeros((n_profiles, n_comp))
+    onehot[np.arange(n_profiles), labels] = 1
+    acc['count'] = onehot.T.dot(finite)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        acc['mean'] = np.nan_to_num(onehot.T.dot(V0)/acc['count'])
+    acc['M2'] = onehot.T.dot(np.where(finite, V - acc['mean'][labels], 0)**2)
+    np.minimum.at(acc['min'], labels, np.where(finite, V, np.inf))
+    np.maximum.at(acc['max'], labels, np.where(finite, V, -np.inf))
+    acc['weighted_sum'] = post_prob.T.dot(V0)
+    acc['weight'] = post_prob.T.dot(finite)
+
+    width = max(acc['high'] - acc['low'], 1e-12)/nbins
+    bins = np.clip(((V0 - acc['low'])/width).astype(int), 0, nbins - 1)
+    flat = (labels[:,np.newaxis]*n_depth + np.arange(n_depth))*nbins + bins
+    acc['hist'] = np.bincount(flat[finite], minlength=n_comp*n_depth*nbins)\
+                    .reshape(n_comp, n_depth, nbins).astype(float)
+    return acc
+
+def mergeAccumulators(a, b):
+    """ Combine two accumulators (e.g. from two chunks or two workers) with
+    the pairwise update of Chan et al.; both must share low, high, nbins """
+    acc = dict(a)
+    count = a['count'] + b['count']
+    with np.errstate(invalid='ignore', divide='ignore'):
+        delta = b['mean'] - a['mean']
+        acc['mean'] = np.where(count > 0, a['mean'] + delta*b['count']/count, 0)
+        acc['M2'] = np.where(count > 0, \
+                    a['M2'] + b['M2'] + delta**2*a['count']*b['count']/count, 0)
+    acc['count'] = count
+    acc['min'] = np.minimum(a['min'], b['min'])
+    acc['max'] = np.maximum(a['max'], b['max'])
+    for key in ['weighted_sum', 'weight', 'hist']:
+        acc[key] = a[key] + b[key]
+    return acc
+
+def mergeDepths(acc):
+    # accumulator of each class over all depths (a single depth column)
+    merged = {key: value[:,:1] for key, value in acc.items() \
+              if key not in ['low', 'high']}
+    merged['low'], merged['high'] = acc['low'], acc['high']
+    for d in range(1, acc['count'].shape[1]):
+        depth = {key: value[:,d:d+1] for key, value in acc.items() \
+                 if key not in ['low', 'high']}
+        merged = mergeAccumulators(merged, depth)
+    return merged
+
+def sortAccumulator(acc, old2new):
+    # accumulator with its class axis in the sorted class order
+    return {key: (value if key in ['low', 'high'] else value[old2new]) \
+            for key, value in acc.items()}
+
+def accumulatorQuantiles(acc, probabilities):
+    # (class, depth, probability) quantiles from the histograms, linear
+    # within a bin and limited to the exact min/max
+    nbins = acc['hist'].shape[2]
+    width = max(acc['high'] - acc['low'], 1e-12)/nbins
+    cumulative = np.cumsum(acc['hist'], axis=2)
+    result = np.full(acc['count'].shape + (len(probabilities),), np.nan)
+    for j, p in enumerate(probabilities):
+        target = p*acc['count']
+        b = np.minimum(np.sum(cumulative < target[:,:,np.newaxis], axis=2), nbins - 1)
+        in_bin = np.take_along_axis(acc['hist'], b[:,:,np.newaxis], axis=2)[:,:,0]
+        before = np.take_along_axis(cumulative, b[:,:,np.newaxis], axis=2)[:,:,0] - in_bin
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fraction = np.where(in_bin > 0, (target - before)/in_bin, 0.5)
+        value = acc['low'] + (b + fraction)*width
+        result[:,:,j] = np.clip(value, acc['min'], acc['max'])
+    result[acc['count'] == 0] = np.nan
+    return result
+
+def accumulatorTable(acc, depths):
+    # long table (class_sorted, pressure) with the describe() columns
+    n_comp, n_depth = acc['count'].shape
+    quartiles = accumulatorQuantiles(acc, [0.25, 0.5, 0.75])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        std = np.sqrt(acc['M2']/(acc['count'] - 1))
+        mean = np.where(acc['count'] > 0, acc['mean'], np.nan)
+    std[acc['count'] <= 1] = np.nan
+    minimum = np.where(acc['count'] > 0, acc['min'], np.nan)
+    maximum = np.where(acc['count'] > 0, acc['max'], np.nan)
+    table = pd.DataFrame({'class_sorted': np.repeat(np.arange(n_comp), n_depth),
+                          'pressure': np.tile(depths, n_comp),
+                          'count': acc['count'].ravel(),
+                          'mean': mean.ravel(),
+                          'std': std.ravel(),
+                          'min': minimum.ravel(),
+                          '25%': quartiles[:,:,0].ravel(),
+                          '50%': quartiles[:,:,1].ravel(),
+                          '75%': quartiles[:,:,2].ravel(),
+                          'max': maximum.ravel()})
+    return table
+
+def dataRanges(address, runIndex, depths, chunk_size=10000):
+    """ (low, high) of each streamed variable: written by Load.main, or for
+    older runs from a NaN-aware pre-pass over the CentredAndUncentred files
+    (so no value falls outside the histograms) """
+    ranges = Print.readDataRanges(address, runIndex)
+    if ranges is not None:
+        return ranges
+    print("ClassProperties.dataRanges: no stored ranges, reading the data")
+    low = dict((column, np.inf) for column in stream_columns)
+    high = dict((column, -np.inf) for column in stream_columns)
+    for chunk in Print.readLoadFromFile_chunks(address, runIndex, depths, chunk_size):
+        for column, V in zip(stream_columns, chunk[3:6]):
+            low[column] = np.fmin(low[column], np.nanmin(V, initial=np.inf))
+            high[column] = np.fmax(high[column], np.nanmax(V, initial=-np.inf))
+    return dict((column, (low[column], high[column])) for column in stream_columns)
+
+# settings of the worker processes
+worker_state = {}
+
+def streamWorkerInit(n_comp, ranges, nbins):
+    worker_state['n_comp'] = n_comp
+    worker_state['ranges'] = ranges
+    worker_state['nbins'] = nbins
+
+def streamWorkerChunk(chunk):
+    # accumulators of every variable for one chunk of profiles
+    labels, post_prob, variables = chunk
+    accs = {}
+    for column in variables:
+        low, high = worker_state['ranges'][column]
+        accs[column] = chunkAccumulator(variables[column], labels, post_prob, \
+                          worker_state['n_comp'], low, high, worker_state['nbins'])
+    return accs
+
+def accumulateStatistics(address, runIndex, n_comp, labels, post_prob, \
+                         chunk_size=10000, n_workers=1, nbins=1024):
+    print("ClassProperties.accumulateStatistics")
+    """ Per-(class, depth) statistics of temperature, standardised
+    temperature and salinity, called by GMM.apply as soon as the labels and
+    posterior probabilities (in the row order of the stored profile ids)
+    exist. The CentredAndUncentred files are read a chunk of profiles at a
+    time, joined to the labels on profile id, so memory depends only on
+    chunk_size and the numbers of classes and depths. Chunk accumulators
+    are merged as they arrive (from a process pool when n_workers > 1).
+    The result, in GMM class numbering, is pickled to
+    Objects/ClassStatistics.pkl, which main(..., streamed=True) reads
+    instead of the profiles """
+    depths = Print.readDepth(address, runIndex)
+    ranges = dataRanges(address, runIndex, depths, chunk_size)
+    row_of_id = Print.profileIndex(Print.profileIds(address, runIndex, labels.size))
+    labels = labels.astype(int)
+
+    def chunks():
+        for lon, lat, dynHeight, Tint_array, X_array, Sint_array, varTime, \
+          profile_id in Print.readLoadFromFile_chunks(address, runIndex, depths, \
+                                                      chunk_size):
+            rows = row_of_id[profile_id]
+            yield labels[rows], post_prob[rows], {'temperature': Tint_array, \
+                  'temperature_standardized': X_array, 'salinity': Sint_array}
+
+    totals = None
+    if n_workers == 1:
+        streamWorkerInit(n_comp, ranges, nbins)
+        for accs in map(streamWorkerChunk, chunks()):
+            totals = accs if totals is None else \
+                     {c: mergeAccumulators(totals[c], accs[c]) for c in accs}
+    else:
+        pool = Parallel.makePool(n_workers, 1, streamWorkerInit, (n_comp, ranges, nbins))
+        try:
+            for accs in pool.imap_unordered(streamWorkerChunk, chunks()):
+                totals = accs if totals is None else \
+                         {c: mergeAccumulators(totals[c], accs[c]) for c in accs}
+        finally:
+            pool.close()
+            pool.join()
+
+    with open(address + 'Objects/ClassStatistics.pkl', 'wb') as f:
+        pickle.dump({'depths': depths, 'statistics': totals}, f)
+    return totals
+
+def mainStreamed(address, runIndex, n_comp, ordering='parameters'):
+    print("ClassProperties.mainStreamed()")
+    """ main() from the accumulators of accumulateStatistics instead of the
+    profiles: class order, *_stats.csv (per class over all depths),
+    *_class_depth_stats.csv and *_posterior_means.csv of temperature,
+    standardised temperature and salinity. Quartiles come from the
+    histograms. No AllProfiles data frame is written """
+    with open(address + 'Objects/ClassStatistics.pkl', 'rb') as f:
+        stored = pickle.load(f)
+    depths, totals = stored['depths'], stored['statistics']
+
+    # sort by temperature (these are the new class numbers), either of the
+    # GMM class means or of the profiles assigned to each class
+    if ordering == 'data':
+        merged = mergeDepths(totals['temperature'])
+        T_means = np.where(merged['count'][:,0] > 0, merged['mean'][:,0], np.nan)
+        old2new = np.argsort(T_means)
+    else:
+        old2new = parameterOrder(address, runIndex)
+    printOld2new(address, old2new, n_comp)
+
+    for column in totals:
+        acc = sortAccumulator(totals[column], old2new)
+        fname = address + 'Results/' + column + '_class_depth_stats.csv'
+        table = accumulatorTable(acc, depths)
+        table[table['count'] > 0].to_csv(fname, index=False)
+
+        fname = address + 'Results/' + column + '_stats.csv'
+        table = accumulatorTable(mergeDepths(acc), [0]).drop(columns='pressure')
+        table = table.set_index('class_sorted')
+        table[table['count'] > 0].to_csv(fname)
+
+        fname = address + 'Results/' + column + '_posterior_means.csv'
+        with np.errstate(invalid='ignore', divide='ignore'):
+            weighted = acc['weighted_sum']/acc['weight']
+        tmp = pd.DataFrame(weighted.T, index=pd.Index(depths, name='pressure'), \
+                           columns=np.arange(n_comp))
+        tmp.to_csv(fname)
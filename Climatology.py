@@ -0,0 +1,206 @@
+"""
+Climatology.py
+
+Purpose:
+    Gridded climatology products of the classification: per-class
+    occurrence frequency, dominant class and mean (maximum) posterior
+    probability on a regular lat/lon grid, optionally per month or season
+
+Input:
+    address = root location
+    n_comp = number of classes/components in GMM
+    grid = cell size in degrees
+    time_mode = None (all profiles), 'month' or 'season'
+Output:
+    - Results/Climatology[_month|_season].h5 (or .nc), gzip compressed
+
+Reads the labels and posterior probabilities written by GMM.apply (not the
+AllProfiles data frame). Classes are numbered as in the plots when
+ClassProperties has written Results/old2new.pkl, otherwise as in the GMM.
+"""
+
+# import relevant modules
+import os
+import pickle
+import numpy as np
+import h5py
+import Print
+
+# netCDF output is optional (HDF5 is written with h5py)
+try:
+    import netCDF4
+except ImportError:
+    netCDF4 = None
+
+# season of each month (DJF, MAM, JJA, SON)
+season_names = ['DJF', 'MAM', 'JJA', 'SON']
+season_of_month = np.array([0, 0, 1, 1, 1, 2, 2, 2, 3, 3, 3, 0])
+
+def main(address, runIndex, n_comp, grid=1.0, time_mode=None, file_format='hdf5'):
+    print("Climatology.main")
+
+    # labels and posterior probabilities of every profile
+    lon, lat, varTime, labels, post_prob = readClassification(address, runIndex, n_comp)
+
+    # accumulate the gridded products
+    products = gridProducts(lon, lat, varTime, labels, post_prob, n_comp, grid, \
+                            time_mode)
+
+    # write them
+    filename = address + 'Results/Climatology'
+    if time_mode is not None:
+        filename = filename + '_' + time_mode
+    if file_format == 'netcdf':
+        printClimatologyNetCDF(filename + '.nc', products, grid, time_mode)
+    else:
+        printClimatologyHDF5(filename + '.h5', products, grid, time_mode)
+    return products
+
+#######################################################################
+
+def readClassification(address, runIndex, n_comp):
+    # labels and posterior probabilities in the sorted class numbering
+    lon, lat, dynHeight, varTime, labels = Print.readLabelsUnsorted(address, runIndex)
+    lon_pp, lat_pp, dynHeight_pp, varTime_pp, post_prob = \
+        Print.readPosteriorProb(address, runIndex, np.arange(n_comp))
+
+    # new class number of each GMM class (GMM numbering if not yet sorted)
+    new_of_old = np.arange(n_comp)
+    fname = address + 'Results/old2new.pkl'
+    if os.path.isfile(fname):
+        with open(fname, 'rb') as f:
+            di = pickle.load(f)
+        for old, new in di.items():
+            new_of_old[old] = new
+    labels = new_of_old[labels.astype(int)]
+    post_prob = post_prob[:,np.argsort(new_of_old)]
+    return lon, lat, varTime, labels, post_prob
+
+def timeIndex(varTime, time_mode):
+    """ Month (0-11) or season (0-3, see season_names) of each profile from
+    its decimal year, or all zeros when time_mode is None. Returns the
+    indices and the number of time slots """
+    if time_mode is None:
+        return np.zeros(varTime.size, dtype=np.int64), 1
+    month = np.clip(np.floor((varTime % 1.0)*12).astype(np.int64), 0, 11)
+    if time_mode == 'month':
+        return month, 12
+    if time_mode == 'season':
+        return season_of_month[month], 4
+    raise ValueError("Climatology: time_mode must be None, 'month' or 'season'")
+
+def gridProducts(lon, lat, varTime, labels, post_prob, n_comp, grid, time_mode=None):
+    """ Gridded products on (time, lat, lon[, class]), from one bincount over
+    the flattened (time, lat, lon, class) index of every profile. Latitude
+    cells cover the data, longitude cells the globe. Returns a dictionary
+    of name: (dimensions, array), coordinates included. Empty cells have
+    NaN means, zero counts and dominant_class -1 """
+    t_index, n_time = timeIndex(varTime, time_mode)
+    lat_start = np.floor(np.min(lat)/grid)*grid
+    n_lat = max(int(np.ceil((np.max(lat) - lat_start)/grid)), 1)
+    n_lon = int(round(360.0/grid))
+    i_lat = np.clip(np.floor((lat - lat_start)/grid).astype(np.int64), 0, n_lat-1)
+    i_lon = np.clip(np.floor((lon + 180.0)/grid).astype(np.int64), 0, n_lon-1)
+    cell = (t_index*n_lat + i_lat)*n_lon + i_lon
+    n_cell = n_time*n_lat*n_lon
+    shape = (n_time, n_lat, n_lon)
+
+    # number of profiles of each class in each cell
+    class_count = np.bincount(cell*n_comp + labels.astype(np.int64), \
+                              minlength=n_cell*n_comp).reshape(n_cell, n_comp)
+    n_profiles = class_count.sum(axis=1)
+    empty = n_profiles == 0
+    n_safe = np.maximum(n_profiles, 1)
+
+    occurrence = (class_count/n_safe[:,None]).astype(np.float32)
+    occurrence[empty,:] = np.nan
+    dominant_class = np.argmax(class_count, axis=1).astype(np.int16)
+    dominant_class[empty] = -1
+
+    # posterior statistics (one bincount per class)
+    mean_max_posterior = (np.bincount(cell, weights=np.max(post_prob, axis=1), \
+                          minlength=n_cell)/n_safe).astype(np.float32)
+    mean_max_posterior[empty] = np.nan
+    mean_posterior = np.empty((n_cell, n_comp), dtype=np.float32)
+    for k in range(n_comp):
+        mean_posterior[:,k] = np.bincount(cell, weights=post_prob[:,k], \
+                                          minlength=n_cell)/n_safe
+    mean_posterior[empty,:] = np.nan
+
+    products = {
+        'time': (('time',), np.arange(n_time, dtype=np.int32)),
+        'lat': (('lat',), lat_start + grid*(np.arange(n_lat) + 0.5)),
+        'lon': (('lon',), -180.0 + grid*(np.arange(n_lon) + 0.5)),
+        'class': (('class',), np.arange(n_comp, dtype=np.int32)),
+        'n_profiles': (('time','lat','lon'), n_profiles.reshape(shape).astype(np.int32)),
+        'class_count': (('time','lat','lon','class'), \
+                        class_count.reshape(shape + (n_comp,)).astype(np.int32)),
+        'occurrence': (('time','lat','lon','class'), occurrence.reshape(shape + (n_comp,))),
+        'dominant_class': (('time','lat','lon'), dominant_class.reshape(shape)),
+        'mean_max_posterior': (('time','lat','lon'), mean_max_posterior.reshape(shape)),
+        'mean_posterior': (('time','lat','lon','class'), \
+                           mean_posterior.reshape(shape + (n_comp,)))}
+    return products
+
+#######################################################################
+
+# what each variable holds (written as attributes)
+descriptions = {
+    'time': 'time slot: 0 = all profiles, month 0-11 or season (see seasons)',
+    'lat': 'latitude of the cell centre (degrees north)',
+    'lon': 'longitude of the cell centre (degrees east)',
+    'class': 'class number (sorted classes, as in the plots minus one)',
+    'n_profiles': 'number of profiles in the cell',
+    'class_count': 'number of profiles of each class in the cell',
+    'occurrence': 'fraction of the profiles in the cell in each class',
+    'dominant_class': 'most common class in the cell (-1 = no profiles)',
+    'mean_max_posterior': 'mean maximum posterior probability in the cell',
+    'mean_posterior': 'mean posterior probability of each class in the cell'}
+
+def printClimatologyHDF5(filename, products, grid, time_mode, compression=4):
+    print("Climatology.printClimatologyHDF5 "+filename)
+    # gzip-compressed datasets, coordinates attached as dimension scales
+    with h5py.File(filename, 'w') as f:
+        for name, (dims, value) in products.items():
+            if len(dims) == 1:
+                f.create_dataset(name, data=value)
+                f[name].make_scale(name)
+            else:
+                f.create_dataset(name, data=value, compression='gzip', \
+                                 compression_opts=compression, shuffle=True)
+            f[name].attrs['description'] = descriptions[name]
+        for name, (dims, value) in products.items():
+            if len(dims) > 1:
+                for i, dim in enumerate(dims):
+                    f[name].dims[i].attach_scale(f[dim])
+                    f[name].dims[i].label = dim
+        f.attrs['grid'] = grid
+        f.attrs['time_mode'] = str(time_mode)
+        if time_mode == 'season':
+            f.attrs['seasons'] = ','.join(season_names)
+
+def printClimatologyNetCDF(filename, products, grid, time_mode, compression=4):
+    print("Climatology.printClimatologyNetCDF "+filename)
+    if netCDF4 is None:
+        raise RuntimeError("Climatology: netCDF output needs the netCDF4 "+\
+                           "package, use file_format = 'hdf5'")
+    dataset = netCDF4.Dataset(filename, 'w')
+    try:
+        for name, (dims, value) in products.items():
+            if len(dims) == 1:
+                dataset.createDimension(name, value.size)
+        for name, (dims, value) in products.items():
+            fill_value = None
+            if value.dtype.kind == 'f':
+                fill_value = np.nan
+            variable = dataset.createVariable(name, value.dtype, dims, \
+                         zlib=(len(dims) > 1), complevel=compression, \
+                         shuffle=True, fill_value=fill_value)
+            variable[:] = value
+            variable.description = descriptions[name]
+        dataset.grid = grid
+        dataset.time_mode = str(time_mode)
+        if time_mode == 'season':
+            dataset.seasons = ','.join(season_names)
+    finally:
+        dataset.close()
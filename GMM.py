@@ -13,17 +13,28 @@ Purpose:
     
 """
 import pickle
+import warnings
 from sklearn import mixture
+from sklearn.exceptions import ConvergenceWarning
+from scipy import linalg
 import numpy as np
 import time
 import ClassProperties
+import Parallel
 import Print
 
-start_time = time.clock()
+start_time = time.perf_counter()
 
-def create(address, runIndex, n_comp, cov_type):
+def create(address, runIndex, n_comp, cov_type, gmm_mode='batch', \
+           chunk_size=10000, n_passes=1, decay=0.6, weight_threshold=0.01, \
+           callback=None, telemetry=False):
     print("GMM.create")
-    """ Takes the training dataset and creates the GMM object """
+    """ Takes the training dataset and creates the GMM object. In 'bayesian'
+    mode n_comp is an upper bound; the number of classes actually kept is
+    returned, and written by Print.printNcomp. A summary of each fit is
+    written to Results/GMM_fit_summary.csv, and with telemetry (or a
+    callback) one row per EM iteration to Results/GMM_fit_log.csv (see
+    fitWithTelemetry) """
     # load col_reduced
     col_reduced = None
     col_reduced = Print.readColreduced(address, runIndex)
@@ -36,19 +47,49 @@ def create(address, runIndex, n_comp, cov_type):
       Print.readPCAFromFile_Train(address, runIndex, col_reduced)
     
     # calculate GMM Object
-    gmm, gmm_weights, gmm_means, gmm_covariances = \
-      None, None, None, None
-    gmm, gmm_weights, gmm_means, gmm_covariances = \
-      GaussianMixtureModel(address, runIndex, n_comp, X_train_array, cov_type)
+    gmm, gmm_weights, gmm_means, gmm_covariances, fit_logs = \
+      None, None, None, None, None
+    if gmm_mode == 'minibatch':
+        # online EM over the full PC-score store (needs PCA.apply first)
+        gmm, gmm_weights, gmm_means, gmm_covariances, fit_logs = \
+          MiniBatchGaussianMixtureModel(address, runIndex, n_comp, \
+                                        col_reduced, X_train_array, cov_type, \
+                                        chunk_size, n_passes, decay, \
+                                        callback=callback, telemetry=telemetry)
+    elif gmm_mode == 'bayesian':
+        # variational fit with unused components pruned
+        gmm, gmm_weights, gmm_means, gmm_covariances, fit_logs = \
+          BayesianGaussianMixtureModel(address, runIndex, n_comp, \
+                                       X_train_array, cov_type, weight_threshold, \
+                                       callback, telemetry)
+    else:
+        gmm, gmm_weights, gmm_means, gmm_covariances, fit_logs = \
+          GaussianMixtureModel(address, runIndex, n_comp, X_train_array, \
+                               cov_type, callback, telemetry)
+
+    # convergence telemetry
+    Print.printFitLog(address, runIndex, 'GMM', fit_logs)
     
+    # number of classes in the fitted model
+    n_comp = gmm.n_components
+    Print.printNcomp(address, runIndex, n_comp)
+
     """ Print the information on the classes to a file """
+    # per-PC variance of each class, whatever the covariance type
+    gmm_covariances = componentVariances(gmm)
     class_number_array = np.arange(0,n_comp).reshape(-1,1)
     Print.printGMMclasses(address, runIndex, class_number_array, gmm_weights, \
                           gmm_means, gmm_covariances, col_reduced_array, 'reduced')
+
+    return n_comp
     
 ###############################################################################
-def apply(address, runIndex, n_comp):
+def apply(address, runIndex, n_comp, chunk_size=10000, n_workers=1, \
+          stream_stats=False):
     print("GMM.apply")
+    """ Labels and posterior probabilities of every profile. stream_stats
+    also accumulates the per-(class, depth) statistics from them here (see
+    ClassProperties.accumulateStatistics) """
     # load col_reduced value
     col_reduced = None
     col_reduced = Print.readColreduced(address, runIndex)
@@ -66,8 +107,18 @@ def apply(address, runIndex, n_comp):
     # calculate the labels and probabilities of the profiles
     sortedLabels, labels, post_prob = None, None, None
 
-    # predict classes based on training dataset, output labels
-    labels = gmm.predict(X_array)  # expected shape (n_profiles, pca index)
+    # labels, posteriors and log-likelihoods from one pass over X_array
+    if n_workers == 1:
+        kernel = inferenceKernel(gmm)
+        labels, post_prob, post_max, log_lik = \
+          scoreProfiles(kernel, X_array, chunk_size)
+    else:
+        labels, post_prob, post_max, log_lik = \
+          scoreProfilesParallel(address+'Objects/GMM_Object.pkl', X_array, \
+                                gmm.n_components, chunk_size, n_workers)
+    print("GMM.apply mean log-likelihood = ", np.mean(log_lik))
+
+    # output labels
     Print.printLabelsUnsorted(address, runIndex, lon, lat, dynHeight, varTime, labels)
 
     # sort labels by mean SST of each class
@@ -75,26 +126,27 @@ def apply(address, runIndex, n_comp):
 #   allDF, sortedLabels, old2new = ClassProperties.main(address,runIndex,n_comp) 
 #   Print.printLabels(address, runIndex, lon, lat, dynHeight, varTime, sortedLabels)
    
-    # calculate posterior probabilities
-    post_prob = gmm.predict_proba(X_array) # expected shape (n_profiles, classes)
-
     # needed for input of printPosteriorProb
     class_number_array = np.arange(0,n_comp).reshape(-1,1)
     
     # Print Labels and probabilities to file
     Print.printPosteriorProb(address, runIndex, lon, lat, dynHeight, \
                              varTime, post_prob, class_number_array)
+
+    # class statistics while the labels are in memory
+    if stream_stats:
+        ClassProperties.accumulateStatistics(address, runIndex, n_comp, labels, \
+                                             post_prob, chunk_size, n_workers)
     
-def GaussianMixtureModel(address, runIndex, n_comp, X_train, cov_type):
+def GaussianMixtureModel(address, runIndex, n_comp, X_train, cov_type, \
+                         callback=None, telemetry=False):
     print("GMM.GaussianMixtureModel")
     gmm = None
     gmm = mixture.GaussianMixture(n_components = n_comp, \
                                   covariance_type = cov_type)
-#    gmm = mixture.BayesianGaussianMixture(n_components = n_comp, \
-#                                          covariance_type = cov_type)
 
     # use training dataset to "fit" Gaussian mixture model
-    gmm.fit(X_train)
+    fit_log = fitWithTelemetry(gmm, X_train, 'batch', callback, telemetry)
     
     # store the GMM object
     gmm_store = address+"Objects/GMM_Object.pkl"
@@ -110,6 +162,528 @@ def GaussianMixtureModel(address, runIndex, n_comp, X_train, cov_type):
     means = np.squeeze(gmm.means_)  # shape (n_components, n_features)
     covariances = abs(np.squeeze(gmm.covariances_))  # shape (n_components, n_features) 
     
-    return gmm, weights, means, covariances
+    return gmm, weights, means, covariances, [fit_log]
+
+###############################################################################
+def BayesianGaussianMixtureModel(address, runIndex, n_comp_max, X_train, \
+                                 cov_type, weight_threshold, callback=None, \
+                                 telemetry=False):
+    print("GMM.BayesianGaussianMixtureModel")
+    """ Variational (Dirichlet process) GMM with n_comp_max components.
+    Components whose weight falls below weight_threshold are dropped and the
+    rest are stored as an ordinary GaussianMixture, so one fit replaces the
+    BIC sweep over n_comp """
+    bgm = None
+    bgm = mixture.BayesianGaussianMixture(n_components = n_comp_max, \
+            covariance_type = cov_type, \
+            weight_concentration_prior_type = 'dirichlet_process', \
+            max_iter = 500)
+    fit_log = fitWithTelemetry(bgm, X_train, 'bayesian', callback, telemetry)
+    if not bgm.converged_:
+        print("GMM.BayesianGaussianMixtureModel WARNING: did not converge")
+
+    # keep the components that are actually used
+    keep = np.where(bgm.weights_ >= weight_threshold)[0]
+    n_comp = keep.size
+    print("GMM.BayesianGaussianMixtureModel effective number of classes = ", \
+          n_comp, " (of ", n_comp_max, ")")
+    print("GMM.BayesianGaussianMixtureModel weights = ", \
+          np.sort(bgm.weights_)[::-1])
+
+    # pruned, renormalised mixture with the posterior mean parameters
+    weights = bgm.weights_[keep]/np.sum(bgm.weights_[keep])
+    means = bgm.means_[keep]
+    covariances = bgm.covariances_
+    if cov_type != 'tied':
+        covariances = covariances[keep]
+
+    gmm = None
+    gmm = mixture.GaussianMixture(n_components = n_comp, \
+                                  covariance_type = cov_type)
+    setGaussianMixtureParameters(gmm, weights, means, covariances, cov_type)
+    gmm.converged_ = bgm.converged_
+    gmm.n_iter_ = bgm.n_iter_
+    gmm.lower_bound_ = bgm.lower_bound_
+
+    # store the GMM object
+    gmm_store = address+"Objects/GMM_Object.pkl"
+    with open(gmm_store, 'wb') as output:
+        gmmObject = gmm
+        pickle.dump(gmmObject, output, pickle.HIGHEST_PROTOCOL)
+    del gmmObject
+
+    # means and covariances
+    weights, means, covariances = None, None, None
+    weights = np.squeeze(gmm.weights_)  # shape (n_components)
+    means = np.squeeze(gmm.means_)  # shape (n_components, n_features)
+    covariances = abs(np.squeeze(gmm.covariances_))
+
+    return gmm, weights, means, covariances, [fit_log]
+
+###############################################################################
+def MiniBatchGaussianMixtureModel(address, runIndex, n_comp, col_reduced, \
+                                  X_train, cov_type, chunk_size, n_passes, \
+                                  decay, reg_covar=1e-6, callback=None, \
+                                  telemetry=False):
+    print("GMM.MiniBatchGaussianMixtureModel")
+    """ Stepwise (online) EM: streams chunks of the full PC-score store and
+    updates running sufficient statistics with step size (step+2)**(-decay),
+    0.5 < decay <= 1. The result is a standard GaussianMixture object.
+
+    The profiles are stored grouped in space and time and the step size
+    decays, so every pass visits them in a new random order (read from the
+    memory-mapped binary store) to keep the model from favouring the last
+    chunks. """
+
+    # initialise with a batch fit on the (small) uniform training dataset
+    gmm = None
+    gmm = mixture.GaussianMixture(n_components = n_comp, \
+                                  covariance_type = cov_type, \
+                                  reg_covar = reg_covar)
+    init_log = fitWithTelemetry(gmm, X_train, 'minibatch_init', callback, \
+                                telemetry)
+    telemetry = telemetry or callback is not None
+
+    # running sufficient statistics, normalised by the number of samples
+    s0, s1, s2 = sufficientStatistics(X_train, gmm.predict_proba(X_train), \
+                                      cov_type)
+
+    # one telemetry record per chunk update
+    stream_log = {'label': 'minibatch', 'n_components': n_comp, \
+                  'iterations': [], 'stopped_early': False}
+    fit_start = time.time()
+
+    # random access to the PC scores (the binary copy of the csv files)
+    if not Print.isPCAScoresCurrent(address, runIndex):
+        Print.printPCAScores(address, runIndex, col_reduced, chunk_size)
+    lon, lat, dynHeight, scores, varTime = Print.readPCAScores(address, runIndex)
+    n_profiles = scores.shape[0]
+
+    step = 0
+    for n_pass in range(n_passes):
+        if stream_log['stopped_early']:
+            break
+        print("GMM.MiniBatchGaussianMixtureModel pass ", n_pass)
+        sum_log_lik, n_seen = 0.0, 0
+        # shuffled rows, sorted within each chunk for the memmap reads
+        order = np.random.permutation(n_profiles)
+        for start in range(0, n_profiles, chunk_size):
+            X_chunk = np.asarray(scores[np.sort(order[start:start+chunk_size])])
+
+            # E-step on this chunk only (timed after the memmap read)
+            e_start = time.time()
+            labels, resp, post_max, log_lik = \
+              scoreProfiles(inferenceKernel(gmm), X_chunk, chunk_size)
+            c0, c1, c2 = sufficientStatistics(X_chunk, resp, cov_type)
+            sum_log_lik = sum_log_lik + log_lik.sum()
+            n_seen = n_seen + X_chunk.shape[0]
+
+            # decaying step towards the chunk statistics
+            eta = (step + 2.0)**(-decay)
+            s0 = s0 + eta*(c0 - s0)
+            s1 = s1 + eta*(c1 - s1)
+            s2 = s2 + eta*(c2 - s2)
+
+            # M-step from the running statistics
+            m_start = time.time()
+            weights, means, covariances = \
+              parametersFromStatistics(s0, s1, s2, cov_type, reg_covar)
+            setGaussianMixtureParameters(gmm, weights, means, covariances, \
+                                         cov_type)
+            step = step + 1
+            if not telemetry:
+                continue
+
+            # chunk mean log-likelihood stands in for the lower bound
+            record = iterationRecord(step, log_lik.mean(), m_start - e_start, \
+                                     time.time() - m_start, weights, False)
+            stream_log['iterations'].append(record)
+            if callback is not None and callback('minibatch', record):
+                stream_log['stopped_early'] = True
+                break
+
+        # mean log-likelihood over the pass (parameters change as it goes)
+        gmm.lower_bound_ = sum_log_lik/n_seen
+        print("GMM.MiniBatchGaussianMixtureModel mean log-likelihood = ", \
+              gmm.lower_bound_)
+
+    gmm.n_iter_ = step
+    print("GMM.MiniBatchGaussianMixtureModel number of chunk updates = ", step)
+    stream_log['fit_time'] = time.time() - fit_start
+    stream_log['n_iter'] = step
+    stream_log['converged'] = False   # no convergence test in online EM
+    stream_log['lower_bound'] = gmm.lower_bound_
+
+    # store the GMM object
+    gmm_store = address+"Objects/GMM_Object.pkl"
+    with open(gmm_store, 'wb') as output:
+        gmmObject = gmm
+        pickle.dump(gmmObject, output, pickle.HIGHEST_PROTOCOL)
+    del gmmObject
+
+    # means and covariances
+    weights, means, covariances = None, None, None
+    weights = np.squeeze(gmm.weights_)  # shape (n_components)
+    means = np.squeeze(gmm.means_)  # shape (n_components, n_features)
+    covariances = abs(np.squeeze(gmm.covariances_))
+
+    return gmm, weights, means, covariances, [init_log, stream_log]
+
+###############################################################################
+# EM telemetry
+
+def fitWithTelemetry(mix, X, label='', callback=None, telemetry=False):
+    """ Fit a GaussianMixture or BayesianGaussianMixture and return a dict
+    with the number of iterations, convergence status, final lower bound
+    and the total fit wall time.
+
+    With telemetry (or a callback) the model's E- and M-steps are timed in
+    place during the one ordinary fit, and each EM iteration is recorded:
+    lower bound, E-step and M-step wall times, component weights and
+    convergence status. callback(label, record) is called after every
+    iteration; if it returns True the fit stops early with the current
+    parameters. Without either, the fit runs untouched. """
+    fit_log = {'label': label, 'n_components': mix.n_components, \
+               'iterations': [], 'stopped_early': False}
+    fit_start = time.time()
+    with warnings.catch_warnings():
+        # non-convergence is reported below
+        warnings.simplefilter('ignore', ConvergenceWarning)
+        if telemetry or callback is not None:
+            hookSteps(mix, fit_log, callback)
+            try:
+                mix.fit(X)
+            except StopFit:
+                fit_log['stopped_early'] = True
+            finally:
+                # back to the class methods (keeps the model picklable)
+                for name in ['_e_step', '_m_step', '_compute_lower_bound']:
+                    del mix.__dict__[name]
+        else:
+            mix.fit(X)
+
+    if fit_log['stopped_early']:
+        # fit() returned before setting these (a BayesianGaussianMixture
+        # only gets weights_ and precisions_ from _set_parameters)
+        mix._set_parameters(mix._get_parameters())
+        record = fit_log['iterations'][-1]
+        mix.converged_ = record['converged']
+        mix.n_iter_ = record['iteration']
+        mix.lower_bound_ = record['lower_bound']
+
+    fit_log['fit_time'] = time.time() - fit_start
+    fit_log['n_iter'] = mix.n_iter_
+    fit_log['converged'] = mix.converged_
+    fit_log['lower_bound'] = mix.lower_bound_
+    if not mix.converged_:
+        print("GMM.fitWithTelemetry "+label+" WARNING: not converged after ", \
+              mix.n_iter_, " iterations")
+    return fit_log
+
+class StopFit(Exception):
+    """ Raised by the telemetry hooks when the callback stops a fit """
+    pass
+
+def hookSteps(mix, fit_log, callback):
+    """ Instance-level wrappers of the EM steps of mix: _e_step and _m_step
+    are timed, and _compute_lower_bound (called once per iteration, after
+    the M-step) appends the iteration record to fit_log """
+    e_step, m_step = mix._e_step, mix._m_step
+    compute_lower_bound = mix._compute_lower_bound
+    step_time = {'e': 0.0, 'm': 0.0}
+
+    def timed_e_step(*args, **kwargs):
+        step_start = time.time()
+        result = e_step(*args, **kwargs)
+        step_time['e'] = time.time() - step_start
+        return result
+
+    def timed_m_step(*args, **kwargs):
+        step_start = time.time()
+        result = m_step(*args, **kwargs)
+        step_time['m'] = time.time() - step_start
+        return result
+
+    def recorded_lower_bound(*args, **kwargs):
+        lower_bound = compute_lower_bound(*args, **kwargs)
+        iterations = fit_log['iterations']
+        previous = iterations[-1]['lower_bound'] if iterations else -np.inf
+        record = iterationRecord(len(iterations) + 1, lower_bound, \
+                                 step_time['e'], step_time['m'], mixtureWeights(mix), \
+                                 abs(lower_bound - previous) < mix.tol)
+        iterations.append(record)
+        if callback is not None and callback(fit_log['label'], record):
+            raise StopFit()
+        return lower_bound
+
+    mix._e_step = timed_e_step
+    mix._m_step = timed_m_step
+    mix._compute_lower_bound = recorded_lower_bound
+
+def mixtureWeights(mix):
+    """ Current component weights; a BayesianGaussianMixture only sets
+    weights_ at the end of the fit, so they come from the concentrations """
+    if not hasattr(mix, 'weight_concentration_'):
+        return mix.weights_
+    if mix.weight_concentration_prior_type == 'dirichlet_process':
+        a, b = mix.weight_concentration_
+        fraction = b/(a + b)
+        weights = a/(a + b)*np.hstack((1, np.cumprod(fraction[:-1])))
+    else:
+        weights = mix.weight_concentration_
+    return weights/np.sum(weights)
+
+def iterationRecord(n_iter, lower_bound, e_step_time, m_step_time, weights, \
+                    converged):
+    return {'iteration': n_iter, 'lower_bound': lower_bound, \
+            'e_step_time': e_step_time, 'm_step_time': m_step_time, \
+            'weights': np.array(weights), 'converged': converged}
+
+def printProgress(label, record):
+    """ Example callback: report every 10th iteration, never stop early """
+    if record['iteration'] % 10 == 0 or record['converged']:
+        print("GMM "+label+" iteration ", record['iteration'], \
+              " lower bound = ", record['lower_bound'], \
+              " E-step time = ", record['e_step_time'], \
+              " M-step time = ", record['m_step_time'])
+    return False
+
+###############################################################################
+def sufficientStatistics(X, resp, cov_type):
+    """ Per-sample averaged zeroth, first and second moments of X weighted by
+    the responsibilities, shapes (k), (k, d) and (k, d, d) or (k, d) """
+    n_samples = X.shape[0]
+    s0 = resp.sum(axis=0)/n_samples
+    s1 = np.dot(resp.T, X)/n_samples
+    if cov_type == 'full' or cov_type == 'tied':
+        s2 = np.empty((resp.shape[1], X.shape[1], X.shape[1]))
+        for k in range(resp.shape[1]):
+            s2[k] = np.dot((resp[:,k][:,np.newaxis]*X).T, X)/n_samples
+    else:
+        s2 = np.dot(resp.T, X*X)/n_samples
+    return s0, s1, s2
+
+def parametersFromStatistics(s0, s1, s2, cov_type, reg_covar):
+    """ M-step: mixture weights, means and covariances from the moments """
+    nk = s0 + 10*np.finfo(s0.dtype).eps
+    weights = nk/nk.sum()
+    means = s1/nk[:,np.newaxis]
+    n_features = means.shape[1]
+    if cov_type == 'full':
+        covariances = s2/nk[:,np.newaxis,np.newaxis] \
+                      - np.einsum('ki,kj->kij', means, means)
+        covariances = covariances + reg_covar*np.eye(n_features)
+    elif cov_type == 'tied':
+        covariances = (s2.sum(axis=0) - np.dot(nk*means.T, means))/nk.sum()
+        covariances = covariances + reg_covar*np.eye(n_features)
+    elif cov_type == 'diag':
+        covariances = s2/nk[:,np.newaxis] - means**2 + reg_covar
+    else:
+        covariances = (s2/nk[:,np.newaxis] - means**2).mean(axis=1) + reg_covar
+    return weights, means, covariances
+
+def computePrecisionCholesky(covariances, cov_type):
+    """ Cholesky factor of the precision matrices, as stored by sklearn """
+    if cov_type == 'full':
+        n_components, n_features, _ = covariances.shape
+        prec_chol = np.empty((n_components, n_features, n_features))
+        for k in range(n_components):
+            cov_chol = linalg.cholesky(covariances[k], lower=True)
+            prec_chol[k] = linalg.solve_triangular(cov_chol, \
+                             np.eye(n_features), lower=True).T
+    elif cov_type == 'tied':
+        n_features = covariances.shape[0]
+        cov_chol = linalg.cholesky(covariances, lower=True)
+        prec_chol = linalg.solve_triangular(cov_chol, np.eye(n_features), \
+                                            lower=True).T
+    else:
+        prec_chol = 1.0/np.sqrt(covariances)
+    return prec_chol
+
+def componentCovariances(gmm):
+    """ (n_components, n_features, n_features) covariance matrices for any
+    covariance_type """
+    n_components, n_features = gmm.means_.shape
+    cov_type = gmm.covariance_type
+    if cov_type == 'full':
+        return gmm.covariances_
+    elif cov_type == 'tied':
+        return np.tile(gmm.covariances_, (n_components, 1, 1))
+    elif cov_type == 'diag':
+        return gmm.covariances_[:,:,np.newaxis]*np.eye(n_features)
+    return gmm.covariances_[:,np.newaxis,np.newaxis]*np.eye(n_features)
+
+def componentVariances(gmm):
+    """ (n_components, n_features) diagonals of the covariance matrices """
+    n_components, n_features = gmm.means_.shape
+    cov_type = gmm.covariance_type
+    if cov_type == 'full':
+        return np.diagonal(gmm.covariances_, axis1=1, axis2=2).copy()
+    elif cov_type == 'tied':
+        return np.tile(np.diag(gmm.covariances_), (n_components, 1))
+    elif cov_type == 'diag':
+        return gmm.covariances_.copy()
+    return np.outer(gmm.covariances_, np.ones(n_features))
+
+def setGaussianMixtureParameters(gmm, weights, means, covariances, cov_type):
+    """ Overwrite the fitted parameters of a GaussianMixture object so that
+    predict, predict_proba, score etc. use them """
+    gmm.weights_ = weights
+    gmm.means_ = means
+    gmm.covariances_ = covariances
+    gmm.precisions_cholesky_ = computePrecisionCholesky(covariances, cov_type)
+    if cov_type == 'full':
+        gmm.precisions_ = np.einsum('kij,klj->kil', gmm.precisions_cholesky_, \
+                                    gmm.precisions_cholesky_)
+    elif cov_type == 'tied':
+        gmm.precisions_ = np.dot(gmm.precisions_cholesky_, \
+                                 gmm.precisions_cholesky_.T)
+    else:
+        gmm.precisions_ = gmm.precisions_cholesky_**2
+    gmm.n_features_in_ = means.shape[1]
+
+###############################################################################
+def inferenceKernel(gmm):
+    """ Precompute everything scoreProfiles needs from a fitted
+    GaussianMixture: log-weights, precision Cholesky factors, their
+    log-determinants and the means projected by the precision factors """
+    cov_type = gmm.covariance_type
+    means = np.asarray(gmm.means_, dtype=np.float64)
+    prec_chol = np.asarray(gmm.precisions_cholesky_, dtype=np.float64)
+    n_components, n_features = means.shape
+
+    kernel = {'cov_type': cov_type, 'n_features': n_features, \
+              'n_components': n_components, \
+              'log_weights': np.log(gmm.weights_)}
+
+    if cov_type == 'full':
+        # stack the K factors side by side so one GEMM projects a chunk
+        kernel['log_det'] = np.sum(np.log(np.diagonal(prec_chol, \
+                                   axis1=1, axis2=2)), axis=1)
+        kernel['prec_stack'] = np.ascontiguousarray(\
+          prec_chol.transpose(1,0,2).reshape(n_features, -1))
+        kernel['mean_prec'] = np.einsum('kd,kde->ke', means, \
+                                        prec_chol).reshape(-1)
+    elif cov_type == 'tied':
+        kernel['log_det'] = np.sum(np.log(np.diag(prec_chol)))
+        kernel['prec_chol'] = prec_chol
+        kernel['mean_prec'] = np.dot(means, prec_chol)
+        kernel['mean_prec_sq'] = np.sum(kernel['mean_prec']**2, axis=1)
+    elif cov_type == 'diag':
+        precisions = prec_chol**2
+        kernel['log_det'] = np.sum(np.log(prec_chol), axis=1)
+        kernel['precisions'] = precisions
+        kernel['mean_prec'] = means*precisions
+        kernel['mean_prec_sq'] = np.sum(means**2*precisions, axis=1)
+    else:
+        precisions = prec_chol**2
+        kernel['log_det'] = n_features*np.log(prec_chol)
+        kernel['precisions'] = precisions
+        kernel['means'] = means
+        kernel['mean_prec_sq'] = np.sum(means**2, axis=1)*precisions
+    return kernel
+
+def scoreProfiles(kernel, X_array, chunk_size=10000):
+    """ Single pass E-step over X_array in chunks of rows. Returns labels,
+    posterior probabilities, maximum posterior probability and per-profile
+    log-likelihood, without sklearn's per-call input validation """
+    n_samples = X_array.shape[0]
+    n_components = kernel['n_components']
+    n_features = kernel['n_features']
+    cov_type = kernel['cov_type']
+
+    labels = np.empty(n_samples, dtype=np.int64)
+    post_prob = np.empty((n_samples, n_components))
+    post_max = np.empty(n_samples)
+    log_lik = np.empty(n_samples)
+
+    for start in range(0, n_samples, chunk_size):
+        stop = min(start + chunk_size, n_samples)
+        X = np.asarray(X_array[start:stop], dtype=np.float64)
+
+        # squared Mahalanobis distance to each class mean, shape (n, k)
+        if cov_type == 'full':
+            Y = np.dot(X, kernel['prec_stack']) - kernel['mean_prec']
+            Y = Y*Y
+            sq = Y.reshape(X.shape[0], n_components, n_features).sum(axis=2)
+        elif cov_type == 'tied':
+            XP = np.dot(X, kernel['prec_chol'])
+            sq = np.sum(XP*XP, axis=1)[:,np.newaxis] \
+                 - 2*np.dot(XP, kernel['mean_prec'].T) + kernel['mean_prec_sq']
+        elif cov_type == 'diag':
+            sq = np.dot(X*X, kernel['precisions'].T) \
+                 - 2*np.dot(X, kernel['mean_prec'].T) + kernel['mean_prec_sq']
+        else:
+            sq = np.sum(X*X, axis=1)[:,np.newaxis]*kernel['precisions'] \
+                 - 2*np.dot(X, kernel['means'].T)*kernel['precisions'] \
+                 + kernel['mean_prec_sq']
+
+        # weighted log-probabilities, then normalise in log space
+        log_prob = -0.5*(n_features*np.log(2*np.pi) + sq) \
+                   + kernel['log_det'] + kernel['log_weights']
+        log_max = np.max(log_prob, axis=1)
+        log_norm = log_max + np.log(np.sum(np.exp(log_prob - \
+                                   log_max[:,np.newaxis]), axis=1))
+
+        labels[start:stop] = np.argmax(log_prob, axis=1)
+        post_prob[start:stop] = np.exp(log_prob - log_norm[:,np.newaxis])
+        post_max[start:stop] = np.exp(log_max - log_norm)
+        log_lik[start:stop] = log_norm
+
+    return labels, post_prob, post_max, log_lik
+
+###############################################################################
+# process-parallel version of scoreProfiles
+
+# model and shared arrays held by each worker process
+worker_state = {}
+
+def scoreProfilesParallel(gmm_store, X_array, n_comp, chunk_size=10000, \
+                          n_workers=None, n_threads=1):
+    print("GMM.scoreProfilesParallel")
+    """ scoreProfiles over a pool of processes. X_array and the outputs live
+    in shared memory; each worker unpickles gmm_store once and writes its
+    chunks straight into the output arrays """
+    n_samples = X_array.shape[0]
+
+    # inputs and outputs in shared memory
+    X_shm, X_shared, X_spec = Parallel.toSharedArray(\
+                                np.asarray(X_array, dtype=np.float64))
+    lab_shm, labels, lab_spec = Parallel.createSharedArray((n_samples,), np.int64)
+    post_shm, post_prob, post_spec = \
+      Parallel.createSharedArray((n_samples, n_comp), np.float64)
+    max_shm, post_max, max_spec = Parallel.createSharedArray((n_samples,), np.float64)
+    ll_shm, log_lik, ll_spec = Parallel.createSharedArray((n_samples,), np.float64)
+    specs = (X_spec, lab_spec, post_spec, max_spec, ll_spec)
+
+    # score chunks, results are written in place
+    pool = Parallel.makePool(n_workers, n_threads, scoreWorkerInit, \
+                             (gmm_store, specs))
+    try:
+        pool.map(scoreWorkerChunk, Parallel.chunkBounds(n_samples, chunk_size))
+    finally:
+        pool.close()
+        pool.join()
+
+    # copy out of shared memory before releasing it
+    labels, post_prob = labels.copy(), post_prob.copy()
+    post_max, log_lik = post_max.copy(), log_lik.copy()
+    Parallel.releaseSharedArrays([X_shm, lab_shm, post_shm, max_shm, ll_shm])
+
+    return labels, post_prob, post_max, log_lik
+
+def scoreWorkerInit(gmm_store, specs):
+    # load the model once per worker
+    with open(gmm_store, 'rb') as input:
+        gmm = pickle.load(input)
+    worker_state['kernel'] = inferenceKernel(gmm)
+    worker_state['arrays'] = [Parallel.attachSharedArray(spec) for spec in specs]
+
+def scoreWorkerChunk(bounds):
+    start, stop = bounds
+    X, labels, post_prob, post_max, log_lik = worker_state['arrays']
+    labels[start:stop], post_prob[start:stop], post_max[start:stop], \
+      log_lik[start:stop] = scoreProfiles(worker_state['kernel'], \
+                                          X[start:stop], stop - start)
 
-print('GMM runtime = ', time.clock() - start_time,' s')
+print('GMM runtime = ', time.perf_counter() - start_time,' s')
@@ -22,41 +22,30 @@ import time
 
 import Print
 
-start_time = time.clock()
+start_time = time.perf_counter()
 
 def main(address, filename_raw_data, runIndex, subsample_uniform, subsample_random,\
          subsample_inTime, grid, conc, fraction_train, inTime_start, inTime_finish,\
          fraction_nan_samples, fraction_nan_depths, cov_type, run_bic=False):
     print("Starting Load.main")
     """ Main function for module"""
-    lon, lat, dynHeight, Tint, Sint, varTime = \
-        load(filename_raw_data)
-    print("Removing depths with high NaN counts")
-    Tint, Sint, depth = \
-        removeDepthFractionNan(Tint, Sint, fraction_nan_depths)
-    print("Removing profiles with high NaN counts")
-    lon, lat, dynHeight, Tint, Sint, varTime = \
-        removeSampleFractionNan(lon, lat, dynHeight, Tint, Sint, \
-        varTime, fraction_nan_samples)
-    print("Dealing with remaining NaN values")
-    Tint, Sint = dealwithNan(Tint, Sint)
+    lon, lat, dynHeight, Tint, Sint, varTime, depth, profile_id = \
+        loadAndClean(filename_raw_data, fraction_nan_samples, fraction_nan_depths)
     
     # at this point the data has been successfully cleaned.
     """ now we need to subselect the training data """
     print("Selecting subset of data that will be used as training data")
-    Tint_train, Sint_train, varTime_train = None, None, None
-    if subsample_uniform: # currently working 
-        lon_train, lat_train, dynHeight_train, Tint_train, Sint_train, \
-            varTime_train = uniformTrain(lon, lat, dynHeight, Tint, Sint, \
-            varTime, depth, grid, conc)
+    train_rows = None   # rows of the cleaned data in the training set
+    if subsample_uniform: # currently working (same draws as uniformTrain)
+        train_rows = uniformTrainIndices(gridCells(lon, lat, grid), conc)
     if subsample_random: # also working
-        lon_train, lat_train, dynHeight_train, Tint_train, Sint_train, \
-            varTime_train = randomTrain(lon, lat, dynHeight, Tint, Sint, \
-            varTime, depth, fraction_train)
+        train_rows = randomTrainIndices(Tint, fraction_train)
     if subsample_inTime:
-        lon_train, lat_train, dynHeight_train, Tint_train, Sint_train, \
-            varTime_train = inTimeTrain(lon, lat, dynHeight, Tint, Sint, \
-            varTime, depth, inTime_start, inTime_finish)
+        train_rows = inTimeTrainIndices(varTime, inTime_start, inTime_finish)
+    lon_train, lat_train, dynHeight_train, Tint_train, Sint_train, varTime_train = \
+        lon[train_rows], lat[train_rows], dynHeight[train_rows], \
+        Tint[train_rows,:], Sint[train_rows,:], varTime[train_rows]
+    print("Tint_train.shape = ", Tint_train.shape)
     
     ## At this point we should have a training data set to go with the full data set
     """ Now we can centre and standardise the training data, and the whole data will follow """
@@ -87,12 +76,21 @@ def main(address, filename_raw_data, runIndex, subsample_uniform, subsample_rand
 #    print("Starting Print")
     print("varTrain_centre.shape = ", varTrain_centre.shape)
     if not run_bic:
+        # persistent profile ids, in the row order of the full and training
+        # files (every writer after this adds them as a profile_id column)
+        Print.printProfileIds(address, runIndex, profile_id, False)
+        Print.printProfileIds(address, runIndex, profile_id[train_rows], True)
         Print.printLoadToFile(address, runIndex, lon, lat, dynHeight,\
                               Tint, var_centre, Sint, varTime, depth)
         Print.printLoadToFile_Train(address, runIndex, lon_train, \
                           lat_train, dynHeight_train, Tint_train, \
                           varTrain_centre, Sint_train, varTime_train, depth)
         Print.printDepth(address, runIndex, depth)
+        # limits of the class statistics histograms (see ClassProperties)
+        Print.printDataRanges(address, runIndex, \
+            {'temperature': (np.nanmin(Tint), np.nanmax(Tint)), \
+             'temperature_standardized': (np.nanmin(var_centre), np.nanmax(var_centre)), \
+             'salinity': (np.nanmin(Sint), np.nanmax(Sint))})
     
     if run_bic:
         return lon_train, lat_train, dynHeight_train, Tint_train, \
@@ -100,6 +98,26 @@ def main(address, filename_raw_data, runIndex, subsample_uniform, subsample_rand
     
 ###############################################################################
 # Functions which Main uses
+def loadAndClean(filename_raw_data, fraction_nan_samples, fraction_nan_depths):
+    print("Load.loadAndClean")
+    """ Load the raw data and remove/interpolate NaN values. Bic calls this
+    once and then draws many training datasets from the result. profile_id
+    is the row of each remaining profile in the raw data file, so it stays
+    the same between runs """
+    lon, lat, dynHeight, Tint, Sint, varTime = \
+        load(filename_raw_data)
+    profile_id = np.arange(lon.size)
+    print("Removing depths with high NaN counts")
+    Tint, Sint, depth = \
+        removeDepthFractionNan(Tint, Sint, fraction_nan_depths)
+    print("Removing profiles with high NaN counts")
+    lon, lat, dynHeight, Tint, Sint, varTime, profile_id = \
+        removeSampleFractionNan(lon, lat, dynHeight, Tint, Sint, \
+        varTime, fraction_nan_samples, profile_id)
+    print("Dealing with remaining NaN values")
+    Tint, Sint = dealwithNan(Tint, Sint)
+    return lon, lat, dynHeight, Tint, Sint, varTime, depth, profile_id
+
 def load(filename_raw_data):
     print("Load.load")
     """ This function loads the raw data from a .mat file """
@@ -158,7 +176,8 @@ def removeDepthFractionNan(VAR, VAR2, fraction_of):
     #print("VAR shape after half Sample removed = ", VAR.shape)
     return VAR, VAR2, depth_remain  
 
-def removeSampleFractionNan(LON, LAT, dynHeight, VAR, VAR2, varTime, fraction_of):
+def removeSampleFractionNan(LON, LAT, dynHeight, VAR, VAR2, varTime, fraction_of, \
+                            profile_id):
     print("Load.removeSampleFractionNan")
     """ This function removes all profiles will a given number of Nan values """
     delete_sample = []
@@ -179,12 +198,13 @@ def removeSampleFractionNan(LON, LAT, dynHeight, VAR, VAR2, varTime, fraction_of
     LON = np.delete(LON, (delete_sample))
     LAT = np.delete(LAT, (delete_sample)) 
     dynHeight = np.delete(dynHeight, (delete_sample))
+    profile_id = np.delete(profile_id, (delete_sample))
     print("Number of samples deleted above the 1/"+\
         str(fraction_of)+" criterion = ", sample_count)
     #print("VAR shape after half Col removed = ", VAR.shape)
     #print("LON shape = ", LON.shape)
     #print("LAT shape = ", LAT.shape)
-    return LON, LAT, dynHeight, VAR, VAR2, varTime
+    return LON, LAT, dynHeight, VAR, VAR2, varTime, profile_id
 
 def dealwithNan(VAR, VAR2):
     print("Load.dealwithNan")
@@ -322,16 +342,45 @@ def uniformTrain(lon, lat, dynHeight, VAR, VAR2, varTime, depth, grid, concentra
     return array_lon, array_lat, array_dynHeight, var_train_array, \
            var2_train_array, array_time
 
+###############################################################################
+def gridCells(lon, lat, grid):
+    print("Load.gridCells")
+    """ Profile indices in each lat/lon cell, using the same cells as
+    uniformTrain (latitude cells start from the floor of the minimum latitude
+    in each longitude band). Only needs computing once per dataset """
+    cells = []
+    for i in np.arange(-180, 180, grid, dtype=np.int32):
+        indices_lon = np.nonzero((lon>=i)&(lon<i+grid))[0]
+        if indices_lon.size == 0:
+            continue
+        lat_i = lat[indices_lon]
+        j_start = np.floor(min(np.floor(lat_i)))
+        j_stop = max(np.ceil(lat_i))
+
+        # latitude cell of each profile in this band, ignoring any beyond
+        # the last cell start as uniformTrain does
+        cell_j = np.floor((lat_i - j_start)/grid).astype(np.int64)
+        valid = (j_start + cell_j*grid) < j_stop
+        order = np.argsort(cell_j[valid], kind='mergesort')
+        sorted_j = cell_j[valid][order]
+        sorted_index = indices_lon[valid][order]
+        starts = np.flatnonzero(np.r_[True, np.diff(sorted_j) != 0])
+        cells.extend(np.split(sorted_index, starts[1:]))
+    return cells
+
+def uniformTrainIndices(cells, concentration):
+    """ Draw concentration profiles (with replacement) from every cell """
+    selected = [cell[np.random.randint(cell.size, size = concentration)] \
+                for cell in cells]
+    return np.concatenate(selected)
+
 ###############################################################################
 def randomTrain(lon, lat, dynHeight, Tint, Sint, varTime, depth, fraction_train):
     lon_rand, lat_rand, dynHeight_rand, Tint_rand, Sint_rand, varTime_rand = \
         None, None, None, None, None, None, None
 
-    array_size = np.ma.size(Tint, axis = 0)   # expecting around 280,000
-    number_rand = fraction_train * array_size
-    
     indices_rand = None
-    indices_rand = np.random.randint(0, high=array_size, size = number_rand)
+    indices_rand = randomTrainIndices(Tint, fraction_train)
     
     lon_rand = lon[indices_rand]
     lat_rand = lat[indices_rand]
@@ -343,6 +392,12 @@ def randomTrain(lon, lat, dynHeight, Tint, Sint, varTime, depth, fraction_train)
     print("Tint_rand.shape = ", Tint_rand.shape)
     
     return lon_rand, lat_rand, dynHeight_rand, Tint_rand, Sint_rand, varTime_rand
+
+def randomTrainIndices(Tint, fraction_train):
+    """ Rows drawn at random (with replacement) for the training set """
+    array_size = np.ma.size(Tint, axis = 0)   # expecting around 280,000
+    number_rand = int(fraction_train * array_size)
+    return np.random.randint(0, high=array_size, size = number_rand)
 ###############################################################################
 def inTimeTrain(lon, lat, dynHeight, Tint, Sint, varTime, depth, \
                 inTime_start, inTime_finish):
@@ -350,8 +405,7 @@ def inTimeTrain(lon, lat, dynHeight, Tint, Sint, varTime, depth, \
     varTime_train = None, None, None, None, None, None
     
     indices_time = None
-    indices_time = np.logical_and(varTime > inTime_start, \
-                                  varTime < inTime_finish)
+    indices_time = inTimeTrainIndices(varTime, inTime_start, inTime_finish)
     
     lon_train = lon[indices_time]
     lat_train = lat[indices_time]
@@ -365,6 +419,11 @@ def inTimeTrain(lon, lat, dynHeight, Tint, Sint, varTime, depth, \
     return lon_train, lat_train, dynHeight_train, Tint_train, \
            Sint_train, varTime_train
 
+def inTimeTrainIndices(varTime, inTime_start, inTime_finish):
+    """ Rows with times inside (inTime_start, inTime_finish) """
+    return np.nonzero(np.logical_and(varTime > inTime_start, \
+                                     varTime < inTime_finish))[0]
+
 ###############################################################################
 
 def centreAndStandardise(address, runIndex, VAR):
@@ -383,4 +442,4 @@ def centreAndStandardise(address, runIndex, VAR):
     
     return stand, stand_store, var_stand
     
-print('Load runtime = ', time.clock() - start_time,' s')
+print('Load runtime = ', time.perf_counter() - start_time,' s')
@@ -14,6 +14,7 @@ This script is the central script for my GMM program. It coordinates:
     PCA.py
     Bic.py
     Reconstruct.py
+    Climatology.py
 
 The intention is to have a program, comprised of a few modules, which can take
 a data set, select a training dataset, a test data set and return:
@@ -35,12 +36,13 @@ import Load, Print, PCA, GMM, Reconstruct, Bic
 import matplotlib.pyplot as plt
 import pandas as pd
 import ClassProperties
+import Climatology
 import Plot
 import os.path
 import pdb
 
 # start the clock (performance timing)
-start_time = time.clock()
+start_time = time.perf_counter()
 
 # set run mode (BIC, GMM, or Plot)
 # -- BIC = calculates BIC scores for a range of classes
@@ -57,12 +59,71 @@ use_fPCA = False
 # plot ACC fronts 
 plotFronts = True
 
+# cell size (degrees) of gridded maps; None = scatter plots of the profiles
+map_grid = None
+# output format of the plots ('pdf' or 'png'), and whether the heavy layers
+# (scatter points, profile lines, histograms) of a pdf are rasterised;
+# maps in a rasterised figure (png, or plot_rasterise) draw a cached raster
+# of the coastlines and gridlines, otherwise they stay vector
+plot_format = 'pdf'
+plot_rasterise = False
+
 # set parameters
 n_comp = 8           # number of classes in GMM object
 n_dimen = 0.999      # amount of variance retained in PCA
 cov_type = 'full'    # covariance type (full, tied, diag, or spherical)
 nbins = 500          # number of bins to use in histograms
 
+# GMM fitting mode
+# -- batch = standard EM on the training dataset only
+# -- minibatch = online EM streamed over all profiles in chunks
+# -- bayesian = variational GMM; the number of classes is chosen by the fit
+#    (at most n_comp_max), so no BIC sweep is needed
+gmm_mode = 'batch'
+n_comp_max = 20         # upper bound on number of classes (bayesian mode)
+weight_threshold = 0.01 # classes with smaller weights are dropped (bayesian mode)
+chunk_size = 10000   # number of profiles per chunk (minibatch mode)
+n_passes = 1         # number of sweeps through all profiles (minibatch mode)
+decay = 0.6          # step size decay exponent, in (0.5, 1] (minibatch mode)
+
+# number of worker processes used to classify profiles (1 = serial)
+# (> 1 also writes the full and training reconstructions concurrently,
+# and draws the per-class and per-PC figures in parallel)
+n_workers = 1
+
+# write the centred reconstructions too (needed by Plot in 'depth' space)
+keep_centred = True
+# also pickle the full depth x depth class covariance matrices
+full_cov_depth = False
+# write reconstruction error summaries (Results/Recon_error_*.csv)
+recon_diagnostics = False
+# skip writing the full reconstruction (Data_store/Reconstruction); profiles
+# are reconstructed on demand with Reconstruct.reconstructProfiles/Region
+lazy_recon = True
+
+# class statistics accumulated chunk by chunk in GMM.apply, which
+# ClassProperties then writes (also Results/*_class_depth_stats.csv) without
+# loading every profile; AllProfiles.pkl is not written, so the Plot run
+# modes refuse to start with it
+stream_stats = False
+
+# class numbering: sort by temperature of the GMM class means ('parameters')
+# or of the profiles in each class ('data')
+class_order = 'parameters'
+
+# gridded climatology of class occurrence and posteriors (Results/Climatology*)
+climatology = False
+climatology_grid = 1.0      # cell size in lat/lon degrees
+climatology_time = None     # None (all profiles), 'month' or 'season'
+climatology_format = 'hdf5' # 'hdf5' (h5py) or 'netcdf' (needs netCDF4)
+
+# per-iteration EM telemetry (Results/GMM_fit_log.csv, E- and M-step times);
+# off by default since it times every step. The fit summaries are always written
+fit_telemetry = False
+# called after every EM iteration with (label, record), which turns on the
+# telemetry for that fit (also in the BIC sweep). Return True to stop early
+fit_callback = None     # e.g. GMM.printProgress
+
 # put here for a quick fix 
 # we can get rid of this variable in a later version of the code
 runIndex = None
@@ -86,6 +147,8 @@ if run_bic:
     grid_bic = 4        # size of cell in lat/lon degrees
     conc_bic = 1        # number of samples from each grid
     size_bic = 1100     # ideal size of the BIC training set
+    seed_bic = 0        # random seed for the BIC sweep (None = not repeatable)
+    patience_bic = None # stop a repeat after this many n without a lower BIC (None = test all n)
 
 subsample_uniform = True  # indicates how the training dataset is selected
 subsample_random = False  # indicates how the training dataset is selected
@@ -129,17 +192,23 @@ def main(runIndex=None):
 
     # loads data, selects train, cleans, centres/standardises, prints
     PCA.create(address, runIndex, n_dimen, use_fPCA)     
-    GMM.create(address, runIndex, n_comp, cov_type)   
     PCA.apply(address, runIndex)                   
-    GMM.apply(address, runIndex, n_comp)     
+
+    # in bayesian mode the fit decides the number of classes
+    n_comp_fit = n_comp
+    if gmm_mode == 'bayesian':
+        n_comp_fit = n_comp_max
+    n_comp_fit = GMM.create(address, runIndex, n_comp_fit, cov_type, gmm_mode, \
+                            chunk_size, n_passes, decay, weight_threshold, \
+                            fit_callback, fit_telemetry)
+    GMM.apply(address, runIndex, n_comp_fit, chunk_size, n_workers, stream_stats)
     
     # reconstruction (back into depth space)
-    Reconstruct.gmm_reconstruct(address, runIndex, n_comp)  
-    Reconstruct.full_reconstruct(address, runIndex)
-    Reconstruct.train_reconstruct(address, runIndex)
+    Reconstruct.main(address, runIndex, n_comp_fit, chunk_size, keep_centred, \
+                     n_workers, full_cov_depth, recon_diagnostics, lazy_recon)
 
     # calculate properties
-    mainProperties(address, runIndex, n_comp)
+    mainProperties(address, runIndex, n_comp_fit)
 
 #######################################################################
 
@@ -147,7 +216,12 @@ def main(runIndex=None):
 def mainProperties(address, runIndex, n_comp):
 
     # calculate class properties, create data frame for later use
-    ClassProperties.main(address, runIndex, n_comp)
+    ClassProperties.main(address, runIndex, n_comp, ordering=class_order, \
+                         streamed=stream_stats)
+    # gridded class occurrence and posterior products (sorted classes)
+    if climatology:
+        Climatology.main(address, runIndex, n_comp, climatology_grid, \
+                         climatology_time, climatology_format)
 
 #######################################################################
 
@@ -166,21 +240,26 @@ def mainPlot(address, address_fronts, runIndex, n_comp, plotFronts):
 
 #   # read data frame with profiles and sorted labels
     print('loading data frame (this could take a while)')
-    frame_store = address + 'Objects/AllProfiles.pkl'
-    allDF = pd.read_pickle(frame_store, compression='infer')
+    allDF = ClassProperties.readAllProfiles(address)
+    # index arrays for selecting the surface, classes and posterior ranges
+    index = ClassProperties.readPlotIndex(address, allDF, n_comp)
 
 #   # make some plots
 #   print('creating plots')
-#   Plot.plotBIC(address, repeat_bic, max_groups)
-    Plot.plotMapCircular(address, address_fronts, plotFronts, n_comp, allDF, colormap)
-    Plot.plotByDynHeight(address, address_fronts, runIndex, n_comp, allDF, colormap)
-    Plot.plotPosterior(address, address_fronts, runIndex, n_comp, plotFronts, allDF)
-    Plot.plotProfilesByClass(address, runIndex, n_comp, allDF, colormap)
-#   Plot.plotGaussiansIndividual(address, runIndex, n_comp, 'reduced', allDF, nbins, colormap)
-#   Plot.plotWeights(address, runIndex)
-#   Plot.plotPCAcomponents(address, runIndex, n_comp)
-#   Plot.plotEigenvectors(address, runIndex, allDF)
-#   Plot.plotPCAmplitudeCoefficients(address, address_fronts, runIndex)
+#   Plot.plotBIC(address, repeat_bic, max_groups, False, plot_format)
+    Plot.plotMapCircular(address, address_fronts, plotFronts, n_comp, allDF, colormap, \
+                         map_grid, index, plot_format, plot_rasterise)
+    Plot.plotByDynHeight(address, address_fronts, runIndex, n_comp, allDF, colormap, \
+                         index, plot_format, plot_rasterise)
+    Plot.plotPosterior(address, address_fronts, runIndex, n_comp, plotFronts, allDF, \
+                       n_workers, map_grid, index, plot_format, plot_rasterise)
+    Plot.plotProfilesByClass(address, runIndex, n_comp, allDF, colormap, n_workers, \
+                             index, plot_format)
+#   Plot.plotGaussiansIndividual(address, runIndex, n_comp, 'reduced', allDF, nbins, colormap, plot_format, plot_rasterise)
+#   Plot.plotWeights(address, runIndex, plot_format)
+#   Plot.plotPCAcomponents(address, runIndex, n_comp, plot_format)
+#   Plot.plotEigenvectors(address, runIndex, allDF, n_workers, plot_format)
+#   Plot.plotPCAmplitudeCoefficients(address, address_fronts, runIndex, n_workers, map_grid, plot_format, plot_rasterise)
 
 #######################################################################
 
@@ -269,18 +348,30 @@ def makeDirectoryStructure(address):
     - Plot the result
     """
 
+# the Plot stage reads AllProfiles.pkl, which streamed statistics skip
+if stream_stats and run_mode in ["Plot", "GMM+Plot"]:
+    raise ValueError("Main: run_mode "+run_mode+" needs Objects/AllProfiles.pkl, "+\
+                     "which is not written with stream_stats = True")
+
+# in bayesian mode, later stages use the number of classes that was kept
+if gmm_mode == 'bayesian' and run_mode in ["Plot", "Props"]:
+    n_comp = Print.readNcomp(address, runIndex)
+
 # main program loop 
 if (run_mode=="BIC"):
 #   Bic.main(address, filename_raw_data,subsample_bic, repeat_bic, max_groups, \
 #       grid_bic, conc_bic, size_bic, n_dimen, fraction_nan_samples, \
-#       fraction_nan_depths, cov_type)
-    Plot.plotBIC(address, repeat_bic, max_groups)
+#       fraction_nan_depths, cov_type, fit_callback, n_workers, seed_bic, \
+#       patience_bic)
+    Plot.plotBIC(address, repeat_bic, max_groups, False, plot_format)
 elif (run_mode=="GMM"):
     main()
 elif (run_mode=="Plot"):
     mainPlot(ploc, address_fronts, runIndex, n_comp, plotFronts) 
 elif (run_mode=="GMM+Plot"):
     main()
+    if gmm_mode == 'bayesian':
+        n_comp = Print.readNcomp(address, runIndex)
     mainPlot(ploc, address_fronts, runIndex, n_comp, plotFronts) 
 elif (run_mode=="Props"):
     mainProperties(address, runIndex, n_comp) 
@@ -288,5 +379,5 @@ else:
     print('Parameter run_mode not set properly. Check Main.py')
 
 # print runtime for performance
-print('Main runtime = ', time.clock() - start_time,' s')
+print('Main runtime = ', time.perf_counter() - start_time,' s')
     
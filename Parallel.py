@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+Parallel.py
+
+Purpose:
+    - Place large read-only arrays (and output arrays) in shared memory so
+      worker processes can use them without pickling copies
+    - Create process pools whose workers are limited to a few BLAS threads,
+      so that n_workers x BLAS threads does not oversubscribe the node
+
+Workers are started with fork: Main.py has no __main__ guard, so a spawned
+worker would re-run the whole program on import.
+"""
+import os
+import multiprocessing
+import numpy as np
+
+# shared memory blocks need python >= 3.8
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+# environment variables read by the common BLAS/OpenMP implementations
+thread_variables = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', \
+                    'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_FRAMEWORK_THREADS', \
+                    'NUMEXPR_NUM_THREADS']
+
+# handles on arrays attached inside a worker (kept alive for the worker)
+worker_arrays = {}
+
+###############################################################################
+
+def createSharedArray(shape, dtype):
+    """ Allocate an array in a new shared memory block. Returns the block
+    (needed for close/unlink), the array and a spec that workers pass to
+    attachSharedArray """
+    if shared_memory is None:
+        raise RuntimeError("Parallel: multiprocessing.shared_memory needs "+\
+                           "python 3.8 or later, use n_workers = 1")
+    dtype = np.dtype(dtype)
+    nbytes = max(int(np.prod(shape))*dtype.itemsize, 1)
+    shm = shared_memory.SharedMemory(create=True, size=nbytes)
+    array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    spec = (shm.name, tuple(shape), dtype.str)
+    return shm, array, spec
+
+def toSharedArray(array):
+    """ Copy an existing array into shared memory """
+    shm, shared, spec = createSharedArray(array.shape, array.dtype)
+    shared[:] = array
+    return shm, shared, spec
+
+def attachSharedArray(spec):
+    """ Attach to a block created by createSharedArray (inside a worker) """
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    worker_arrays[name] = shm
+    return array
+
+def releaseSharedArrays(shm_list):
+    """ Close and free shared blocks once the pool has finished """
+    for shm in shm_list:
+        shm.close()
+        shm.unlink()
+
+###############################################################################
+
+def limitThreads(n_threads):
+    """ Cap the number of BLAS/OpenMP threads in this process """
+    for variable in thread_variables:
+        os.environ[variable] = str(n_threads)
+    # BLAS is already loaded in a forked worker, so also set the limit at
+    # runtime when threadpoolctl (a scikit-learn dependency) is available
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(limits=n_threads)
+    except ImportError:
+        pass
+
+def workerInit(n_threads, initializer, initargs):
+    limitThreads(n_threads)
+    if initializer is not None:
+        initializer(*initargs)
+
+def workerCount(n_workers, n_threads=1):
+    """ Number of pool processes: n_workers, or by default as many as the
+    cores allow with n_threads BLAS threads each """
+    if n_workers is None or n_workers < 1:
+        n_workers = max(os.cpu_count()//max(n_threads, 1), 1)
+    return n_workers
+
+def makePool(n_workers, n_threads=1, initializer=None, initargs=()):
+    """ Process pool whose workers each use at most n_threads BLAS threads """
+    n_workers = workerCount(n_workers, n_threads)
+    context = multiprocessing.get_context('fork')
+    pool = context.Pool(processes=n_workers, initializer=workerInit, \
+                        initargs=(n_threads, initializer, initargs))
+    return pool
+
+def chunkBounds(n_rows, chunk_size):
+    """ (start, stop) row ranges covering n_rows """
+    return [(start, min(start + chunk_size, n_rows)) \
+            for start in range(0, n_rows, chunk_size)]
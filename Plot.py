@@ -19,6 +19,7 @@ import matplotlib.path as mpath
 import matplotlib.pyplot as plt
 import matplotlib.colors as colors
 import matplotlib.cm as cmx
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from scipy.optimize import curve_fit
 import pickle
 import pdb
@@ -27,12 +28,110 @@ import cartopy
 import cartopy.crs as ccrs
 import cartopy.feature as cfeature
 
+import ClassProperties
+import Parallel
 import Print
 import time
 
-start_time = time.clock()
+start_time = time.perf_counter()
 
-def plotMapCircular(address, address_fronts, plotFronts, n_comp, allDF, colormap):
+#######################################################################
+
+# Figures are drawn as independent tasks (function, args, slices): slices
+# is a list of (array name, start, stop) rows of the plotting arrays,
+# appended to args when the figure is drawn. With n_workers > 1 the arrays
+# are put in shared memory and the figures drawn by a process pool (Agg)
+
+# plotting arrays by name (attached from shared memory inside a worker)
+plot_arrays = {}
+
+def plotWorkerInit(specs):
+    plt.switch_backend('Agg')
+    for name, spec in specs.items():
+        plot_arrays[name] = Parallel.attachSharedArray(spec)
+
+def plotTask(task):
+    function, args, slices = task
+    data = [plot_arrays[name][start:stop] for name, start, stop in slices]
+    function(*(tuple(args) + tuple(data)))
+    plt.close('all')
+
+def renderTasks(tasks, arrays, n_workers=1):
+    """ Draw every figure in tasks, serially or on a pool of n_workers """
+    if n_workers == 1:
+        plot_arrays.update(arrays)
+        try:
+            for task in tasks:
+                plotTask(task)
+        finally:
+            plot_arrays.clear()
+        return
+
+    shm_list, specs = [], {}
+    for name, array in arrays.items():
+        shm, shared, spec = Parallel.toSharedArray(np.ascontiguousarray(array))
+        shm_list.append(shm)
+        specs[name] = spec
+    pool = Parallel.makePool(n_workers, 1, plotWorkerInit, (specs,))
+    try:
+        for result in pool.imap_unordered(plotTask, tasks):
+            pass
+    finally:
+        pool.close()
+        pool.join()
+        Parallel.releaseSharedArrays(shm_list)
+
+#######################################################################
+
+def savePlot(fig, filename, fmt='pdf', dpi=200):
+    """ Save fig as filename.fmt (fmt = 'pdf', 'png', ...) and close it, so
+    that long plotting runs do not keep every figure in memory. dpi sets
+    the resolution of png output and of rasterised layers in a pdf """
+    fig.savefig(filename+"."+fmt, bbox_inches="tight", transparent=True, dpi=dpi)
+    plt.close(fig)
+
+#######################################################################
+
+# Gridded maps: instead of scattering (a thinned subset of) the profiles,
+# every profile is binned onto a grid x grid degree lat/lon grid and the
+# per-cell field drawn as one raster, so drawing time and file size depend
+# on the grid and not on the number of profiles
+
+def gridAggregate(lon, lat, values, grid, n_comp=None):
+    """ Per-cell mean of values, or with n_comp (values are then classes)
+    the most common class in each cell. Empty cells are NaN. Returns the
+    lon and lat cell edges and the (lat, lon) field """
+    n_lon = int(round(360.0/grid))
+    n_lat = int(round(180.0/grid))
+    n_cell = n_lat*n_lon
+    i_lon = np.clip(np.floor((lon + 180.0)/grid).astype(np.int64), 0, n_lon-1)
+    i_lat = np.clip(np.floor((lat + 90.0)/grid).astype(np.int64), 0, n_lat-1)
+    cell = i_lat*n_lon + i_lon
+
+    count = np.bincount(cell, minlength=n_cell)
+    if n_comp is None:
+        field = np.bincount(cell, weights=values, minlength=n_cell)/np.maximum(count, 1)
+    else:
+        counts = np.bincount(cell*n_comp + np.asarray(values, dtype=np.int64), \
+                             minlength=n_cell*n_comp).reshape(n_cell, n_comp)
+        field = np.argmax(counts, axis=1).astype(float)
+    field[count == 0] = np.nan
+
+    lon_edges = -180.0 + grid*np.arange(n_lon+1)
+    lat_edges = -90.0 + grid*np.arange(n_lat+1)
+    return lon_edges, lat_edges, field.reshape(n_lat, n_lon)
+
+def gridMesh(ax1, lon, lat, values, grid, n_comp=None, **kwargs):
+    """ Draw the gridAggregate field on a map (kwargs go to pcolormesh) """
+    lon_edges, lat_edges, field = gridAggregate(lon, lat, values, grid, n_comp)
+    CS = ax1.pcolormesh(lon_edges, lat_edges, np.ma.masked_invalid(field), \
+                        transform=ccrs.PlateCarree(), rasterized=True, **kwargs)
+    return CS, field
+
+#######################################################################
+
+def plotMapCircular(address, address_fronts, plotFronts, n_comp, allDF, colormap, \
+                    grid=None, index=None, fmt='pdf', rasterise=False):
     print("Plot.plotMapCircular")
     runIndex = None
 
@@ -45,17 +144,21 @@ def plotMapCircular(address, address_fronts, plotFronts, n_comp, allDF, colormap
 #   colorname = 'RdYlBu_r'
 #   colormap = plt.get_cmap(colorname,n_comp)
 
-    # select x, y, and color data    
-    surfaceDF = allDF[allDF.pressure == 15]
-    surfaceDF = surfaceDF[surfaceDF.posterior_probability >= threshold]
-    xplot = surfaceDF['longitude'].values
-    yplot = surfaceDF['latitude'].values
-    cplot = surfaceDF['class_sorted'].values
-
-    # subselect
-    xplot = xplot[::pskip]
-    yplot = yplot[::pskip]
-    cplot = cplot[::pskip]
+    # select x, y, and color data (15 dbar, above the threshold)
+    if index is None:
+        index = ClassProperties.plotIndex(allDF, n_comp)
+    rows = ClassProperties.profileRows(index, \
+             ClassProperties.thresholdProfiles(index, threshold), \
+             np.flatnonzero(index['depths'] == 15))
+    xplot = allDF['longitude'].values[rows]
+    yplot = allDF['latitude'].values[rows]
+    cplot = allDF['class_sorted'].values[rows]
+
+    # subselect (gridded maps use every profile)
+    if grid is None:
+        xplot = xplot[::pskip]
+        yplot = yplot[::pskip]
+        cplot = cplot[::pskip]
 
     # shift indices for plotting
     cplot = cplot + 1
@@ -64,12 +167,19 @@ def plotMapCircular(address, address_fronts, plotFronts, n_comp, allDF, colormap
     proj = ccrs.SouthPolarStereo()
     proj_trans = ccrs.PlateCarree()
     
-    # create plot axes
-    ax1 = plt.axes(projection=proj)
-
-    # create scatter plot 
-    CS = ax1.scatter(xplot, yplot, s = 2.0, lw = 0, c = cplot, \
-                     cmap=colormap, vmin = 0.5, vmax = n_comp + 0.5, transform = proj_trans)
+    # create plot axes (with gridlines and coastlines)
+    fig = plt.figure()
+    ax1 = mapAxes(fig, None, fmt, rasterise)
+
+    # create scatter plot, or map of the most common class in each cell
+    if grid is None:
+        CS = ax1.scatter(xplot, yplot, s = 2.0, lw = 0, c = cplot, \
+                         cmap=colormap, vmin = 0.5, vmax = n_comp + 0.5, transform = proj_trans, \
+                         rasterized = rasterise)
+    else:
+        # (cplot is already shifted to 1..n_comp)
+        CS, field = gridMesh(ax1, xplot, yplot, cplot, grid, n_comp + 1, \
+                             cmap=colormap, vmin = 0.5, vmax = n_comp + 0.5)
     
     # add fronts
     if plotFronts:
@@ -104,35 +214,94 @@ def plotMapCircular(address, address_fronts, plotFronts, n_comp, allDF, colormap
     ax1.set_boundary(circle, transform=ax1.transAxes)
  
     # Add features
-    ax1.gridlines()
 #    ax1.add_feature(cfeature.LAND)
-    ax1.coastlines()
     
-    colorbar = plt.colorbar(CS)
+    colorbar = fig.colorbar(CS, ax=ax1)
     cblabels = np.arange(1, int(n_comp)+1, 1)
 #   cblabels = np.arange(0, int(n_comp), 1)
     cbloc = cblabels
     colorbar.set_ticks(cbloc)
     colorbar.set_ticklabels(cblabels)
     colorbar.set_label('Class', rotation=270, labelpad=10)
-    plt.savefig(address+"Plots/Labels_Map_n"+str(n_comp)+\
-                ".pdf",bbox_inches="tight",transparent=True)
+    savePlot(fig, address+"Plots/Labels_Map_n"+str(n_comp), fmt)
 #   plt.show()
     
 #######################################################################
     
+# front polylines by address_fronts, read once per process
+front_cache = {}
+
 def loadFronts(address_fronts):
-    SAF, SACCF, SBDY, PF = None, None, None, None
-    SAF =   np.loadtxt(address_fronts+'saf_kim.txt')
-    SACCF = np.loadtxt(address_fronts+'saccf_kim.txt')
-    SBDY =  np.loadtxt(address_fronts+'sbdy_kim.txt')
-    PF =    np.loadtxt(address_fronts+'pf_kim.txt')
+    if address_fronts not in front_cache:
+        SAF, SACCF, SBDY, PF = None, None, None, None
+        SAF =   np.loadtxt(address_fronts+'saf_kim.txt')
+        SACCF = np.loadtxt(address_fronts+'saccf_kim.txt')
+        SBDY =  np.loadtxt(address_fronts+'sbdy_kim.txt')
+        PF =    np.loadtxt(address_fronts+'pf_kim.txt')
+        front_cache[address_fronts] = (SAF, SACCF, SBDY, PF)
     
-    return SAF, SACCF, SBDY, PF
+    return front_cache[address_fronts]
+
+#######################################################################
+
+# static map backgrounds by (extent, dpi), drawn once per process
+map_cache = {}
+
+def mapBackground(extent, dpi=200):
+    """ Gridlines and coastlines of the SouthPolarStereo map with the given
+    extent (lon/lat, None = global), drawn once on a transparent raster.
+    Returns the raster and its extent in projection coordinates """
+    key = (extent, dpi)
+    if key not in map_cache:
+        proj = ccrs.SouthPolarStereo()
+        fig = plt.figure(figsize=(6,6), dpi=dpi)
+        canvas = FigureCanvasAgg(fig)
+        ax = fig.add_axes([0, 0, 1, 1], projection=proj)
+        if extent is None:
+            ax.set_global()
+        else:
+            ax.set_extent(extent, crs=ccrs.PlateCarree())
+        # fill the whole raster, so pixels map linearly onto the limits
+        ax.set_aspect('auto')
+        ax.gridlines()
+        ax.coastlines()
+        ax.patch.set_visible(False)
+        ax.spines['geo'].set_visible(False)
+        fig.patch.set_alpha(0.0)
+        canvas.draw()
+        raster = np.asarray(canvas.buffer_rgba()).copy()
+        raster_extent = ax.get_xlim() + ax.get_ylim()
+        plt.close(fig)
+        map_cache[key] = (raster, raster_extent)
+    return map_cache[key]
+
+def mapAxes(fig, extent, fmt='pdf', rasterise=False):
+    """ SouthPolarStereo axes with gridlines and coastlines. When the figure
+    is rasterised anyway (png, or rasterise for the data layers) the cached
+    background raster is drawn (above the data, as the vector coastlines
+    would be) instead of projecting the coastlines again; a pdf without
+    rasterise keeps vector coastlines and gridlines """
+    proj = ccrs.SouthPolarStereo()
+    ax1 = fig.add_subplot(1, 1, 1, projection=proj)
+    if extent is not None:
+        ax1.set_extent(extent, crs=ccrs.PlateCarree())
+    if fmt != 'pdf' or rasterise:
+        raster, raster_extent = mapBackground(extent)
+        ax1.imshow(raster, extent=raster_extent, transform=proj, \
+                   origin='upper', interpolation='nearest', zorder=1.5)
+        if extent is None:
+            ax1.set_global()
+        else:
+            ax1.set_extent(extent, crs=ccrs.PlateCarree())
+    else:
+        ax1.gridlines()
+        ax1.coastlines()
+    return ax1
 
 #######################################################################
 
-def plotByDynHeight(address, address_fronts, runIndex, n_comp, allDF, colormap):
+def plotByDynHeight(address, address_fronts, runIndex, n_comp, allDF, colormap, \
+                    index=None, fmt='pdf', rasterise=False):
 
     # print function name 
     print("Plot.plotByDynHeight")
@@ -146,9 +315,12 @@ def plotByDynHeight(address, address_fronts, runIndex, n_comp, allDF, colormap):
 #   colorname = 'RdYlBu_r'
 #   colormap = plt.get_cmap(colorname,n_comp)
 
-    # select points for plotting 
-    surfaceDF = allDF[allDF['depth_index']==0].dropna()
-    surfaceDF = surfaceDF[surfaceDF.posterior_probability >= threshold]
+    # select points for plotting (surface, above the threshold)
+    if index is None:
+        index = ClassProperties.plotIndex(allDF, n_comp)
+    rows = ClassProperties.profileRows(index, \
+             ClassProperties.thresholdProfiles(index, threshold), 0)
+    surfaceDF = allDF.iloc[rows].dropna()
     xplot = surfaceDF['longitude'].values
     yplot = surfaceDF['dynamic_height'].values
     cplot = surfaceDF['class_sorted'].values
@@ -165,11 +337,11 @@ def plotByDynHeight(address, address_fronts, runIndex, n_comp, allDF, colormap):
     cplot = cplot + 1
 
     # next, plot all classes on single plot
-    plt.figure(figsize=(5,5))
+    fig = plt.figure(figsize=(5,5))
 
     # scatter plot
     CS = plt.scatter(xplot, yplot, s = 2.0, c = cplot, cmap = colormap, \
-                     vmin = 0.5, vmax = n_comp+0.5, lw = 0)
+                     vmin = 0.5, vmax = n_comp+0.5, lw = 0, rasterized = rasterise)
     plt.xlim((-180, 180)) 
     plt.ylim((2.0, 18.0)) 
     plt.xlabel('Longitude')
@@ -192,15 +364,38 @@ def plotByDynHeight(address, address_fronts, runIndex, n_comp, allDF, colormap):
     colorbar.set_label('Class', rotation=270, labelpad=10)
 
     # save figure
-    plt.savefig(address+"Plots/classes_dynHeight_single.pdf",bbox_inches="tight",transparent=True) 
+    savePlot(fig, address+"Plots/classes_dynHeight_single", fmt)
     #lt.show()
 
 ###############################################################################
 
-def plotPosterior(address, address_fronts, runIndex, n_comp, plotFronts, allDF):
+def plotPosterior(address, address_fronts, runIndex, n_comp, plotFronts, allDF, \
+                  n_workers=1, grid=None, index=None, fmt='pdf', rasterise=False):
 
     print("Plot.plotPosterior")
 
+    # just select the surface, rows sorted by class
+    if index is None:
+        index = ClassProperties.plotIndex(allDF, n_comp)
+    rows = ClassProperties.profileRows(index, index['class_order'], 0)
+    offsets = index['class_offsets']
+    arrays = {'lon': allDF['longitude'].values[rows], \
+              'lat': allDF['latitude'].values[rows], \
+              'prob': allDF['posterior_probability'].values[rows]}
+
+    # one map per class
+    tasks = []
+    for k in range(0,n_comp):
+        slices = [(name, offsets[k], offsets[k+1]) for name in ['lon','lat','prob']]
+        tasks.append((plotPosteriorClass, (address, address_fronts, k, n_comp, \
+                      plotFronts, grid, index['bucket_counts'][k], fmt, rasterise), slices))
+    renderTasks(tasks, arrays, n_workers)
+
+def plotPosteriorClass(address, address_fronts, k, n_comp, plotFronts, grid, \
+                       ncount, fmt, rasterise, lon_k, lat_k, prob_k):
+
+    print(k)
+
     # threshold
     nsub = 5
 
@@ -220,149 +415,132 @@ def plotPosterior(address, address_fronts, runIndex, n_comp, plotFronts, allDF):
 #   norm = mpl.colors.Normalize(vmin=0.0, vmax=1.0)
     norm = mpl.colors.BoundaryNorm(bounds, cmap.N)
 
-    # just select the surface
-    surfaceDF = allDF[allDF['depth_index']==0]
+    likelihood = prob_k
 
-    # loop over index, make some plots
-    for k in range(0,n_comp):
-        print(k)
-        lon_k = surfaceDF[surfaceDF.class_sorted == k]['longitude']
-        lat_k = surfaceDF[surfaceDF.class_sorted == k]['latitude']
-        prob_k = surfaceDF[surfaceDF.class_sorted ==k]['posterior_probability']
-        likelihood = prob_k
-
-        # calculate numbers of pirofiles in each
-        ncount = np.zeros(4,)
-        ntotal = 0
-        pp = likelihood.values
-        for nprof in range(0,pp.size):
-            ntotal = ntotal + 1
-            if pp[nprof]<=0.50:
-                ncount[0] = ncount[0] + 1
-            elif pp[nprof]<=0.75:
-                ncount[1] = ncount[1] + 1
-            elif pp[nprof]<=0.90:
-                ncount[2] = ncount[2] + 1
-            elif pp[nprof]<=1.00:
-                ncount[3] = ncount[3] + 1
-
-        ncount_pct = 100*ncount/ntotal
-  
-        # print
-        print('number in each pp range (0.0 <= 0.50 <= 0.75 <= 0.90 <= 1.0)')
-        print(ncount)
-        print('scaled by total in this class')
-        print(ncount_pct)
-     
-        # subselect
-        xplot = lon_k[::nsub]
-        yplot = lat_k[::nsub]
-        cplot = likelihood[::nsub]
-
-        # projection
-        proj = ccrs.SouthPolarStereo()
-        proj_trans = ccrs.PlateCarree()
-        ax1 = plt.axes(projection=proj)
-        ax1.set_extent((-180,180,-90,-30),crs=proj_trans)
+    # numbers of profiles in each posterior range (precomputed in the index)
+    ntotal = likelihood.size
+    ncount_pct = 100*ncount/ntotal
+
+    # print
+    print('number in each pp range (0.0 <= 0.50 <= 0.75 <= 0.90 <= 1.0)')
+    print(ncount)
+    print('scaled by total in this class')
+    print(ncount_pct)
+ 
+    # subselect (gridded maps use every profile)
+    if grid is not None:
+        nsub = 1
+    xplot = lon_k[::nsub]
+    yplot = lat_k[::nsub]
+    cplot = likelihood[::nsub]
+
+    # projection
+    proj = ccrs.SouthPolarStereo()
+    proj_trans = ccrs.PlateCarree()
+    fig = plt.figure()
+    ax1 = mapAxes(fig, (-180,180,-90,-30), fmt, rasterise)
+    if grid is None:
         CS = ax1.scatter(xplot , yplot, s = 3.0, lw = 0, c = cplot, \
-                         cmap = cmap, transform = proj_trans)
-        cb3 = mpl.colorbar.ColorbarBase(plt.gca(), \
-                                        cmap=cmap, \
-                                        norm=norm, \
-                                        ticks=bounds, \
-                                        spacing='uniform', \
-                                        orientation='vertical')
-        cb3.ax.tick_params(labelsize=22)
-        print(cb3.ax.viewLim)
-        # plot fronts 
-        if plotFronts:
-            SAF, SACCF, SBDY, PF = None, None, None, None
-            SAF, SACCF, SBDY, PF = loadFronts(address_fronts)  
-            ax1.plot(PF[:,0], PF[:,1], lw = 1,ls='-', label='PF', \
-                     color='grey', transform=proj_trans) 
-
-        # compute a circle in axes coordinates, which we can use as a boundary for the map.
-        theta = np.linspace(0, 2*np.pi, 100)
-        center = [0.5, 0.5]
-        radius = 0.52   # 0.46 corresponds to roughly 30S Latitude
-        verts = np.vstack([np.sin(theta), np.cos(theta)]).T
-        circle = mpath.Path(verts * radius + center)
-        ax1.set_boundary(circle, transform=ax1.transAxes)
-
-        # add features
-        ax1.gridlines()
-        ax1.coastlines()
-        ax1.set_extent((-180,180,-90,-30),crs=proj_trans)
+                         cmap = cmap, norm = norm, transform = proj_trans, \
+                         rasterized = rasterise)
+    else:
+        # mean posterior probability of the class in each cell
+        CS, field = gridMesh(ax1, xplot, yplot, cplot, grid, cmap = cmap, norm = norm)
+    # (colorbar in its own axes, beside the map)
+    cb3 = fig.colorbar(CS, ax=ax1, \
+                       ticks=bounds, \
+                       spacing='uniform', \
+                       orientation='vertical')
+    cb3.ax.tick_params(labelsize=22)
+    print(cb3.ax.viewLim)
+    # plot fronts 
+    if plotFronts:
+        SAF, SACCF, SBDY, PF = None, None, None, None
+        SAF, SACCF, SBDY, PF = loadFronts(address_fronts)  
+        ax1.plot(PF[:,0], PF[:,1], lw = 1,ls='-', label='PF', \
+                 color='grey', transform=proj_trans) 
 
-#       plt.text(0, 1, "Class "+str(k+1), transform = ax1.transAxes)
+    # compute a circle in axes coordinates, which we can use as a boundary for the map.
+    theta = np.linspace(0, 2*np.pi, 100)
+    center = [0.5, 0.5]
+    radius = 0.52   # 0.46 corresponds to roughly 30S Latitude
+    verts = np.vstack([np.sin(theta), np.cos(theta)]).T
+    circle = mpath.Path(verts * radius + center)
+    ax1.set_boundary(circle, transform=ax1.transAxes)
 
-        # show plot
-        plt.savefig(address+"Plots/v3_PostProb_Class"+str(k)+\
-                    "_n"+str(n_comp)+".pdf",bbox_inches="tight",transparent=True)
-#       plt.show()
-        ax1.clear()
+    ax1.set_extent((-180,180,-90,-30),crs=proj_trans)
+
+#   plt.text(0, 1, "Class "+str(k+1), transform = ax1.transAxes)
+
+    # show plot
+    savePlot(fig, address+"Plots/v3_PostProb_Class"+str(k)+"_n"+str(n_comp), fmt)
+#   plt.show()
 
 ###############################################################################
 
-def plotProfilesByClass(address, runIndex, n_comp, allDF, colormap):
+def plotProfilesByClass(address, runIndex, n_comp, allDF, colormap, n_workers=1, \
+                        index=None, fmt='pdf'):
 
     # print
     print('Plot.plotProfilesByClass')
 
+    # (profile, depth) temperature, profiles sorted by class
+    if index is None:
+        index = ClassProperties.plotIndex(allDF, n_comp)
+    offsets = index['class_offsets']
+    arrays = {'temperature': allDF['temperature'].values.reshape(-1, \
+                             index['n_depths'])[index['class_order']]}
+
+    # loop through all classes, get mean/std temperature of profiles
+    tasks = []
+    for k in range(0,n_comp):
+        slices = [('temperature', offsets[k], offsets[k+1])]
+        tasks.append((plotProfilesOfClass, \
+                      (address, k, n_comp, colormap, index['depths'], fmt), slices))
+    renderTasks(tasks, arrays, n_workers)
+
+def plotProfilesOfClass(address, k, n_comp, colormap, P, fmt, T_k):
+
     # set dimensions of plot
     w = 6
     h = 12 
 
-    # plot the data in map form - individual
-    # now passed in as an external argument
-#   colorname = 'RdYlBu_r'
-#   colormap = plt.get_cmap(colorname,n_comp)
-
     # get colors for plots
     cNorm = colors.Normalize(vmin=0, vmax=n_comp)
     scalarMap = cmx.ScalarMappable(norm=cNorm, cmap=colormap)
 
-    # loop through all classes, get mean/std temperature of profiles
-    for k in range(0,n_comp):
-
-        # create figure
-        fig = plt.figure(figsize=(7,7))
-
-        # select color for plot
-        colorVal = scalarMap.to_rgba(k)
- 
-        # select all profiles from class k
-        class_k_DF = allDF[ allDF['class_sorted'] == k ]
-
-        # calculate statistics of those profiles at each pressure level
-        Tmean = class_k_DF.groupby(['depth_index'])['temperature'].mean().values
-        Tmedian = class_k_DF.groupby(['depth_index'])['temperature'].median().values
-        Tsig = class_k_DF.groupby(['depth_index'])['temperature'].std().values
-        P = class_k_DF.groupby(['depth_index'])['pressure'].mean().values 
-
-        # create plot
-        plt.plot(Tmean, P, color=colorVal, linestyle='solid', linewidth=5.0)
-        plt.plot(Tmean-Tsig, P, color=colorVal, linestyle='dashed', linewidth=5.0)
-        plt.plot(Tmean+Tsig, P, color=colorVal, linestyle='dashed', linewidth=5.0)
-
-        # invert axes
-        ax = plt.gca()
-        ax.set_ylim(0,1000)
-        ax.set_xlim(-2,25)
-        ax.grid(alpha=0.2)
-        ax.invert_yaxis()
-        ax.set_xlabel('Temperature (°C)')
-        ax.set_ylabel('Pressure (dbar)')
-
-        # save and show the plot 
-        plt.savefig(address + 'Plots/Tprof_by_pressure_class' + \
-                    str(k).zfill(3) + '.pdf', bbox_inches="tight", \
-                    transparent=True)
-#       plt.show()
+    # create figure
+    fig = plt.figure(figsize=(7,7))
+
+    # select color for plot
+    colorVal = scalarMap.to_rgba(k)
+
+    # calculate statistics of the class k profiles at each pressure level
+    Tmean = np.nanmean(T_k, axis=0, dtype=np.float64)
+    Tmedian = np.nanmedian(T_k, axis=0)
+    Tsig = np.nanstd(T_k, axis=0, dtype=np.float64, ddof=1)
+
+    # create plot
+    plt.plot(Tmean, P, color=colorVal, linestyle='solid', linewidth=5.0)
+    plt.plot(Tmean-Tsig, P, color=colorVal, linestyle='dashed', linewidth=5.0)
+    plt.plot(Tmean+Tsig, P, color=colorVal, linestyle='dashed', linewidth=5.0)
+
+    # invert axes
+    ax = plt.gca()
+    ax.set_ylim(0,1000)
+    ax.set_xlim(-2,25)
+    ax.grid(alpha=0.2)
+    ax.invert_yaxis()
+    ax.set_xlabel('Temperature (°C)')
+    ax.set_ylabel('Pressure (dbar)')
+
+    # save and show the plot 
+    savePlot(fig, address + 'Plots/Tprof_by_pressure_class' + str(k).zfill(3), fmt)
+#   plt.show()
 
 ###############################################################################
 
-def plotProfileClass(address, runIndex, n_comp, space, allDF, colormap):
+def plotProfileClass(address, runIndex, n_comp, space, allDF, colormap, fmt='pdf'):
 
     # space will be 'depth', 'reduced' or 'uncentred'
     print("Plot.plotProfileClass "+str(space))
@@ -406,14 +584,14 @@ def plotProfileClass(address, runIndex, n_comp, space, allDF, colormap):
     ax1.grid(True)
     ax1.legend(loc='best')
     #ax1.set_title("Class Profiles with Depth in SO - "+space)
-    filename = address+"Plots/Class_Profiles_"+space+"_n"+str(n_comp)+".pdf"  
-    plt.savefig(filename,bbox_inches="tight",transparent=True)
+    filename = address+"Plots/Class_Profiles_"+space+"_n"+str(n_comp)
+    savePlot(fig, filename, fmt)
 #   plt.show()
 
 ###############################################################################
 ###############################################################################
 
-def plotProfile(address, runIndex, space): # Uses traing profiles at the moment
+def plotProfile(address, runIndex, space, fmt='pdf', rasterise=False): # Uses traing profiles at the moment
         # space will be 'depth', 'original' or 'uncentred'
     print("Plot.plotProfileClass "+str(space))
     # Load depth
@@ -449,7 +627,8 @@ def plotProfile(address, runIndex, space): # Uses traing profiles at the moment
     
     fig, ax1 = plt.subplots()
     for d in range(np.ma.size(X_profiles, axis=0)):
-        ax1.plot(X_profiles[d,:], depth_array, lw = 1, alpha = 0.01, color = 'grey')
+        ax1.plot(X_profiles[d,:], depth_array, lw = 1, alpha = 0.01, color = 'grey', \
+                 rasterized = rasterise)
         
     if space == 'depth':
         ax1.set_xlabel("Normalized Temperature Anomaly /degree")
@@ -463,13 +642,13 @@ def plotProfile(address, runIndex, space): # Uses traing profiles at the moment
     #ax1.set_title("Profiles with Depth in SO - "+space)
     ax1.set_xlabel("Temperature /degrees")
     ax1.set_ylabel("Depth /dbar")
-    filename = address+"Plots/Profiles_"+space+".pdf"  
-    plt.savefig(filename,bbox_inches="tight",transparent=True)
+    filename = address+"Plots/Profiles_"+space
+    savePlot(fig, filename, fmt)
 #   plt.show()
     
 ###############################################################################
 
-def plotPCAcomponents(address, runIndex, n_comp):
+def plotPCAcomponents(address, runIndex, n_comp, fmt='pdf'):
 
     # space will be 'depth', 'reduced' or 'uncentred'
     print("Plot.plotPCAcomponents")
@@ -478,7 +657,7 @@ def plotPCAcomponents(address, runIndex, n_comp):
     pressures = Print.readDepth(address, runIndex) 
 
     # read PCA object
-    with open('../Objects/PCA_object.pkl','rb') as input:
+    with open(address+'Objects/PCA_object.pkl','rb') as input:
         pca_object = pickle.load(input)
 
     # get number of components
@@ -492,17 +671,26 @@ def plotPCAcomponents(address, runIndex, n_comp):
     scalarMap = cmx.ScalarMappable(norm = cNorm, cmap = colormap) 
     colorVal = scalarMap.to_rgba
 
-    # line plot
+    # line plot, one figure per component
     for k in range(0, n_pca_comp):
         fig = plt.figure(figsize=(7,7))
         x = np.transpose(pca_comp[k])
         y = pressures
         plt.plot(x, y, color=colorVal(k), linestyle='solid', linewidth=5.0)
-        plt.show()
+
+        # axis
+        ax = plt.gca()
+        ax.set_ylabel("Pressure (dbar)")
+        ax.invert_yaxis()
+        ax.grid(True)
+
+        # save figure
+        savePlot(fig, address+"Plots/PCA_components" + str(k).zfill(2), fmt)
 
 ###############################################################################
 
-def plotGaussiansIndividual(address, runIndex, n_comp, space, allDF, Nbins, colormap):
+def plotGaussiansIndividual(address, runIndex, n_comp, space, allDF, Nbins, colormap, \
+                            fmt='pdf', rasterise=False):
 
     # space will be 'depth', 'reduced' or 'uncentred'
     print("Plot.plotGaussiansIndividual "+str(space))
@@ -561,13 +749,6 @@ def plotGaussiansIndividual(address, runIndex, n_comp, space, allDF, Nbins, colo
     gmm_weights, gmm_means, gmm_covariances = Print.readGMMclasses(address,\
                                                         runIndex, depth_array, space)
 
-#   if space == 'uncentred':
-#       stand = None
-#       with open(address+"Objects/Scale_object.pkl", 'rb') as input:
-#           stand = pickle.load(input)
-#       gmm_means = stand.inverse_transform(gmm_means)
-#       gmm_covariances = stand.inverse_transform(gmm_covariances)
-    
     print("shapes: ", gmm_weights.shape, gmm_means.shape, gmm_covariances.shape)
     print("depth_array_mod.shape = ", depth_array_mod.shape)
     
@@ -584,7 +765,8 @@ def plotGaussiansIndividual(address, runIndex, n_comp, space, allDF, Nbins, colo
             X_row = X_train[:,int(depth_array_mod[i])]
         means_row, cov_row = None, None
         means_row = gmm_means[:,int(depth_array_mod[i])]
-        cov_row = abs(gmm_covariances[:,int(depth_array_mod[i])])
+        # per-depth class variance (diagonal of the back-projected covariance)
+        cov_row = gmm_covariances[:,int(depth_array_mod[i])]
 #       print("Covariance = ", cov_row)
         
         xmax, xmin = None, None
@@ -616,7 +798,8 @@ def plotGaussiansIndividual(address, runIndex, n_comp, space, allDF, Nbins, colo
         
         ax1.plot(x_values, np.sum(y_total,axis=0), lw = 2, color = 'black', \
                  label="Overall", linestyle='dashed')
-        ax1.hist(X_row, bins=Nbins, normed=True, facecolor='grey', lw = 0)
+        ax1.hist(X_row, bins=Nbins, normed=True, facecolor='grey', lw = 0, \
+                 rasterized = rasterise)
         ax1.set_ylabel("Probability density")
         ax1.set_xlabel("Normalized temperature anomaly")
         if space == 'reduced':
@@ -634,16 +817,15 @@ def plotGaussiansIndividual(address, runIndex, n_comp, space, allDF, Nbins, colo
         if i==0:
             ax1.legend(loc='best')
 
-        plt.savefig(address+\
-                    "Plots/TrainHisto_Gaussians_n"+\
-                    str(n_comp)+"_"+\
-                    space+str(int((depth_array[depth_array_mod[i]])))+\
-                    ".pdf",bbox_inches="tight",transparent=True)
+        savePlot(fig, address+\
+                 "Plots/TrainHisto_Gaussians_n"+\
+                 str(n_comp)+"_"+\
+                 space+str(int((depth_array[depth_array_mod[i]]))), fmt)
 #       plt.show()
    
 ###############################################################################    
 
-def plotBIC(address, repeat_bic, max_groups, trend=False): 
+def plotBIC(address, repeat_bic, max_groups, trend=False, fmt='pdf'): 
     # Load the data and define variables first
     bic_many, bic_mean, bic_stdev, n_mean, n_stdev, n_min = None, None, None, None, None, None
     bic_many, bic_mean, bic_stdev, n_mean, n_stdev, n_min = Print.readBIC(address, repeat_bic)
@@ -686,18 +868,18 @@ def plotBIC(address, repeat_bic, max_groups, trend=False):
     ax1.set_xlabel("Number of classes (k)")
     ax1.grid(True)
     ax1.set_title("BIC values for GMM with different numbers of classes")
-    ax1.set_ylim(min(bic_mean)*0.97, min(bic_mean)*1.07)
+    ax1.set_ylim(np.nanmin(bic_mean)*0.97, np.nanmin(bic_mean)*1.07)
     ax1.legend(loc='best')
     if trend:
-        plt.savefig(address+"Plots/BIC_trend.pdf",bbox_inches="tight",transparent=True)
+        savePlot(fig, address+"Plots/BIC_trend", fmt)
     else:
-        plt.savefig(address+"Plots/BIC_revision2.pdf",bbox_inches="tight",transparent=True)
+        savePlot(fig, address+"Plots/BIC_revision2", fmt)
 #   plt.show()
     
 ###############################################################################
 # Use the VBGMM to determine how many classes we should use in the GMM
 
-def plotWeights(address, runIndex):
+def plotWeights(address, runIndex, fmt='pdf'):
 
     # load depth
     depth = None
@@ -721,12 +903,12 @@ def plotWeights(address, runIndex):
     ax1.grid(True)
     ax1.set_title("VBGMM class weights")
     ax1.legend(loc='best')
-    plt.savefig(address+"Plots/Weights_VBGMM.pdf", bbox_inches="tight",transparent=True)
+    savePlot(fig, address+"Plots/Weights_VBGMM", fmt)
     
 ###############################################################################
 # New function to plot the eigenvectors
 
-def plotEigenvectors(address, runIndex, allDF):
+def plotEigenvectors(address, runIndex, allDF, n_workers=1, fmt='pdf'):
     
     # load reduced depth
     depth = None
@@ -754,82 +936,85 @@ def plotEigenvectors(address, runIndex, allDF):
 #       Tmean_plus_PC[m] = Tmean + pca_comp_unstand[m]
 #       Tmean_minus_PC[m] = Tmean - pca_comp_unstand[m]    
 
-    #depths = (5 * (np.arange(np.ma.size(pca_components, axis=1)) )) + 15
+    # centred, uncentred and uncentred plus/minus the mean profile
+    # (the eigenvectors are small, so they are passed with each task)
+    tasks = []
     for i in range(np.ma.size(pca_comp, axis=0)):
+        tasks.append((plotEigenvectorCentred, (address, i, depth, pca_comp[i,:], fmt), []))
+    for i in range(np.ma.size(pca_comp_unstand, axis=0)):
+        tasks.append((plotEigenvectorUncentred, \
+                      (address, i, depth, pca_comp_unstand[i,:], fmt), []))
+    for i in range(np.ma.size(pca_comp_unstand, axis=0)):
+        tasks.append((plotEigenvectorWithMean, \
+                      (address, i, depth, Tmean, pca_comp_unstand[i], fmt), []))
+    renderTasks(tasks, {}, n_workers)
 
-        fig = plt.figure(figsize=(7,7))
+def plotEigenvectorCentred(address, i, depth, pca_comp_i, fmt='pdf'):
 
-        # create plot
-        plt.plot(pca_comp[i,:], depth, linewidth=2.0, color='black')
+    fig = plt.figure(figsize=(7,7))
 
-        # axis
-        ax = plt.gca()
-        ax.set_ylabel("Pressure (dbar)")
-#       ax.set_xlabel("Centred Eigenvector Coefficient")
-        ax.invert_yaxis()
-        ax.grid(True)
-#       ax.legend(loc='best')
+    # create plot
+    plt.plot(pca_comp_i, depth, linewidth=2.0, color='black')
 
-        # save figure
-        plt.savefig(address+"Plots/PCA_Eigenvectors_centred" + str(i).zfill(2)  + \
-                    ".pdf",bbox_inches="tight",transparent=True)
-        plt.show()
-    
-    # plot uncentred
-    #depths = (5 * (np.arange(np.ma.size(pca_components, axis=1)) )) + 15
-    for i in range(np.ma.size(pca_comp_unstand, axis=0)):
+    # axis
+    ax = plt.gca()
+    ax.set_ylabel("Pressure (dbar)")
+#   ax.set_xlabel("Centred Eigenvector Coefficient")
+    ax.invert_yaxis()
+    ax.grid(True)
+#   ax.legend(loc='best')
 
-        fig = plt.figure(figsize=(7,7))
+    # save figure
+    savePlot(fig, address+"Plots/PCA_Eigenvectors_centred" + str(i).zfill(2), fmt)
 
-        # create plot
-        plt.plot(pca_comp_unstand[i,:], depth, linewidth=2.0, color='black')
+def plotEigenvectorUncentred(address, i, depth, pca_comp_unstand_i, fmt='pdf'):
 
-        # fix axes
-        ax = plt.gca()
-        ax.set_xlim(3,10)
-        ax.set_ylim(0,1000)
-        ax.set_ylabel("Pressure (dbar)")
-#       ax.set_xlabel("Eigenvector Coefficient")
-        ax.invert_yaxis()
-        ax.grid(True)
-#       ax.legend(loc='best')
+    fig = plt.figure(figsize=(7,7))
 
-        # save figures
-        plt.savefig(address+"Plots/PCA_Eigenvectors_uncentred" + str(i).zfill(2) + \
-                    ".pdf",bbox_inches="tight",transparent=True)
-        plt.show()
+    # create plot
+    plt.plot(pca_comp_unstand_i, depth, linewidth=2.0, color='black')
 
-    # plot uncentred plus/minus the profiles
-    #depths = (5 * (np.arange(np.ma.size(pca_components, axis=1)) )) + 15
-    for i in range(np.ma.size(pca_comp_unstand, axis=0)):
+    # fix axes
+    ax = plt.gca()
+    ax.set_xlim(3,10)
+    ax.set_ylim(0,1000)
+    ax.set_ylabel("Pressure (dbar)")
+#   ax.set_xlabel("Eigenvector Coefficient")
+    ax.invert_yaxis()
+    ax.grid(True)
+#   ax.legend(loc='best')
 
-        fig = plt.figure(figsize=(7,7))
+    # save figures
+    savePlot(fig, address+"Plots/PCA_Eigenvectors_uncentred" + str(i).zfill(2), fmt)
 
-        # create plot
-        yp = Tmean + pca_comp_unstand[i]
-        ym = Tmean - pca_comp_unstand[i]
-        plt.plot(yp, depth, linewidth=1.0, color='black', linestyle='--')
-        plt.plot(Tmean, depth, linewidth=2.0, color='black', linestyle='-')
-        plt.plot(ym, depth, linewidth=1.0, color='black', linestyle='--')
+def plotEigenvectorWithMean(address, i, depth, Tmean, pca_comp_unstand_i, fmt='pdf'):
 
-        # fix axes
-        ax = plt.gca()
-        ax.set_xlim(0,20)
-        ax.set_ylim(0,1000)
-        ax.set_ylabel("Pressure (dbar)")
-#       ax.set_xlabel("Eigenvector Coefficient")
-        ax.invert_yaxis()
-        ax.grid(True)
-#       ax.legend(loc='best')
+    fig = plt.figure(figsize=(7,7))
+
+    # create plot
+    yp = Tmean + pca_comp_unstand_i
+    ym = Tmean - pca_comp_unstand_i
+    plt.plot(yp, depth, linewidth=1.0, color='black', linestyle='--')
+    plt.plot(Tmean, depth, linewidth=2.0, color='black', linestyle='-')
+    plt.plot(ym, depth, linewidth=1.0, color='black', linestyle='--')
+
+    # fix axes
+    ax = plt.gca()
+    ax.set_xlim(0,20)
+    ax.set_ylim(0,1000)
+    ax.set_ylabel("Pressure (dbar)")
+#   ax.set_xlabel("Eigenvector Coefficient")
+    ax.invert_yaxis()
+    ax.grid(True)
+#   ax.legend(loc='best')
 
-        # save figures
-        plt.savefig(address+"Plots/PCA_Eigenvectors_withMean" + str(i).zfill(2) + \
-                    ".pdf",bbox_inches="tight",transparent=True)
-        plt.show()
+    # save figures
+    savePlot(fig, address+"Plots/PCA_Eigenvectors_withMean" + str(i).zfill(2), fmt)
 
 ###########
 
-def plotPCAmplitudeCoefficients(address, address_fronts, runIndex):
+def plotPCAmplitudeCoefficients(address, address_fronts, runIndex, n_workers=1, \
+                                grid=None, fmt='pdf', rasterise=False):
 
     # color maps
     colorname = 'RdBu_r'
@@ -842,63 +1027,76 @@ def plotPCAmplitudeCoefficients(address, address_fronts, runIndex):
     [lon, lat, dynHeight, X_array, varTime] = None, None, None, None, None
     [lon, lat, dynHeight, X_array, varTime] = Print.readPCAFromFile(address, runIndex, col_reduced=6)
 
-    # subsample
+    # subsample (one row of amplitude per PC, gridded maps use every profile)
     nsub = 10
-    xplot = lon[::nsub]
-    yplot = lat[::nsub]
+    if grid is not None:
+        nsub = 1
+    arrays = {'lon': lon[::nsub], 'lat': lat[::nsub], \
+              'amplitude': X_array[::nsub,:].T}
+    n_plot = arrays['lon'].size
 
     # make some maps
+    tasks = []
     for k in range(0,col_reduced):
+        slices = [('lon', 0, n_plot), ('lat', 0, n_plot), ('amplitude', k, k+1)]
+        tasks.append((plotPCAmplitudeMap, (address, address_fronts, k, colormap, grid, \
+                      fmt, rasterise), slices))
+    renderTasks(tasks, arrays, n_workers)
 
-        cplot = X_array[:,k]
-        cplot = cplot[::nsub]
+def plotPCAmplitudeMap(address, address_fronts, k, colormap, grid, fmt, rasterise, \
+                       xplot, yplot, cplot):
 
-        pmax = np.max([np.abs(np.min(cplot)), np.max(cplot)])
-        pmin = -1.0*pmax
+    cplot = cplot[0,:]
 
-        proj = ccrs.SouthPolarStereo()
-        proj_trans = ccrs.PlateCarree()
+    # symmetric colour range about zero (of the cell means in grid mode,
+    # set once gridMesh has aggregated them)
+    pmax = np.max([np.abs(np.min(cplot)), np.max(cplot)])
+    pmin = -1.0*pmax
 
-        ax1 = plt.axes(projection=proj)
-        ax1.set_extent((-180,180,-90,-30),crs=proj_trans)
+    proj = ccrs.SouthPolarStereo()
+    proj_trans = ccrs.PlateCarree()
 
-        CS = ax1.scatter(xplot, yplot, s = 3.0, lw = 0, c = cplot, \
-                         cmap = colormap, transform = proj_trans, vmin = pmin, vmax = pmax)
+    fig = plt.figure()
+    ax1 = mapAxes(fig, (-180,180,-90,-30), fmt, rasterise)
 
-        # plot fronts 
-        SAF, SACCF, SBDY, PF = None, None, None, None
-        SAF, SACCF, SBDY, PF = loadFronts(address_fronts)  
-        ax1.plot(SAF[:,0], SAF[:,1], lw = 1, ls='-', label='SAF', \
-                 color='black', transform=proj_trans)
-        ax1.plot(PF[:,0], PF[:,1], lw = 1,ls='-', label='PF', \
-                 color='grey', transform=proj_trans)
-        ax1.plot(SACCF[:,0], SACCF[:,1], lw = 1,ls='-', label='SACCF', \
-                 color='green', transform=proj_trans)
-        ax1.plot(SBDY[:,0], SBDY[:,1], lw = 1,ls='-', label='SBDY', \
-                 color='blue', transform=proj_trans)
+    if grid is None:
+        CS = ax1.scatter(xplot, yplot, s = 3.0, lw = 0, c = cplot, \
+                         cmap = colormap, transform = proj_trans, vmin = pmin, vmax = pmax, \
+                         rasterized = rasterise)
+    else:
+        CS, field = gridMesh(ax1, xplot, yplot, cplot, grid, cmap = colormap)
+        pmax = np.nanmax(np.abs(field))
+        CS.set_clim(-1.0*pmax, pmax)
 
-        # compute a circle in axes coordinates, which we can use as a boundary for the map.
-        theta = np.linspace(0, 2*np.pi, 100)
-        center = [0.5, 0.5]
-        radius = 0.52   # 0.46 corresponds to roughly 30S Latitude
-        verts = np.vstack([np.sin(theta), np.cos(theta)]).T
-        circle = mpath.Path(verts * radius + center)
-        ax1.set_boundary(circle, transform=ax1.transAxes)
+    # plot fronts 
+    SAF, SACCF, SBDY, PF = None, None, None, None
+    SAF, SACCF, SBDY, PF = loadFronts(address_fronts)  
+    ax1.plot(SAF[:,0], SAF[:,1], lw = 1, ls='-', label='SAF', \
+             color='black', transform=proj_trans)
+    ax1.plot(PF[:,0], PF[:,1], lw = 1,ls='-', label='PF', \
+             color='grey', transform=proj_trans)
+    ax1.plot(SACCF[:,0], SACCF[:,1], lw = 1,ls='-', label='SACCF', \
+             color='green', transform=proj_trans)
+    ax1.plot(SBDY[:,0], SBDY[:,1], lw = 1,ls='-', label='SBDY', \
+             color='blue', transform=proj_trans)
+
+    # compute a circle in axes coordinates, which we can use as a boundary for the map.
+    theta = np.linspace(0, 2*np.pi, 100)
+    center = [0.5, 0.5]
+    radius = 0.52   # 0.46 corresponds to roughly 30S Latitude
+    verts = np.vstack([np.sin(theta), np.cos(theta)]).T
+    circle = mpath.Path(verts * radius + center)
+    ax1.set_boundary(circle, transform=ax1.transAxes)
 
-        # add features
-        ax1.gridlines()
-        ax1.coastlines()
-        ax1.set_extent((-180,180,-90,-30),crs=proj_trans)
+    ax1.set_extent((-180,180,-90,-30),crs=proj_trans)
 
-        # plot colorbar
-        colorbar = plt.colorbar(CS)
+    # plot colorbar
+    colorbar = fig.colorbar(CS, ax=ax1)
 
-        # save figures
-        plt.savefig(address+"Plots/PCA_AmplitudeCoefficientMaps" + str(k).zfill(2) + \
-                    ".pdf",bbox_inches="tight",transparent=True)
-        #plt.show()
-        plt.clf()
+    # save figures
+    savePlot(fig, address+"Plots/PCA_AmplitudeCoefficientMaps" + str(k).zfill(2), fmt)
+    #plt.show()
 
 ###########
 
-print('Plot runtime = ', time.clock() - start_time,' s')
+print('Plot runtime = ', time.perf_counter() - start_time,' s')
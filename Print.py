@@ -13,11 +13,12 @@ Purpose:
 """
 import time
 import numpy as np
+import pandas as pd
 from pathlib import Path
 import os.path
 import csv
 
-start_time = time.clock()
+start_time = time.perf_counter()
 
 separator = ','
 
@@ -47,6 +48,27 @@ def readDepth(address, runIndex):
     depth = csvfile[:]
     return depth
 
+# ranges of the data (histogram limits of the streamed class statistics)
+def printDataRanges(address, runIndex, ranges):
+    print("Print.printDataRanges")
+    filename = address+"Data_store/Info/Data_ranges.csv"
+    file = open(filename,'w')
+    writer = csv.DictWriter(file, fieldnames = ['variable','low','high'], \
+                            delimiter = separator)
+    writer.writeheader()
+    writer = csv.writer(file, delimiter=separator)
+    for variable in ranges:
+        writer.writerow([variable, ranges[variable][0], ranges[variable][1]])
+    file.close()
+
+def readDataRanges(address, runIndex):
+    # {variable: (low, high)}, None for runs from before they were written
+    filename = address+"Data_store/Info/Data_ranges.csv"
+    if not os.path.isfile(filename):
+        return None
+    table = pd.read_csv(filename, header=0)
+    return {row.variable: (row.low, row.high) for row in table.itertuples()}
+
 # Col_reduced Printing
 def printColreduced(address, runIndex, col_reduced):
     print("Print.printColreduced")
@@ -71,6 +93,101 @@ def readColreduced(address, runIndex):
     print("col_reduced = ", col_reduced)
     return col_reduced
 
+# N_comp Printing (number of classes in the fitted GMM)
+def printNcomp(address, runIndex, n_comp):
+    print("Print.printNcomp")
+    filename = address+"Data_store/Info/N_comp.csv"
+    file = open(filename,'w')
+    data = [n_comp]
+    writer = csv.DictWriter(file, fieldnames = ['N_comp'], \
+                            delimiter = separator)
+    writer.writeheader()
+    writer = csv.writer(file, delimiter=separator)
+    writer.writerow(data)
+    file.close()
+
+def readNcomp(address, runIndex):
+    print("Print.readNcomp")
+    filename = address+"Data_store/Info/N_comp.csv"
+    n_comp = None
+    head_number = 1
+    csvfile = np.genfromtxt(filename, delimiter=",",\
+                            skip_header=head_number)
+    n_comp = int(csvfile)
+    print("n_comp = ", n_comp)
+    return n_comp
+
+###############################################################################
+
+# persistent profile ids (assigned in Load.loadAndClean)
+
+def printProfileIds(address, runIndex, profile_id, isTrain):
+    print("Print.printProfileIds isTrain = "+str(isTrain))
+    # one id per row of the full (or training) data files, in the same order
+    filename = address+"Data_store/Info/Profile_ids.csv"
+    if isTrain:
+        filename = address+"Data_store/Info/Profile_ids_Train.csv"
+    file = open(filename,'w')
+    writer = csv.DictWriter(file, fieldnames = ['profile_id'], delimiter = separator)
+    writer.writeheader()
+    writer = csv.writer(file, delimiter=separator)
+    writer.writerows(np.asarray(profile_id, dtype=np.int64).reshape(-1,1))
+    file.close()
+
+# ids already read, by filename: (modification time, ids)
+profile_id_cache = {}
+
+def readProfileIds(address, runIndex, isTrain=False):
+    # None when no ids have been stored (runs from before they existed)
+    filename = address+"Data_store/Info/Profile_ids.csv"
+    if isTrain:
+        filename = address+"Data_store/Info/Profile_ids_Train.csv"
+    if not os.path.isfile(filename):
+        return None
+    mtime = os.path.getmtime(filename)
+    if filename not in profile_id_cache or profile_id_cache[filename][0] != mtime:
+        profile_id = pd.read_csv(filename, header=0)['profile_id'].values
+        profile_id_cache[filename] = (mtime, profile_id.astype(np.int64))
+    return profile_id_cache[filename][1]
+
+def profileIds(address, runIndex, n_rows=None, isTrain=False):
+    # ids of the rows of the full (or training) data; a file of n_rows rows
+    # that does not match them is an error, not something to paper over
+    profile_id = readProfileIds(address, runIndex, isTrain)
+    if profile_id is None:
+        raise ValueError("Print.profileIds: no stored profile ids, "+\
+                         "run Load.main again to write them")
+    if n_rows is not None and profile_id.size != n_rows:
+        raise ValueError("Print.profileIds: "+str(n_rows)+" rows but "+\
+                         str(profile_id.size)+" stored profile ids")
+    return profile_id
+
+def profileIndex(profile_id):
+    """ Lookup table row_of_id with row_of_id[id] = row of a table whose
+    rows have the ids profile_id (-1 for ids not present), so another table
+    keyed by profile_id joins onto it in O(1) per profile """
+    profile_id = np.asarray(profile_id, dtype=np.int64)
+    row_of_id = np.full(profile_id.max() + 1, -1, dtype=np.int64)
+    row_of_id[profile_id] = np.arange(profile_id.size)
+    return row_of_id
+
+def joinRows(table_id, profile_id):
+    # rows of the table with ids table_id holding profile_id (-1 where absent)
+    row_of_id = profileIndex(table_id)
+    profile_id = np.asarray(profile_id, dtype=np.int64)
+    rows = np.full(profile_id.shape, -1, dtype=np.int64)
+    inside = (profile_id >= 0) & (profile_id < row_of_id.size)
+    rows[inside] = row_of_id[profile_id[inside]]
+    return rows
+
+def rowsWithIds(columns, profile_id):
+    # csv rows of the (float) columns, each followed by its integer id
+    if len(columns) != len(profile_id):
+        raise ValueError("Print.rowsWithIds: "+str(len(columns))+" rows but "+\
+                         str(len(profile_id))+" profile ids")
+    for line, id_ in zip(columns, np.asarray(profile_id, dtype=np.int64).tolist()):
+        yield list(line) + [id_]
+
     
 ###############################################################################
 
@@ -154,10 +271,93 @@ def readBIC(address, repeat_bic):
 
 ###############################################################################
 
+# BIC checkpoint store: one row per finished (repeat, n_components) fit
+
+def printBICCell(address, config, repeat, n_components, seed, bic, fit_time):
+    # appended (and flushed) as soon as each fit finishes
+    filename = address + "Data_store/Info/BIC_cells.csv"
+    new_file = not os.path.isfile(filename)
+    file = open(filename, 'a')
+    if not new_file and os.path.getsize(filename) > 0:
+        # finish a row left incomplete by an interrupted run
+        with open(filename, 'rb') as last:
+            last.seek(-1, os.SEEK_END)
+            if last.read(1) not in [b'\n', b'\r']:
+                file.write('\n')
+    if new_file:
+        writer = csv.DictWriter(file, fieldnames = ['config', 'repeat', \
+                 'n_components', 'seed', 'bic', 'fit_time'], delimiter = separator)
+        writer.writeheader()
+    writer = csv.writer(file, delimiter=separator)
+    writer.writerow([config, int(repeat), int(n_components), int(seed), \
+                     float(bic), float(fit_time)])
+    file.close()
+
+def readBICCells(address, config):
+    # {(repeat, n_components): (seed, bic, fit_time)} for rows written with config
+    filename = address + "Data_store/Info/BIC_cells.csv"
+    cells = {}
+    if not os.path.isfile(filename):
+        return cells
+    file = open(filename, 'r')
+    for row in csv.DictReader(file, delimiter=separator):
+        # a row cut short by an interrupted write is ignored
+        if row['config'] != config or row['fit_time'] in [None, '']:
+            continue
+        cells[(int(row['repeat']), int(row['n_components']))] = \
+            (int(row['seed']), float(row['bic']), float(row['fit_time']))
+    file.close()
+    print("Print.readBICCells found ", len(cells), " finished fits")
+    return cells
+
+###############################################################################
+
+# GMM fit telemetry (see GMM.fitWithTelemetry)
+def printFitLog(address, runIndex, name, fit_logs, append=False):
+    print("Print.printFitLog "+name)
+    # one row per EM iteration (only with telemetry or a callback)
+    filename = address + "Results/" + name + "_fit_log.csv"
+    new_file = (not append) or (not os.path.isfile(filename))
+    file = open(filename, 'w' if new_file else 'a')
+    if new_file:
+        writer = csv.DictWriter(file, fieldnames = ['label', 'n_components', \
+                 'iteration', 'lower_bound', 'e_step_time', 'm_step_time', \
+                 'converged', 'weights'], delimiter = separator)
+        writer.writeheader()
+    writer = csv.writer(file, delimiter=separator)
+    for fit_log in fit_logs:
+        for record in fit_log['iterations']:
+            weights = ' '.join(['%.6g' % w for w in record['weights']])
+            writer.writerow([fit_log['label'], fit_log['n_components'], \
+                             record['iteration'], record['lower_bound'], \
+                             record['e_step_time'], record['m_step_time'], \
+                             int(record['converged']), weights])
+    file.close()
+
+    # one row per fit
+    filename = address + "Results/" + name + "_fit_summary.csv"
+    new_file = (not append) or (not os.path.isfile(filename))
+    file = open(filename, 'w' if new_file else 'a')
+    if new_file:
+        writer = csv.DictWriter(file, fieldnames = ['label', 'n_components', \
+                 'n_iter', 'converged', 'stopped_early', 'lower_bound', \
+                 'fit_time'], delimiter = separator)
+        writer.writeheader()
+    writer = csv.writer(file, delimiter=separator)
+    for fit_log in fit_logs:
+        writer.writerow([fit_log['label'], fit_log['n_components'], \
+                         fit_log['n_iter'], int(fit_log['converged']), \
+                         int(fit_log['stopped_early']), \
+                         fit_log['lower_bound'], fit_log['fit_time']])
+    file.close()
+
+###############################################################################
+
 # load Printing
 def printLoadToFile(address, runIndex, lon, lat, dynHeight, Tint, \
                     var_centre, Sint, varTime, depth ):
     print("Print.printLoadToFile")
+    profile_id = profileIds(address, runIndex, len(lon))
     i = 0 
     for d in depth:
         filename = address+\
@@ -175,11 +375,10 @@ def printLoadToFile(address, runIndex, lon, lat, dynHeight, Tint, \
             writer = csv.DictWriter(file, fieldnames = \
                                    ['lon','lat','dynHeight',\
                                    'Tint_'+str(int(d)).zfill(3),'Tint_centred',\
-                                   'Sint','Time'], delimiter = separator)
+                                   'Sint','Time','profile_id'], delimiter = separator)
             writer.writeheader()
             writer = csv.writer(file, delimiter=separator)
-            for line in data:
-                writer.writerow(line)    
+            writer.writerows(rowsWithIds(data, profile_id))
             file.close()
             del filename, file
         
@@ -192,6 +391,7 @@ def printLoadToFile_Train(address, runIndex, lon_train, lat_train, \
                           varTrain_centre, Sint_train, varTime_train,\
                           depth ):
     print("Print.printLoadToFile_Train")
+    profile_id = profileIds(address, runIndex, len(lon_train), True)
     i = 0 
     for d in depth:
         filename_train = address+\
@@ -208,12 +408,11 @@ def printLoadToFile_Train(address, runIndex, lon_train, lat_train, \
                         fieldnames = ['lon_train','lat_train','dynHeight_train',\
                                       'VAR_train_'+str(int(d)).zfill(3),\
                                       'Var_train_centred',\
-                                      'Sint_train','Time_train'], \
+                                      'Sint_train','Time_train','profile_id'], \
                                        delimiter = separator)
         writer.writeheader()
         writer = csv.writer(file_train, delimiter=separator)    
-        for line in data_train:
-            writer.writerow(line)
+        writer.writerows(rowsWithIds(data_train, profile_id))
         file_train.close() 
         del filename_train, file_train
         
@@ -291,6 +490,37 @@ def readLoadFromFile(address, runIndex, depth):
 
     return lon, lat, dynHeight, Tint_array, X_array, Sint_array, varTime
 
+def readLoadFromFile_chunks(address, runIndex, depth, chunk_size):
+    print("Print.readLoadFromFile_chunks")
+    # generator version of readLoadFromFile, chunk_size profiles at a time,
+    # which also yields the profile ids of the chunk
+    readers = []
+    for d in depth:
+        filename = address+\
+           "Data_store/CentredAndUncentred/CentredAndUncentred_depth"+\
+           str(int(d)).zfill(3)+".csv"
+        readers.append(pd.read_csv(filename, header=0, chunksize=chunk_size, \
+                                   float_precision='round_trip'))
+
+    # the files are row-aligned (checked on the ids), so advance all
+    # readers together
+    for chunks in zip(*readers):
+        profile_id = chunks[0]['profile_id'].values.astype(np.int64)
+        for chunk in chunks[1:]:
+            if not np.array_equal(chunk['profile_id'].values, profile_id):
+                raise ValueError("Print.readLoadFromFile_chunks: depth files "+\
+                                 "are not row-aligned")
+        lon        = chunks[0].values[:,0]
+        lat        = chunks[0].values[:,1]
+        dynHeight  = chunks[0].values[:,2]
+        varTime    = chunks[0].values[:,6]
+        Tint_array = np.column_stack([chunk.values[:,3] for chunk in chunks])
+        X_array    = np.column_stack([chunk.values[:,4] for chunk in chunks])
+        Sint_array = np.column_stack([chunk.values[:,5] for chunk in chunks])
+
+        yield lon, lat, dynHeight, Tint_array, X_array, Sint_array, varTime, \
+              profile_id
+
 #######################################################################
 
 def readLoadFromFile_Train(address, runIndex, depth):
@@ -464,6 +694,7 @@ def printClassProperties(address, runIndex, classPropTuple, old2new):
 def printPCAToFile(address, runIndex, lon, lat, dynHeight, \
                    X_pca, varTime, col_reduced):
     print("Print.printPCAToFile")
+    profile_id = profileIds(address, runIndex, len(lon))
     for d in range(col_reduced):
         filename = address + "Data_store/PCA/PCA_reddepth" + \
                              str(int(d)).zfill(3) + ".csv"        
@@ -473,11 +704,10 @@ def printPCAToFile(address, runIndex, lon, lat, dynHeight, \
         data = columns
         writer = csv.DictWriter(file, \
             fieldnames = ['lon','lat','dynHeight','VAR_'+\
-            str(int(d)).zfill(3),'Time'], delimiter = separator)
+            str(int(d)).zfill(3),'Time','profile_id'], delimiter = separator)
         writer.writeheader()
         writer = csv.writer(file, delimiter=separator)    
-        for line in data:
-            writer.writerow(line)
+        writer.writerows(rowsWithIds(data, profile_id))
         file.close() 
         del filename, file
 
@@ -486,6 +716,7 @@ def printPCAToFile(address, runIndex, lon, lat, dynHeight, \
 def printPCAToFile_Train(address, runIndex, lon_train, lat_train, dynHeight_train, \
                                 X_pca_train, varTime_train, col_reduced):
     print("Print.printPCAToFile_Train")
+    profile_id = profileIds(address, runIndex, len(lon_train), True)
     for d in range(col_reduced):
         filename_train = address+\
            "Data_store/PCA_Train/PCA_Train_reddepth"+\
@@ -497,11 +728,10 @@ def printPCAToFile_Train(address, runIndex, lon_train, lat_train, dynHeight_trai
         data_train = columns_train
         writer = csv.DictWriter(file_train, fieldnames = \
             ['lon_train','lat_train','dynHeight_train','VAR_train_'+\
-            str(int(d)).zfill(3),'Time_train'], delimiter = separator)
+            str(int(d)).zfill(3),'Time_train','profile_id'], delimiter = separator)
         writer.writeheader()
         writer = csv.writer(file_train, delimiter=separator)    
-        for line in data_train:
-            writer.writerow(line)
+        writer.writerows(rowsWithIds(data_train, profile_id))
         file_train.close() 
         del filename_train, file_train
 
@@ -568,6 +798,72 @@ def readPCAFromFile_Train(address, runIndex, col_reduced):
     
     return lon_train, lat_train, dynHeight_train, X_train_array, varTime_train
 
+#######################################################################
+
+def readPCAFromFile_chunks(address, runIndex, col_reduced, chunk_size, isTrain=False):
+    print("Print.readPCAFromFile_chunks isTrain = "+str(isTrain))
+    # generator version of readPCAFromFile (or readPCAFromFile_Train): yields
+    # chunk_size profiles at a time so the full PC-score array never has to
+    # be held in memory
+    readers = []
+    for d in range(col_reduced):
+        filename = address+"Data_store/PCA/PCA_reddepth"+str(int(d)).zfill(3)+".csv"
+        if isTrain:
+            filename = address+"Data_store/PCA_Train/PCA_Train_reddepth"+\
+                       str(int(d)).zfill(3)+".csv"
+        readers.append(pd.read_csv(filename, header=0, chunksize=chunk_size, \
+                                   float_precision='round_trip'))
+
+    # the files are row-aligned, so advance all readers together
+    for chunks in zip(*readers):
+        lon       = chunks[0].values[:,0]
+        lat       = chunks[0].values[:,1]
+        dynHeight = chunks[0].values[:,2]
+        varTime   = chunks[0].values[:,4]
+        X_array   = np.column_stack([chunk.values[:,3] for chunk in chunks])
+
+        yield lon, lat, dynHeight, X_array, varTime
+
+#######################################################################
+
+def printPCAScores(address, runIndex, col_reduced, chunk_size=10000):
+    print("Print.printPCAScores")
+    # binary copy of the PCA_reddepth files for random access:
+    # PCA_scores.npy (profiles, col_reduced) and PCA_coords.npy with the
+    # columns lon, lat, dynHeight, varTime
+    filename = address+"Data_store/PCA/PCA_reddepth000.csv"
+    with open(filename) as file:
+        n_profiles = sum(1 for line in file) - 1
+    scores = np.lib.format.open_memmap(address+"Data_store/PCA/PCA_scores.npy", \
+                                       mode='w+', shape=(n_profiles, col_reduced))
+    coords = np.lib.format.open_memmap(address+"Data_store/PCA/PCA_coords.npy", \
+                                       mode='w+', shape=(n_profiles, 4))
+    start = 0
+    for lon, lat, dynHeight, X_array, varTime in \
+      readPCAFromFile_chunks(address, runIndex, col_reduced, chunk_size):
+        stop = start + X_array.shape[0]
+        scores[start:stop,:] = X_array
+        coords[start:stop,:] = np.column_stack((lon, lat, dynHeight, varTime))
+        start = stop
+    scores.flush()
+    coords.flush()
+    del scores, coords
+
+def readPCAScores(address, runIndex):
+    print("Print.readPCAScores")
+    # memory-mapped, so only the rows that are used are read from disk
+    scores = np.load(address+"Data_store/PCA/PCA_scores.npy", mmap_mode='r')
+    coords = np.load(address+"Data_store/PCA/PCA_coords.npy", mmap_mode='r')
+    return coords[:,0], coords[:,1], coords[:,2], scores, coords[:,3]
+
+def isPCAScoresCurrent(address, runIndex):
+    # the binary store is older than the csv files after a new PCA.apply
+    filename = address+"Data_store/PCA/PCA_scores.npy"
+    if not os.path.isfile(filename):
+        return False
+    return os.path.getmtime(filename) >= \
+           os.path.getmtime(address+"Data_store/PCA/PCA_reddepth000.csv")
+
 ###############################################################################
 
 def printGMMclasses(address, runIndex, class_number_array, gmm_weights, gmm_means,\
@@ -583,12 +879,15 @@ def printGMMclasses(address, runIndex, class_number_array, gmm_weights, gmm_mean
              +space+str(int(d)).zfill(3)+".csv"        
 
         file_train = open(filename_train,'w')
+        # Covariances_ is the class variance at this depth/PC, Std_ its root
         columns_train = np.column_stack((class_number_array, \
-                            gmm_weights, gmm_means[:,i], gmm_covariances[:,i]))
+                            gmm_weights, gmm_means[:,i], gmm_covariances[:,i], \
+                            np.sqrt(gmm_covariances[:,i])))
         data_train = columns_train
         writer = csv.DictWriter(file_train, \
             fieldnames = ['Class','Weights','Means_'+\
                           str(int(d)).zfill(3),'Covariances_'+\
+                          str(int(d)).zfill(3),'Std_'+\
                           str(int(d)).zfill(3)], delimiter = separator)
         writer.writeheader()
         writer = csv.writer(file_train, delimiter=separator)    
@@ -645,11 +944,11 @@ def printLabelsUnsorted(address, runIndex, lon, lat, dynHeight, varTime, labels)
     columns = np.column_stack(( lon, lat, dynHeight, varTime, labels ))
     data = columns
     writer = csv.DictWriter(file, fieldnames = \
-             ['lon','lat','dynHeight','varTime','label'], delimiter = separator)
+             ['lon','lat','dynHeight','varTime','label','profile_id'], \
+             delimiter = separator)
     writer.writeheader()
     writer = csv.writer(file, delimiter=separator)    
-    for line in data:
-        writer.writerow(line)
+    writer.writerows(rowsWithIds(data, profileIds(address, runIndex, len(lon))))
     file.close() 
     del filename, file
 
@@ -663,11 +962,11 @@ def printLabels(address, runIndex, lon, lat, dynHeight, varTime, labels):
     columns = np.column_stack(( lon, lat, dynHeight, varTime, labels ))
     data = columns
     writer = csv.DictWriter(file, fieldnames = \
-             ['lon','lat','dynHeight','varTime','label'], delimiter = separator)
+             ['lon','lat','dynHeight','varTime','label','profile_id'], \
+             delimiter = separator)
     writer.writeheader()
     writer = csv.writer(file, delimiter=separator)    
-    for line in data:
-        writer.writerow(line)
+    writer.writerows(rowsWithIds(data, profileIds(address, runIndex, len(lon))))
     file.close() 
     del filename, file
 
@@ -712,6 +1011,7 @@ def readLabels(address,runIndex):
 def printPosteriorProb(address, runIndex, lon, lat, dynHeight, \
                        varTime, post_prob, class_number_array):
     print("Print.printPosteriorProb")
+    profile_id = profileIds(address, runIndex, len(lon))
     i = 0
     for class_number in class_number_array:
         filename = address+"Data_store/Probabilities/Post_prob_class"\
@@ -721,11 +1021,10 @@ def printPosteriorProb(address, runIndex, lon, lat, dynHeight, \
         data = columns
         writer = csv.DictWriter(file, fieldnames = \
                  ['lon','lat','dynHeight','varTime','post_prob_class_'+\
-                 str(class_number)], delimiter = separator)
+                 str(class_number),'profile_id'], delimiter = separator)
         writer.writeheader()
         writer = csv.writer(file, delimiter=separator)    
-        for line in data:
-            writer.writerow(line)
+        writer.writerows(rowsWithIds(data, profile_id))
         file.close() 
         del filename, file
         i = i + 1
@@ -768,7 +1067,15 @@ def printReconstruction(address, runIndex, lon, lat, dynHeight, X, XC, \
                         varTime, depth, isTrain):
     print("Print.printReconstruction isTrain = "+str(isTrain))
     # isTrain is True or False
-    i = 0
+    files, writers = openReconstruction(address, runIndex, depth, isTrain)
+    printReconstructionChunk(writers, lon, lat, dynHeight, X, XC, varTime, \
+                             profileIds(address, runIndex, len(lon), isTrain))
+    closeReconstruction(files)
+
+def openReconstruction(address, runIndex, depth, isTrain):
+    # open one file per depth and write the headers, so the reconstruction
+    # can be written a chunk of profiles at a time
+    files, writers = [], []
     for d in depth:
         filename = address+"Data_store/Reconstruction/Recon_depth"+\
                    str(int(d)).zfill(3)+".csv"
@@ -776,22 +1083,85 @@ def printReconstruction(address, runIndex, lon, lat, dynHeight, X, XC, \
             filename = address+"Data_store/Reconstruction_Train/Recon_Train_depth"+\
                    str(int(d)).zfill(3)+".csv"
         file = open(filename,'w')
-        columns = np.column_stack(( lon, lat, dynHeight, X[:,i], XC[:,i], varTime ))
-        data = columns
         writer = csv.DictWriter(file, \
                  fieldnames = ['lon','lat','dynHeight',\
                                'X_'+str(int(d)).zfill(3), 'X_centred', \
-                               'varTime'], delimiter = separator)
+                               'varTime', 'profile_id'], delimiter = separator)
         writer.writeheader()
-        writer = csv.writer(file, delimiter=separator)    
-        for line in data:
-            writer.writerow(line)
-        file.close() 
-        del filename, file
-        i = i + 1
+        files.append(file)
+        writers.append(csv.writer(file, delimiter=separator))
+    return files, writers
+
+def printReconstructionChunk(writers, lon, lat, dynHeight, X, XC, varTime, \
+                             profile_id):
+    # XC = None writes NaN in the X_centred column
+    if XC is None:
+        XC = np.full(X.shape, np.nan)
+    for i in range(len(writers)):
+        columns = np.column_stack(( lon, lat, dynHeight, X[:,i], XC[:,i], varTime ))
+        writers[i].writerows(rowsWithIds(columns, profile_id))
+
+def closeReconstruction(files):
+    for file in files:
+        file.close()
         
 #######################################################################
 
+# reconstruction error diagnostics (see Reconstruct.errorDiagnostics)
+
+def openReconError(address, runIndex):
+    # per-profile errors, written a chunk at a time
+    filename = address+"Results/Recon_error_profiles.csv"
+    file = open(filename,'w')
+    writer = csv.DictWriter(file, fieldnames = ['index','lon','lat', \
+             'varTime','rmse','max_error','profile_id'], delimiter = separator)
+    writer.writeheader()
+    return file, csv.writer(file, delimiter=separator)
+
+def printReconErrorChunk(writer, index, lon, lat, varTime, rmse, max_error, \
+                         profile_id):
+    writer.writerows(rowsWithIds(np.column_stack((index, lon, lat, varTime, \
+                                                  rmse, max_error)), profile_id))
+
+def printReconErrorSummary(address, runIndex, depth, n_profiles, mean_error, \
+                           var_error, rmse_depth, max_error_depth, rmse, worst):
+    print("Print.printReconErrorSummary")
+    # per-depth error statistics
+    filename = address+"Results/Recon_error_depth.csv"
+    file = open(filename,'w')
+    writer = csv.DictWriter(file, fieldnames = ['depth','mean_error', \
+             'error_variance','rmse','max_abs_error'], delimiter = separator)
+    writer.writeheader()
+    writer = csv.writer(file, delimiter=separator)
+    writer.writerows(np.column_stack((depth, mean_error, var_error, \
+                                      rmse_depth, max_error_depth)))
+    file.close()
+
+    # whole-dataset summary
+    filename = address+"Results/Recon_error_summary.csv"
+    file = open(filename,'w')
+    writer = csv.DictWriter(file, fieldnames = ['n_profiles','rmse', \
+             'max_abs_error','worst_profile_rmse'], delimiter = separator)
+    writer.writeheader()
+    writer = csv.writer(file, delimiter=separator)
+    writer.writerow([n_profiles, rmse, np.max(max_error_depth), \
+                     worst[0][0] if len(worst) > 0 else np.nan])
+    file.close()
+
+    # worst profiles, largest rmse first; worst = [(rmse, index, lon, lat,
+    # varTime, max_error)]
+    filename = address+"Results/Recon_error_worst.csv"
+    file = open(filename,'w')
+    writer = csv.DictWriter(file, fieldnames = ['rank','index','lon','lat', \
+             'varTime','rmse','max_error'], delimiter = separator)
+    writer.writeheader()
+    writer = csv.writer(file, delimiter=separator)
+    for rank, (profile_rmse, index, lon, lat, varTime, max_error) in enumerate(worst):
+        writer.writerow([rank+1, index, lon, lat, varTime, profile_rmse, max_error])
+    file.close()
+
+#######################################################################
+
 def readReconstruction(address, runIndex, depth, isTrain):
     print("Print.readReconstruction isTrain = "+str(isTrain))
     # Function reads the Reconstructed XR, XRC, XR_Train, XRC_Train
@@ -838,4 +1208,4 @@ def readReconstruction(address, runIndex, depth, isTrain):
     return lon, lat, dynHeight, X_array, X_array_centred, varTime
         
     
-print('Printing runtime = ', time.clock() - start_time,' s')
+print('Printing runtime = ', time.perf_counter() - start_time,' s')
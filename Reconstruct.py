@@ -13,19 +13,63 @@ Purpose:
     - Load the Scaling object to uncentre the results
     - Print the GMM means, weights and covariances in real space
     - Print the Reconstructed train and full datasets
+    - main() runs all of these from one load of the PCA/scaling objects
+    - Summarise the reconstruction error (per profile and per depth)
+    - Reconstruct selected profiles (by index, lon/lat box or time window)
+      on demand from the stored PC scores
 
 """
 import pickle
+import collections
+import heapq
 from sklearn import mixture
 import numpy as np
 import time
 
+import GMM
+import Parallel
 import Print
 
-start_time = time.clock()
+start_time = time.perf_counter()
 
-def gmm_reconstruct(address, runIndex, n_comp):
-    print("Reconstruct.gmm_reconstruct")
+def main(address, runIndex, n_comp, chunk_size=10000, keep_centred=True, \
+         n_workers=1, full_cov=False, diagnostics=False, lazy=True):
+    print("Reconstruct.main")
+    """ Load the PCA/scaling objects, col_reduced and depth once, then
+    reconstruct the GMM classes and the training dataset. The full dataset
+    is only written with lazy=False; otherwise just the binary PC-score
+    store is built, from which reconstructProfiles/reconstructRegion
+    reconstruct any profiles on demand. With n_workers > 1 the full and
+    training outputs are written at the same time by two processes.
+    diagnostics adds the reconstruction error summaries of errorDiagnostics """
+    objects = loadObjects(address, runIndex)
+    gmm_reconstruct(address, runIndex, n_comp, objects, full_cov)
+
+    # the full dataset, or the store for reconstructing it on demand
+    full_task = (full_reconstruct, (address, runIndex, chunk_size, \
+                                    keep_centred, objects))
+    if lazy:
+        full_task = (lazyStore, (address, runIndex, chunk_size))
+
+    if n_workers == 1:
+        full_task[0](*full_task[1])
+        train_reconstruct(address, runIndex, chunk_size, keep_centred, objects)
+    else:
+        pool = Parallel.makePool(2)
+        try:
+            jobs = [pool.apply_async(full_task[0], full_task[1]), \
+                    pool.apply_async(train_reconstruct, (address, runIndex, \
+                                     chunk_size, keep_centred, objects))]
+            for job in jobs:
+                job.get()
+        finally:
+            pool.close()
+            pool.join()
+
+    if diagnostics:
+        errorDiagnostics(address, runIndex, chunk_size, objects=objects)
+
+def loadObjects(address, runIndex):
     # Load the pca object for the inverse transform
     pca = None
     with open(address+'Objects/PCA_object.pkl', 'rb') as input:
@@ -39,25 +83,49 @@ def gmm_reconstruct(address, runIndex, n_comp):
     # Load col_reduced value
     col_reduced = None
     col_reduced = Print.readColreduced(address, runIndex)
-    col_reduced_array = np.arange(col_reduced)
     
     # Load depth
     depth = None
     depth = Print.readDepth(address, runIndex)
+    return pca, stand, col_reduced, depth
+
+def inverseTransform(pca, stand):
+    """ The inverse PCA and the inverse scaling are both affine, so the
+    reconstruction is X_pca.W + b. Returns (W, b) for the centred
+    (R = reconstructed, C = centred) and the uncentred reconstructions """
+    W_centred = pca.components_
+    if pca.whiten:
+        W_centred = W_centred*np.sqrt(pca.explained_variance_)[:,np.newaxis]
+    b_centred = pca.mean_
+    W = W_centred*stand.scale_
+    b = b_centred*stand.scale_ + stand.mean_
+    return W_centred, b_centred, W, b
+
+def gmm_reconstruct(address, runIndex, n_comp, objects=None, full_cov=False):
+    print("Reconstruct.gmm_reconstruct")
+    """ Class means and per-depth variances in depth space. The covariances
+    are projected with W^T.Sigma.W (then scaled by the outer product of the
+    scaling factors when uncentred); only the diagonals are printed. With
+    full_cov the full depth-space matrices are also pickled to
+    Objects/GMM_covariances_depth.pkl """
+    # PCA and scaling objects, col_reduced and depth
+    if objects is None:
+        objects = loadObjects(address, runIndex)
+    pca, stand, col_reduced, depth = objects
     
-    # Load the gmm properties
-    gmm_weights, gmm_means, gmm_covariances = None, None, None
-    gmm_weights, gmm_means, gmm_covariances = \
-            Print.readGMMclasses(address, runIndex, \
-                                 col_reduced_array, 'reduced')
+    # Load the gmm object
+    gmm = None
+    with open(address+'Objects/GMM_Object.pkl', 'rb') as input:
+        gmm = pickle.load(input)
     
     """ Finished loading, now inverse transform and print """
     
     # Inverse transform gmm properties
+    W_centred, b_centred, W, b = inverseTransform(pca, stand)
     weights, means, covariances = None, None, None
-    weights = gmm_weights
-    means = pca.inverse_transform(gmm_means)
-    covariances = pca.inverse_transform(gmm_covariances)
+    weights = gmm.weights_
+    means = gmm.means_.dot(W_centred) + b_centred
+    covariances = covarianceDiagonal(gmm, W_centred)
     
     # Print the results to a file
     class_number_array = np.arange(0,n_comp)
@@ -68,90 +136,254 @@ def gmm_reconstruct(address, runIndex, n_comp):
     weights_UC, means_UC, covariances_UC = None, None, None
     weights_UC = weights
     means_UC = stand.inverse_transform(means)
-    covariances_UC = stand.inverse_transform(covariances)
+    covariances_UC = covariances*stand.scale_**2
     Print.printGMMclasses(address, runIndex, class_number_array, \
                           weights_UC, means_UC, covariances_UC, depth, \
                           'uncentred')
-    
-    del pca, stand
+
+    # full (n_comp, depth, depth) matrices, only when asked for
+    if full_cov:
+        cov_depth = {}
+        cov_depth['centred'] = covarianceMatrices(gmm, W_centred)
+        cov_depth['uncentred'] = cov_depth['centred']*np.outer(stand.scale_, stand.scale_)
+        cov_depth['depth'] = depth
+        with open(address+'Objects/GMM_covariances_depth.pkl', 'wb') as output:
+            pickle.dump(cov_depth, output, pickle.HIGHEST_PROTOCOL)
+
+def covarianceDiagonal(gmm, W):
+    # diag(W^T.Sigma_k.W) for each class without forming the depth x depth
+    # matrices, shape (n_comp, n_depth)
+    cov_type = gmm.covariance_type
+    if cov_type == 'full':
+        return np.einsum('pi,kpq,qi->ki', W, gmm.covariances_, W)
+    elif cov_type == 'tied':
+        return np.tile(np.einsum('pi,pq,qi->i', W, gmm.covariances_, W), \
+                       (gmm.n_components, 1))
+    elif cov_type == 'diag':
+        return gmm.covariances_.dot(W**2)
+    return np.outer(gmm.covariances_, np.sum(W**2, axis=0))
+
+def covarianceMatrices(gmm, W):
+    # W^T.Sigma_k.W for each class, shape (n_comp, n_depth, n_depth)
+    return np.einsum('pi,kpq,qj->kij', W, GMM.componentCovariances(gmm), W)
+
 ###############################################################################
     
-def train_reconstruct(address, runIndex):
+def train_reconstruct(address, runIndex, chunk_size=10000, keep_centred=True, \
+                      objects=None):
     print("Reconstruct.train_reconstruct")
-    # Load the pca object for the inverse transform
-    pca = None
-    with open(address+'Objects/PCA_object.pkl', 'rb') as input:
-        pca = pickle.load(input)
-    # Load the scaled object for the uncentering 
-    stand = None
-    with open(address+"Objects/Scale_object.pkl", 'rb') as input:
-        stand = pickle.load(input)
-        
-    # load col_reduced value
-    col_reduced, col_reduced_array = None, None
-    col_reduced = Print.readColreduced(address, runIndex)
-    col_reduced_array = np.arange(col_reduced)
-    
-    # load depth
-    depth = None
-    depth = Print.readDepth(address, runIndex)
-    
-    # load the training varaible
-    lon_train, lat_train, dynHeight_train, X_train_array, \
-        varTime_train = None, None, None, None, None
-    lon_train, lat_train, dynHeight_train, X_train_array, \
-        varTime_train = Print.readPCAFromFile_Train(address, \
-        runIndex, col_reduced)
-    
-    # reconstruct
-    XRC_train = None     # R = reconstructed, C = centred
-    XRC_train = pca.inverse_transform(X_train_array)
+    reconstructChunks(address, runIndex, True, chunk_size, keep_centred, objects)
     
-    # uncentre
-    XR_train = None          # R = reconstructed
-    XR_train = stand.inverse_transform(XRC_train)
-    
-    # Print the results to a file
-    Print.printReconstruction(address, runIndex, lon_train, lat_train, \
-                              dynHeight_train, XR_train, XRC_train, \
-                              varTime_train, depth, True)
-    
-def full_reconstruct(address, runIndex):
+def full_reconstruct(address, runIndex, chunk_size=10000, keep_centred=True, \
+                     objects=None):
     print("Reconstruct.full_reconstruct")
-    # Load the pca object for the inverse transform
-    pca = None
-    with open(address+'Objects/PCA_object.pkl', 'rb') as input:
-        pca = pickle.load(input)
-    
-    # Load the scaled object for the uncentering 
-    stand = None
-    with open(address+"Objects/Scale_object.pkl", 'rb') as input:
-        stand = pickle.load(input)
-    
-    # Load col_reduced value
-    col_reduced, col_reduced_array = None, None
-    col_reduced = Print.readColreduced(address, runIndex)
-    col_reduced_array = np.arange(col_reduced)
-    
-    # Load depth
-    depth = None
-    depth = Print.readDepth(address, runIndex)
-    
-    # Load the training varaible
-    lon, lat, dynHeight, X_array, varTime = None, None, None, None, None
-    lon, lat, dynHeight, X_array, varTime = \
-        Print.readPCAFromFile(address, runIndex, col_reduced)
-    
-    # Reconstruct
-    XRC = None     # R = reconstructed, C = centred
-    XRC = pca.inverse_transform(X_array)
-    
-    # Uncentre
-    XR = None          # R = reconstructed
-    XR = stand.inverse_transform(XRC)
-    
-    # Print the results to a file
-    Print.printReconstruction(address, runIndex, lon, lat, dynHeight,\
-                              XR, XRC, varTime, depth, False)
+    reconstructChunks(address, runIndex, False, chunk_size, keep_centred, objects)
+
+def reconstructChunks(address, runIndex, isTrain, chunk_size=10000, \
+                      keep_centred=True, objects=None):
+    # PCA and scaling objects, col_reduced and depth
+    if objects is None:
+        objects = loadObjects(address, runIndex)
+    pca, stand, col_reduced, depth = objects
+    W_centred, b_centred, W, b = inverseTransform(pca, stand)
+
+    # stored profile ids, in the row order of the PCA files
+    profile_id = Print.profileIds(address, runIndex, None, isTrain)
+
+    # read the PC scores, reconstruct and write a chunk of profiles at a time
+    files, writers = Print.openReconstruction(address, runIndex, depth, isTrain)
+    start = 0
+    try:
+        for lon, lat, dynHeight, X_array, varTime in \
+          Print.readPCAFromFile_chunks(address, runIndex, col_reduced, \
+                                       chunk_size, isTrain):
+            stop = start + X_array.shape[0]
+            # Reconstruct and uncentre in one step
+            XR = None          # R = reconstructed
+            XR = X_array.dot(W) + b
+            
+            # centred reconstruction only when it is kept
+            XRC = None     # R = reconstructed, C = centred
+            if keep_centred:
+                XRC = X_array.dot(W_centred) + b_centred
+            
+            # Print the results to a file
+            Print.printReconstructionChunk(writers, lon, lat, dynHeight, \
+                                           XR, XRC, varTime, profile_id[start:stop])
+            start = stop
+    finally:
+        Print.closeReconstruction(files)
+
+###############################################################################
+
+def errorDiagnostics(address, runIndex, chunk_size=10000, n_worst=20, \
+                     objects=None):
+    print("Reconstruct.errorDiagnostics")
+    """ Compare every profile with its reconstruction from the retained PCs
+    (in the uncentred units of the data), streaming the Load and PCA files
+    together. Per-profile RMSE and maximum error are written a chunk at a
+    time, the per-depth error mean/variance are running accumulators and
+    only the n_worst worst profiles are kept, so memory does not grow with
+    the number of profiles """
+    # PCA and scaling objects, col_reduced and depth
+    if objects is None:
+        objects = loadObjects(address, runIndex)
+    pca, stand, col_reduced, depth = objects
+    W_centred, b_centred, W, b = inverseTransform(pca, stand)
+
+    # running totals per depth
+    n_total = 0
+    mean_error = np.zeros(len(depth))
+    M2_error = np.zeros(len(depth))      # sum of squared deviations from the mean
+    sq_error = np.zeros(len(depth))
+    max_error_depth = np.zeros(len(depth))
+    worst = []      # min-heap of (rmse, index, lon, lat, varTime, max_error)
+
+    file, writer = Print.openReconError(address, runIndex)
+    try:
+        for (lon, lat, dynHeight, Tint_array, X_centred, Sint_array, varTime, \
+             profile_id), \
+            (lon_pca, lat_pca, dynHeight_pca, X_array, varTime_pca) in \
+          zip(Print.readLoadFromFile_chunks(address, runIndex, depth, chunk_size), \
+              Print.readPCAFromFile_chunks(address, runIndex, col_reduced, chunk_size)):
+            error = Tint_array - (X_array.dot(W) + b)
+            n_chunk = error.shape[0]
+            index = np.arange(n_total, n_total + n_chunk)
+
+            # per profile
+            rmse = np.sqrt(np.mean(error**2, axis=1))
+            max_error = np.max(np.abs(error), axis=1)
+            Print.printReconErrorChunk(writer, index, lon, lat, varTime, \
+                                       rmse, max_error, profile_id)
+            if n_worst > 0:
+                for k in np.argsort(rmse)[-n_worst:]:
+                    item = (rmse[k], index[k], lon[k], lat[k], varTime[k], max_error[k])
+                    if len(worst) < n_worst:
+                        heapq.heappush(worst, item)
+                    elif item > worst[0]:
+                        heapq.heapreplace(worst, item)
+
+            # per depth, merge the chunk mean and M2 into the running totals
+            mean_chunk = error.mean(axis=0)
+            M2_chunk = np.sum((error - mean_chunk)**2, axis=0)
+            delta = mean_chunk - mean_error
+            n_new = n_total + n_chunk
+            mean_error = mean_error + delta*n_chunk/n_new
+            M2_error = M2_error + M2_chunk + delta**2*n_total*n_chunk/n_new
+            sq_error = sq_error + np.sum(error**2, axis=0)
+            max_error_depth = np.maximum(max_error_depth, np.max(np.abs(error), axis=0))
+            n_total = n_new
+    finally:
+        file.close()
+
+    var_error = M2_error/n_total
+    rmse_depth = np.sqrt(sq_error/n_total)
+    rmse = np.sqrt(np.sum(sq_error)/(n_total*len(depth)))
+    worst = sorted(worst, reverse=True)
+    print("Reconstruct.errorDiagnostics rmse = ", rmse, " over ", n_total, " profiles")
+    Print.printReconErrorSummary(address, runIndex, depth, n_total, mean_error, \
+                                 var_error, rmse_depth, max_error_depth, rmse, worst)
+
+###############################################################################
+# on-demand reconstruction of selected profiles from the stored PC scores
+
+# objects, memory-mapped scores and the block cache of the open store
+lazy_state = {}
+lazy_cache = collections.OrderedDict()
+
+def lazyStore(address, runIndex, block_size=10000, col_reduced=None):
+    """ Build the binary PC-score store unless it is already up to date """
+    if Print.isPCAScoresCurrent(address, runIndex):
+        return
+    if col_reduced is None:
+        col_reduced = Print.readColreduced(address, runIndex)
+    Print.printPCAScores(address, runIndex, col_reduced, block_size)
+
+def lazyOpen(address, runIndex, block_size=10000, max_blocks=32):
+    """ Open (or reuse) the PC-score store of address/runIndex. The binary
+    store is built from the PCA_reddepth files the first time, and rebuilt
+    after PCA.apply has rewritten them """
+    key = (address, runIndex, block_size)
+    if lazy_state.get('key') == key and Print.isPCAScoresCurrent(address, runIndex):
+        lazy_state['max_blocks'] = max_blocks
+        return lazy_state
+    print("Reconstruct.lazyOpen")
+    pca, stand, col_reduced, depth = loadObjects(address, runIndex)
+    lazyStore(address, runIndex, block_size, col_reduced)
+    lon, lat, dynHeight, scores, varTime = Print.readPCAScores(address, runIndex)
+
+    lazy_state.clear()
+    lazy_cache.clear()
+    lazy_state['key'] = key
+    lazy_state['block_size'] = block_size
+    lazy_state['max_blocks'] = max_blocks
+    lazy_state['depth'] = depth
+    lazy_state['scores'] = scores
+    lazy_state['lon'], lazy_state['lat'] = lon, lat
+    lazy_state['dynHeight'], lazy_state['varTime'] = dynHeight, varTime
+    W_centred, b_centred, W, b = inverseTransform(pca, stand)
+    lazy_state[True] = (W_centred, b_centred)     # centred
+    lazy_state[False] = (W, b)                    # uncentred
+    return lazy_state
+
+def lazyBlock(block, centred):
+    # reconstructed rows of one block, least recently used blocks dropped
+    key = (block, centred)
+    if key in lazy_cache:
+        lazy_cache.move_to_end(key)
+        return lazy_cache[key]
+    block_size = lazy_state['block_size']
+    W, b = lazy_state[centred]
+    X_block = np.asarray(lazy_state['scores'][block*block_size:(block+1)*block_size])
+    X_block = X_block.dot(W) + b
+    lazy_cache[key] = X_block
+    while len(lazy_cache) > lazy_state['max_blocks']:
+        lazy_cache.popitem(last=False)
+    return X_block
+
+def reconstructProfiles(address, runIndex, indices, centred=False, \
+                        block_size=10000, max_blocks=32):
+    print("Reconstruct.reconstructProfiles")
+    """ Depth-space profiles for the given profile indices (rows of the
+    PCA_reddepth files), without reconstructing the whole dataset. Returns
+    lon, lat, dynHeight, X (indices, depth), varTime and depth """
+    state = lazyOpen(address, runIndex, block_size, max_blocks)
+    indices = np.asarray(indices, dtype=int).ravel()
+    X = np.empty((indices.size, len(state['depth'])))
+    blocks = indices//block_size
+    for block in np.unique(blocks):
+        rows = np.where(blocks == block)[0]
+        X[rows,:] = lazyBlock(block, centred)[indices[rows] - block*block_size,:]
+    return state['lon'][indices], state['lat'][indices], \
+           state['dynHeight'][indices], X, state['varTime'][indices], state['depth']
+
+def selectProfiles(address, runIndex, lon_range=None, lat_range=None, \
+                   time_range=None, block_size=10000):
+    """ Indices of the profiles inside a lon/lat box and time window, each
+    given as (min, max) or None. A lon_range with min > max crosses the
+    dateline """
+    state = lazyOpen(address, runIndex, block_size)
+    lon, lat, varTime = state['lon'], state['lat'], state['varTime']
+    select = np.ones(lon.shape, dtype=bool)
+    if lon_range is not None:
+        if lon_range[0] <= lon_range[1]:
+            select &= (lon >= lon_range[0]) & (lon <= lon_range[1])
+        else:
+            select &= (lon >= lon_range[0]) | (lon <= lon_range[1])
+    if lat_range is not None:
+        select &= (lat >= lat_range[0]) & (lat <= lat_range[1])
+    if time_range is not None:
+        select &= (varTime >= time_range[0]) & (varTime <= time_range[1])
+    return np.where(select)[0]
+
+def reconstructRegion(address, runIndex, lon_range=None, lat_range=None, \
+                      time_range=None, centred=False, block_size=10000, \
+                      max_blocks=32):
+    print("Reconstruct.reconstructRegion")
+    # reconstructProfiles for the profiles chosen by selectProfiles
+    indices = selectProfiles(address, runIndex, lon_range, lat_range, \
+                             time_range, block_size)
+    return (indices,) + reconstructProfiles(address, runIndex, indices, \
+                                            centred, block_size, max_blocks)
 
-print('Reconstruct runtime = ', time.clock() - start_time,' s')
+print('Reconstruct runtime = ', time.perf_counter() - start_time,' s')